@@ -0,0 +1,95 @@
+"""
+Rendering of the box plots of the quantification tables.
+The plots are rendered (by a pool of processes or one after another) with the non-interactive "Agg" backend, so they
+also render without a display, and every figure gets closed right after it's saved. A plot is only rendered again, if its data (the rows of the plotted columns), its annotations
+or the style changed. The hashes of the rendered plots are kept in a `.plot_cache.json` file of the output folder.
+(c) 2024, Maximilian Otto, Berlin.
+"""
+
+import os, json, hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+
+plot_cache_file_name = ".plot_cache.json"
+
+# Everything that changes the look of a plot, part of the hash of every plot
+# (increase "version" when the rendering itself changes)
+box_plot_style = {
+    "version": 1,
+    "context": "paper",
+    "style": "whitegrid",
+    "height": 7,
+    "aspect": 0.8,
+    "alpha": 0.5,
+    "linewidth": 0.5,
+    "text_format": "star",
+    "loc": "outside",
+}
+
+# Hash of a plot: its rows, annotations and style
+def plot_hash(job):
+    sha1 = hashlib.sha1(json.dumps({key: value for key, value in job.items() if key != "data"}, sort_keys=True, default=str).encode())
+    sha1.update(pd.util.hash_pandas_object(job["data"], index=False).to_numpy().tobytes())
+    return sha1.hexdigest()
+
+# Use the non-interactive backend, in the processes of the pool and when the plots are rendered one after another
+def use_agg_backend():
+    import matplotlib
+    matplotlib.use("Agg")
+
+# Render a single box plot with the single values on top and save it
+# input: data with the columns x and y, file name of the `.png file`, order of the boxes,
+#        pairs of boxes with their (already corrected) p-values to annotate, name of the test, style
+def render_box_plot(data, x, y, file_name, order=None, box_pairs=(), p_values=(), test_short_name=None, style=box_plot_style):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    sns.set_theme(context=style["context"], style=style["style"])
+    grid = sns.catplot(x=x, y=y, kind="box", legend=False, height=style["height"], aspect=style["aspect"], data=data, order=order, fliersize=0)
+    try:
+        ax = sns.stripplot(x=x, y=y, data=data, order=order, jitter=True, dodge=True, marker="o", alpha=style["alpha"], linewidth=style["linewidth"], ax=grid.ax)
+        if len(box_pairs) > 0:
+            from statannot import add_stat_annotation
+            add_stat_annotation(ax, data=data, x=x, y=y, order=order, box_pairs=list(box_pairs), perform_stat_test=False, pvalues=list(p_values),
+                                test_short_name=test_short_name, comparisons_correction=None, text_format=style["text_format"], loc=style["loc"], verbose=0)
+        grid.figure.savefig(file_name, bbox_inches="tight")
+    finally:
+        plt.close(grid.figure)
+    return file_name
+
+# Render all plots that changed since the last run
+# input: list of keyword arguments of `render_box_plot()`, number of processes (1 to render them one after another),
+#        folder of the plot cache (default: folder of the first plot)
+# return: number of rendered plots
+def render_box_plots(jobs, n_workers=1, cache_folder_path=None):
+    if len(jobs) == 0:
+        return 0
+    cache_file_name = os.path.join(cache_folder_path or os.path.dirname(os.path.abspath(jobs[0]["file_name"])), plot_cache_file_name)
+    cache = {}
+    if os.path.isfile(cache_file_name):
+        try:
+            with open(cache_file_name) as f:
+                cache = json.load(f)
+        except ValueError:
+            cache = {}
+
+    hashes = {job["file_name"]: plot_hash(job) for job in jobs}
+    jobs = [job for job in jobs if not (os.path.isfile(job["file_name"]) and cache.get(os.path.abspath(job["file_name"])) == hashes[job["file_name"]])]
+    try:
+        if n_workers <= 1:
+            if jobs:
+                use_agg_backend()
+            for job in jobs:
+                render_box_plot(**job)
+                cache[os.path.abspath(job["file_name"])] = hashes[job["file_name"]]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=use_agg_backend) as executor:
+                futures = [executor.submit(render_box_plot, **job) for job in jobs]
+                for future in as_completed(futures):
+                    file_name = future.result()
+                    cache[os.path.abspath(file_name)] = hashes[file_name]
+    finally:
+        with open(cache_file_name + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(cache_file_name + ".tmp", cache_file_name)
+    return len(jobs)
@@ -0,0 +1,78 @@
+"""
+Build manifest of the pipeline stages (data preparation, thresholding, mask conversion, quantification).
+For every image set, a stage records the content hashes of its input files, its parameters and the content hashes
+of the files it wrote. An image set only gets rebuilt, if one of these changed or an output file is missing,
+instead of skipping everything with an existing output file name.
+The manifest is a `.json file` in the output folder of the stage.
+The content hashes are cached by file size and modification time, so unchanged files are only read once.
+(c) 2024, Maximilian Otto, Berlin.
+"""
+
+import os, json, hashlib
+
+# sha1 of the content of a file
+# hashes: {file: [size, modification time, sha1]}, the hash is only recalculated if the size or the modification time changed
+def file_hash(file_name, hashes):
+    stat = os.stat(file_name)
+    cached = hashes.get(file_name)
+    if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached[2]
+    sha1 = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    hashes[file_name] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+    return hashes[file_name][2]
+
+# Parameters the way they are stored in the `.json file`, e.g. tuples become lists
+def normalize_parameters(parameters):
+    return json.loads(json.dumps(parameters, sort_keys=True, default=str))
+
+# Manifest of a single stage:
+#  {"stage": name, "hashes": {file: [size, modification time, sha1]},
+#   "entries": {key: {"inputs": {file: sha1}, "parameters": {...}, "outputs": {file: sha1}}}}
+# The key identifies an image set within the stage, e.g. the file name of its first channel.
+class BuildManifest:
+    def __init__(self, folder_path, stage):
+        self.file_name = os.path.join(folder_path, f".build_manifest_{stage}.json")
+        self.stage = stage
+        self.hashes = {}
+        self.entries = {}
+        if os.path.isfile(self.file_name):
+            with open(self.file_name) as f:
+                manifest = json.load(f)
+            self.hashes = manifest["hashes"]
+            self.entries = manifest["entries"]
+
+    def hash(self, file_name):
+        return file_hash(os.path.abspath(file_name), self.hashes)
+
+    def hash_files(self, file_names):
+        return {os.path.abspath(file_name): self.hash(file_name) for file_name in file_names}
+
+    # return: True if the image set was built with the same inputs and parameters and all outputs are unchanged
+    def is_up_to_date(self, key, inputs, parameters, outputs):
+        entry = self.entries.get(key)
+        if entry is None or entry["parameters"] != normalize_parameters(parameters):
+            return False
+        if sorted(entry["inputs"]) != sorted(os.path.abspath(file_name) for file_name in inputs):
+            return False
+        if sorted(entry["outputs"]) != sorted(os.path.abspath(file_name) for file_name in outputs):
+            return False
+        for file_name, sha1 in list(entry["inputs"].items()) + list(entry["outputs"].items()):
+            if not os.path.isfile(file_name) or self.hash(file_name) != sha1:
+                return False
+        return True
+
+    # Record a (re)built image set
+    def record(self, key, inputs, parameters, outputs):
+        self.entries[key] = {
+            "inputs": self.hash_files(inputs),
+            "parameters": normalize_parameters(parameters),
+            "outputs": self.hash_files(outputs),
+        }
+
+    def save(self):
+        with open(self.file_name + ".tmp", "w") as f:
+            json.dump({"stage": self.stage, "hashes": self.hashes, "entries": self.entries}, f)
+        os.replace(self.file_name + ".tmp", self.file_name)
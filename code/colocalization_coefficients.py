@@ -0,0 +1,211 @@
+"""
+Intensity based colocalization coefficients of channel pairs: Pearson's r, Manders' M1/M2, the overlap coefficient
+and the Costes automatic thresholds with the thresholded Manders' coefficients (tM1/tM2).
+A single pass over the pixels of a channel pair builds its joint intensity histogram (with `bincount`) and the exact
+sums of the intensities. Pearson's r, Manders' coefficients and the overlap coefficient come from the exact sums.
+The Costes search only needs cumulative sums of the histogram, instead of one pass over the image per threshold.
+Channels with more than 8 bits are binned to `bits` bits per channel, the Costes thresholds and the thresholded
+Manders' coefficients are calculated with the centers of the bins then.
+The histograms and sums of several crops (e.g. the ROI bands) can simply be added up.
+The Costes randomization test scrambles blocks of the size of the point spread function. Only the sum of the products
+of the two channels changes with the scrambling, so every shuffle is a gather of the blocks and one dot product,
+done for a whole batch of shuffles at once (the random picks of all shuffles and one matrix-vector product).
+(c) 2024, Maximilian Otto, Berlin.
+"""
+
+import time
+import numpy as np
+
+# Columns per channel pair, in the order of `coefficients()`
+coefficient_names = [
+    "Pearson's r", "Manders' M1", "Manders' M2", "Overlap coefficient",
+    "Costes threshold 1", "Costes threshold 2", "Costes tM1", "Costes tM2",
+]
+
+# Columns per channel pair of the randomization test, in the order of `randomization_test()`
+randomization_names = ["Costes p-value", "Randomized Pearson's r (mean)", "Costes randomizations"]
+
+# Number of bits a channel gets binned to
+def histogram_bits(dtype, bits=10):
+    return min(np.iinfo(dtype).bits, 8 if dtype == np.uint8 else bits)
+
+# Names of the exact sums of `joint_statistics()`
+sum_names = ["n", "sum1", "sum2", "sum11", "sum22", "sum12", "sum1 where ch2 > 0", "sum2 where ch1 > 0"]
+
+# Joint intensity histogram and exact intensity sums of two integer channels of the same dtype
+# input: 2D channels, optional boolean mask of the pixels to use (e.g. the ROI), bits per channel for > 8 bit channels
+# return: (histogram (levels of ch1, levels of ch2), int64 sums in the order of `sum_names`)
+def joint_statistics(ch1, ch2, mask=None, bits=10, block_rows=256):
+    hist_bits = histogram_bits(ch1.dtype, bits)
+    shift = np.iinfo(ch1.dtype).bits - hist_bits
+    n_levels = 1 << hist_bits
+    hist = np.zeros(n_levels * n_levels, dtype=np.int64)
+    sums = np.zeros(len(sum_names), dtype=np.int64)
+    # The sums of a block are float64 dot products (fast), they are exact integers as long as they stay below 2^53,
+    # so a block has at most 2^53 / (2^16 - 1)^2 (about 2 million) pixels. The blocks are added up as int64.
+    block_rows = max(1, min(block_rows, (1 << 21) // max(1, ch1.shape[1])))
+    for row in range(0, ch1.shape[0], block_rows):
+        codes = (ch1[row:row + block_rows] >> shift).astype(np.intp) * n_levels + (ch2[row:row + block_rows] >> shift)
+        block1 = ch1[row:row + block_rows].astype(np.float64)
+        block2 = ch2[row:row + block_rows].astype(np.float64)
+        if mask is not None:
+            codes, block1, block2 = codes[mask[row:row + block_rows]], block1[mask[row:row + block_rows]], block2[mask[row:row + block_rows]]
+        hist += np.bincount(codes.ravel(), minlength=n_levels * n_levels)
+        block1, block2 = block1.ravel(), block2.ravel()
+        sums += [int(value) for value in (block1.size, block1.sum(), block2.sum(), block1 @ block1, block2 @ block2, block1 @ block2,
+                                          block1 @ (block2 > 0), block2 @ (block1 > 0))]
+    return hist.reshape(n_levels, n_levels), sums
+
+# Intensity of every level of a histogram (center of its bin)
+def level_values(n_levels, dtype):
+    shift = np.iinfo(dtype).bits - int(np.log2(n_levels))
+    return np.arange(n_levels, dtype=np.float64) * (1 << shift) + ((1 << shift) - 1) / 2
+
+# Pearson's r from the sums of a set of pixels
+def pearson_from_sums(n, sum1, sum2, sum11, sum22, sum12):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covariance = n * sum12 - sum1 * sum2
+        variance1 = n * sum11 - sum1 ** 2
+        variance2 = n * sum22 - sum2 ** 2
+        return covariance / np.sqrt(variance1 * variance2)
+
+# Sums over all pixels with level1 >= i and level2 >= j, for all i, j (2D suffix sums)
+def suffix_sums(values):
+    return values[::-1, ::-1].cumsum(axis=0).cumsum(axis=1)[::-1, ::-1]
+
+# Costes automatic thresholds: the thresholds move down the orthogonal regression line of the two channels,
+# until the pixels below the thresholds (below threshold 1 or below threshold 2) aren't correlated anymore (r <= 0).
+# return: (threshold level of ch1, threshold level of ch2), or None if the channels aren't positively correlated
+def costes_thresholds(hist, values1, values2):
+    n = hist.sum()
+    a, b = values1[:, None], values2[None, :]
+    sums = [hist * a, hist * b, hist * a * a, hist * b * b, hist * a * b]
+    totals = [total.sum() for total in sums]
+    mean1, mean2 = totals[0] / n, totals[1] / n
+    variance1 = totals[2] / n - mean1 ** 2
+    variance2 = totals[3] / n - mean2 ** 2
+    covariance = totals[4] / n - mean1 * mean2
+    if covariance <= 0:
+        return None
+    slope = (variance2 - variance1 + np.sqrt((variance2 - variance1) ** 2 + 4 * covariance ** 2)) / (2 * covariance)
+    intercept = mean2 - slope * mean1
+
+    # sums of the pixels above both thresholds, for every pair of thresholds at once
+    above = [suffix_sums(hist)] + [suffix_sums(values) for values in sums]
+    levels1 = np.arange(hist.shape[0])
+    # every level of ch1 is a candidate, the threshold of ch2 is on the regression line
+    levels2 = np.clip(np.searchsorted(values2, slope * values1 + intercept, side="left"), 0, hist.shape[1] - 1)
+    below = [total - above_sums[levels1, levels2] for total, above_sums in zip([n] + totals, above)]
+    r_below = pearson_from_sums(*below)
+    # from the highest threshold down, the first one where the pixels below aren't correlated anymore
+    uncorrelated = np.flatnonzero(~(r_below > 0))
+    level1 = uncorrelated[-1] if uncorrelated.size else 0
+    return int(level1), int(levels2[level1])
+
+# All coefficients of a channel pair from its joint histogram and exact sums (see `joint_statistics()`)
+# return: list in the order of `coefficient_names`, NaN if undefined (e.g. a channel without signal)
+def coefficients(hist, sums, dtype=np.uint8):
+    values1 = level_values(hist.shape[0], dtype)
+    values2 = level_values(hist.shape[1], dtype)
+    a, b = values1[:, None], values2[None, :]
+    # Python integers, so the products of the sums are exact and can't overflow
+    n, sum1, sum2, sum11, sum22, sum12, within1, within2 = (int(value) for value in sums)
+    if n == 0:
+        return [float("nan")] * len(coefficient_names)
+    covariance = n * sum12 - sum1 * sum2
+    variance1, variance2 = n * sum11 - sum1 ** 2, n * sum22 - sum2 ** 2
+    pearson = covariance / np.sqrt(float(variance1) * float(variance2)) if variance1 and variance2 else float("nan")
+
+    # Manders' coefficients: fraction of the intensity of one channel where the other channel has signal (intensity > 0)
+    manders_m1 = within1 / sum1 if sum1 else float("nan")
+    manders_m2 = within2 / sum2 if sum2 else float("nan")
+    overlap = sum12 / np.sqrt(float(sum11) * float(sum22)) if sum11 and sum22 else float("nan")
+
+    thresholds = costes_thresholds(hist, values1, values2)
+    if thresholds is None:
+        threshold1 = threshold2 = costes_m1 = costes_m2 = float("nan")
+    else:
+        level1, level2 = thresholds
+        # lowest intensity of the threshold levels
+        threshold1, threshold2 = level1 * (values1[1] - values1[0]), level2 * (values2[1] - values2[0])
+        # thresholded Manders' coefficients: intensity at or above both thresholds / intensity at or above the own threshold
+        with np.errstate(divide="ignore", invalid="ignore"):
+            costes_m1 = (hist[level1:, level2:] * a[level1:]).sum() / (hist[level1:, :] * a[level1:]).sum()
+            costes_m2 = (hist[level1:, level2:] * b[:, level2:]).sum() / (hist[:, level2:] * b[:, level2:]).sum()
+    return [float(value) for value in (pearson, manders_m1, manders_m2, overlap, threshold1, threshold2, costes_m1, costes_m2)]
+
+# Column names of the coefficients of the channel pairs
+# input: list of (name of ch1, name of ch2)
+def coefficient_columns(pair_names):
+    return [f"{name} ({name1} & {name2})" for name1, name2 in pair_names for name in coefficient_names]
+
+# Coefficients of the channel pairs as columns of the quantification table
+# input: {(ch1 index, ch2 index): (joint histogram, sums) of `joint_statistics()`}, channel names by index, dtype of the channels
+def coefficient_row(statistics, channel_names, dtype=np.uint8):
+    row = {}
+    for (i, j), (hist, sums) in statistics.items():
+        row.update(zip(coefficient_columns([(channel_names[i], channel_names[j])]), coefficients(hist, sums, dtype)))
+    return row
+
+# Side length of the scrambled blocks: the lateral FWHM of the point spread function (0.51 * wavelength / NA) in pixels
+def psf_block_size(wavelength_nm, numerical_aperture, pixel_size_um):
+    return max(1, int(np.ceil(0.51 * wavelength_nm / 1000 / numerical_aperture / pixel_size_um)))
+
+# Pixels of a channel as one row per block (block_size x block_size), rows and columns that don't fill a block are left out
+def block_matrix(channel, block_size):
+    rows, cols = channel.shape[0] // block_size, channel.shape[1] // block_size
+    blocks = channel[:rows * block_size, :cols * block_size].reshape(rows, block_size, cols, block_size).swapaxes(1, 2)
+    return blocks.reshape(rows * cols, block_size * block_size).astype(np.float64)
+
+# Costes randomization test: is the Pearson's r of two channels higher than for randomly placed blocks of ch2?
+# The blocks of ch2 are scrambled `n_shuffles` times, in batches of shuffles of about `batch_bytes` each,
+# until `time_limit` (seconds) is reached (the p-value is based on the shuffles done until then).
+# roi: boolean mask of the pixels to test (e.g. the ROI mask), blocks with pixels outside of it are left out.
+#      Otherwise the zeros outside the ROI would be scrambled too and look like a correlation of both channels.
+# return: list in the order of `randomization_names`: p-value, mean r of the scrambled images, number of shuffles
+def randomization_test(ch1, ch2, block_size, n_shuffles=200, time_limit=None, seed=0, roi=None, batch_bytes=256 << 20):
+    start = time.perf_counter()
+    a, b = block_matrix(ch1, block_size), block_matrix(ch2, block_size)
+    if roi is not None:
+        inside = block_matrix(roi, block_size).all(axis=1)
+        a, b = a[inside], b[inside]
+    n = a.size
+    sum1, sum2, sum11, sum22 = a.sum(), b.sum(), (a * a).sum(), (b * b).sum()
+    observed = pearson_from_sums(n, sum1, sum2, sum11, sum22, (a * b).sum())
+    # Scrambling ch2 against ch1 is the same as scrambling ch1 against ch2, so the channel with fewer blocks with signal
+    # is kept in place: only its blocks with signal add to the sum of the products.
+    if np.count_nonzero(b.any(axis=1)) < np.count_nonzero(a.any(axis=1)):
+        a, b = b, a
+    a = a[a.any(axis=1)].astype(np.float32)
+    if not np.isfinite(observed) or len(a) == 0:
+        return [float("nan"), float("nan"), 0]
+    # sum(a * (b - mean of b)) = sum(a * b) - mean of b * sum(a): the centered products are smaller, so they add up precisely enough
+    # in float32 (half the memory to gather)
+    mean2 = b.mean()
+    offset = mean2 * a.sum(dtype=np.float64)
+    b = (b - mean2).astype(np.float32)
+
+    rng = np.random.default_rng(seed)
+    # every block as a single (void) value, so gathering the blocks is a 1D copy of whole blocks
+    b = b.view(np.dtype((np.void, b.shape[1] * b.itemsize))).ravel()
+    # the gathered blocks and the random keys of a batch (16 bytes per block of ch2: float64 key and index) fit into batch_bytes
+    batch = max(1, batch_bytes // max(a.nbytes, 16 * len(b)))
+    shuffled = []
+    while len(shuffled) < n_shuffles and (time_limit is None or time.perf_counter() - start < time_limit):
+        n_batch = min(batch, n_shuffles - len(shuffled))
+        # the blocks that land on the kept blocks with signal: a random sample without replacement per shuffle, for the
+        # whole batch at once. Every block of ch2 gets a random key, the blocks with the len(a) smallest keys are picked
+        # in the order of their keys (a random permutation cut to len(a), without sorting all keys).
+        keys = rng.random((n_batch, len(b)))
+        picks = np.argpartition(keys, len(a) - 1, axis=1)[:, :len(a)]
+        picks = np.take_along_axis(picks, np.argsort(np.take_along_axis(keys, picks, axis=1), axis=1), axis=1)
+        # sum of the products of every shuffle of the batch: one matrix-vector product
+        sum12 = b[picks].view(np.float32).reshape(n_batch, a.size) @ a.ravel() + offset
+        shuffled.extend(pearson_from_sums(n, sum1, sum2, sum11, sum22, sum12))
+    shuffled = np.array(shuffled)
+    p_value = (1 + np.sum(shuffled >= observed)) / (1 + len(shuffled))
+    return [float(p_value), float(shuffled.mean()) if len(shuffled) else float("nan"), len(shuffled)]
+
+# Column names of the randomization test of the channel pairs
+def randomization_columns(pair_names):
+    return [f"{name} ({name1} & {name2})" for name1, name2 in pair_names for name in randomization_names]
@@ -1,6 +1,7 @@
 """
 -> Because all images were available in 8bit format (which got checked with this script too), 
     we simply combine the three individual gray-scale images to RGB8 images.
+-> Alternatively, any number of channels can be combined into one OME-TIFF with the original bit depth.
 (c) 2023, Maximilian Otto, Berlin.
 """
 
@@ -32,6 +33,17 @@ input_file_format = ".tiff"
 # Combine the images into one RGB-image?
 merge_to_rgb: bool = True
 output_file_format: str = ".bmp"
+# Other option:
+#  - ".ome.tiff": tiled, compressed multi-channel OME-TIFF with the original bit depth instead of an RGB8 image.
+#     It gets written tile by tile, so only a few rows of one channel are in memory at a time.
+#     The channels are taken from `ome_channel_suffixes`, e.g. ["0", "1", "2", "3"] for the four round2 channels.
+
+# Channel name suffices and the plane of each file that holds the channel (OpenCV/BGR order, as for the `.bmp`),
+# only used for the OME-TIFF. Files with a single plane are used as they are.
+ome_channel_suffixes = [ch_1_suf, ch_2_suf, ch_3_suf]
+ome_channel_planes = [0, 1, 2]
+ome_tile_size = 512
+ome_compression = "zlib"
 
 # Min. bit-depth we want to check for:
 # Has the microscope used a >=12bit-color camera and an according sensitivity? 
@@ -39,12 +51,26 @@ output_file_format: str = ".bmp"
 # Otherwise the images were probably saved as 8bit images. 
 # For 16, 24 and 32 bit images, the min_bit_depth should be 12, 16 and 24 respectively.  
 min_bit_depth = 8
+
+# Keep a catalog of all images of `wd` (`.image_catalog.sqlite`, see `image_catalog.py`)?
+# The folders are then listed from the catalog instead of the (network) drive, only changed folders get listed again.
+use_image_catalog = True
+
+# Number of files whose headers are read at the same time (mostly waiting for the disk / network share)
+audit_threads = 16
+# Every n-th pixel of every n-th row is checked, if a file has no "SMaxSampleValue" tag
+audit_sample_stride = 4
 # ----------------------------------------------------------------------------------------------- #
 
-import exifread
-import glob, os
+import os, struct
+import numpy as np
 import cv2
+import tifffile
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+import build_manifest
+import dataset_index
+import image_catalog
 
 # Input: amount of bits, e.g. the amount of bits used to store a greyscale image.
 # Return: Max. value of a certain amount of bits.
@@ -52,71 +78,225 @@ from tqdm import tqdm
 def max_bits(min_bit_depth):
     return (1 << min_bit_depth) - 1
 
+# TIFF tags needed for the bit-depth audit
+tiff_tags = {
+    256: "width",
+    257: "height",
+    258: "bits_per_sample",
+    277: "samples_per_pixel",
+    339: "sample_format",
+    340: "smax_sample_value",
+}
+# struct formats of the TIFF field types
+tiff_field_types = {1: "B", 2: "s", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i", 11: "f", 12: "d", 16: "Q", 17: "q", 18: "Q"}
+
+# Read the tags of the first image file directory (IFD) of a (Big)TIFF file, without decoding any pixels.
+# input: file name string
+# return: dict with the values of `tiff_tags` (tuples), missing tags are left out
+def read_tiff_tags(file):
+    tags = {}
+    with open(file, "rb") as f:
+        header = f.read(16)
+        byte_order = {b"II": "<", b"MM": ">"}.get(header[:2])
+        if byte_order is None:
+            raise ValueError(f"{file} is not a TIFF file")
+        version = struct.unpack(byte_order + "H", header[2:4])[0]
+        if version == 42:
+            count_format, offset_format = "H", "I"
+            ifd_offset = struct.unpack(byte_order + "I", header[4:8])[0]
+        elif version == 43:
+            count_format, offset_format = "Q", "Q"
+            ifd_offset = struct.unpack(byte_order + "Q", header[8:16])[0]
+        else:
+            raise ValueError(f"{file} is not a TIFF file")
+        offset_size = struct.calcsize(offset_format)
+        entry_size = 4 + 2 * offset_size
+
+        f.seek(ifd_offset)
+        entry_count = struct.unpack(byte_order + count_format, f.read(struct.calcsize(count_format)))[0]
+        entries = f.read(entry_count * entry_size)
+        for i in range(entry_count):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            tag, field_type, value_count = struct.unpack(byte_order + "HH" + offset_format, entry[:4 + offset_size])
+            if tag not in tiff_tags or field_type not in tiff_field_types:
+                continue
+            value_format = f"{byte_order}{value_count}{tiff_field_types[field_type]}"
+            value_size = struct.calcsize(value_format)
+            value = entry[4 + offset_size:]
+            # larger values are stored somewhere else in the file
+            if value_size > offset_size:
+                f.seek(struct.unpack(byte_order + offset_format, value)[0])
+                value = f.read(value_size)
+            tags[tiff_tags[tag]] = struct.unpack(value_format, value[:value_size])
+    return tags
+
+# Bit-depth audit of a single image file.
+# The max. value is taken from the "SMaxSampleValue" tag, if it exists.
+# Otherwise the image is decoded and every `audit_sample_stride`-th pixel is checked (might miss single bright pixels).
+# return: dict with file name, dtype, bit depth, max. value (and where it came from), image size and file size
+def audit_image(file):
+    tags = read_tiff_tags(file)
+    bit_depth = tags.get("bits_per_sample", (1,))[0]
+    sample_format = {1: "uint", 2: "int", 3: "float"}.get(tags.get("sample_format", (1,))[0], "uint")
+    report = {
+        "file": os.path.basename(file),
+        "dtype": f"{sample_format}{bit_depth}",
+        "bit_depth": bit_depth,
+        "max_value": None,
+        "max_value_source": "tag",
+        "width": tags.get("width", (None,))[0],
+        "height": tags.get("height", (None,))[0],
+        "channels": tags.get("samples_per_pixel", (1,))[0],
+        "file_size": os.path.getsize(file),
+    }
+    if "smax_sample_value" in tags:
+        report["max_value"] = max(tags["smax_sample_value"])
+    else:
+        img = cv2.imread(file, -1)
+        if img is not None:
+            report["max_value"] = np.max(img[::audit_sample_stride, ::audit_sample_stride]).item()
+            report["max_value_source"] = "sample"
+    return report
+
+# Audit all files at once, `n_threads` files at a time
+# return: list of the reports of `audit_image()`, in the order of `files`
+def audit_images(files, n_threads=audit_threads):
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(tqdm(executor.map(audit_image, files), total=len(files), desc = "Checking for bit depth (higher than 8 bit)"))
+
 # Imaging data in 24bit-tif should have one pixel value higher than 16bit-color values.
 # input: current file name string, max. value of the min. bit-depth (e.g. 255 for 8bit)
 # return: True if the image contains a bright pixel 
 def is_it_really_16_bit(file, max_value_of_min_bit_depth):
-    pic_brighter_than_min_bit_depth = False
-    with open(file, 'rb') as f: 
-        tags = exifread.process_file(f) # type: ignore
-    # Check if the "Image SMaxSampleValue" tag exists:
-    if "Image SMaxSampleValue" in tags:
-        max_sample_value = tags["Image SMaxSampleValue"].values
-        # Check max. brightness of the image (Larger than max(8bit)):
-        if int(max_sample_value) > max_value_of_min_bit_depth:
-            pic_brighter_than_min_bit_depth = True
-    return pic_brighter_than_min_bit_depth
+    max_value = audit_image(file)["max_value"]
+    return max_value is not None and max_value > max_value_of_min_bit_depth
 
 # Check each image of a folder for its brightness. Print out the number of images that are darker than 12bit.
+# return: number of images brighter than the min. bit depth and the reports of `audit_image()`
 def check_bit_depth(pic_folder_path):
-    pics_brighter_than_16_bit = 0
-    pics_total = 0
-    pics_too_dark = []
     max_value_of_min_bit_depth = max_bits(min_bit_depth)
-    os.chdir(pic_folder_path)
     print("Searching for pictures with a brightness indicating that they are truly 16 bits and not too dark:")
-    print(os.getcwd())
-    for file in tqdm(glob.glob("*"+input_file_format), desc = "Checking for bit depth (higher than 8 bit)"):
-        pics_total += 1
-        if is_it_really_16_bit(file, max_value_of_min_bit_depth) == True:
-            pics_brighter_than_16_bit += 1
-        else: 
-            pics_too_dark.append(os.path.basename(file))
+    print(pic_folder_path)
+    files = [os.path.join(pic_folder_path, name) for name in sorted(dataset_index.list_file_names(pic_folder_path)) if name.endswith(input_file_format)]
+    reports = audit_images(files)
+    pics_total = len(reports)
+    pics_too_dark = [report["file"] for report in reports if report["max_value"] is None or report["max_value"] <= max_value_of_min_bit_depth]
+    pics_brighter_than_16_bit = pics_total - len(pics_too_dark)
+    pics_sampled = sum(report["max_value_source"] == "sample" for report in reports)
     print("{0} {1} {2} {3}".format(pics_brighter_than_16_bit, "of", pics_total, "are definitely saved with a higher bit depth than 8 bit."))
+    if pics_sampled > 0:
+        print(f"{pics_sampled} files have no \"SMaxSampleValue\" tag, their max. value was estimated from every {audit_sample_stride}. pixel.")
     if len(pics_too_dark) > 0:
         print("The following files are too dark or they could have been saved in another data format:")
-        if len(pics_too_dark) == len([name for name in os.listdir() if os.path.isfile(name)]):
+        if len(pics_too_dark) == pics_total:
             print("All images are too dark")
         else: 
             for pic in pics_too_dark:
                 print(pic)
-    return pics_brighter_than_16_bit
+    return pics_brighter_than_16_bit, reports
 # test the first folder. The others are ususally stored in the same format.
 #check_bit_depth(pic_folder_path)                
 # none ok so far. --> they are stored and interpreted as rgb8 images 
 # even though they are just greyscale and the microscope is probably capable of capturing higher ranges. 
 
+# Rows of a single plane of a TIFF image, `band_rows` rows at a time.
+# Only one strip is decoded at a time and only the requested plane is kept. Tiled TIFFs are decoded at once.
+# plane: index in OpenCV/BGR(A) order
+def iterate_tiff_row_bands(file, band_rows, plane=0):
+    def plane_of(img):
+        if img.ndim == 2 or img.shape[-1] == 1:
+            return img.reshape(img.shape[:2])
+        # tifffile keeps the RGB(A) order of the file
+        return img[..., 2 - plane if img.shape[-1] >= 3 and plane < 3 else plane]
+
+    with tifffile.TiffFile(file) as tif:
+        page = tif.pages.first
+        height = page.imagelength
+        if page.is_tiled or page.planarconfig != 1:
+            img = plane_of(page.asarray())
+            for row in range(0, height, band_rows):
+                yield img[row:row + band_rows]
+            return
+
+        rows = []
+        row_count = 0
+        for segment, indices, _ in page.segments():
+            # indices[-3] is the first row of the strip, the last strip may be padded
+            segment = np.ascontiguousarray(plane_of(segment[0][:height - indices[-3]]))
+            rows.append(segment)
+            row_count += len(segment)
+            while row_count >= band_rows:
+                band = np.concatenate(rows) if len(rows) > 1 else rows[0]
+                yield band[:band_rows]
+                rows = [band[band_rows:]]
+                row_count -= band_rows
+        if row_count > 0:
+            yield np.concatenate(rows)
+
+# Merge any number of channels into one OME-TIFF, tile by tile and with the original bit depth
+# input: file names of the channels, output file name, plane of each file that holds the channel
+def merge_to_ome_tiff(channel_files, output_file, planes, tile_size=ome_tile_size, compression=ome_compression):
+    with tifffile.TiffFile(channel_files[0]) as tif:
+        page = tif.pages.first
+        shape = (len(channel_files), page.imagelength, page.imagewidth)
+        dtype = page.dtype
+
+    # the tiles of each channel, row by row
+    def tiles():
+        for file, plane in zip(channel_files, planes):
+            for band in iterate_tiff_row_bands(file, tile_size, plane):
+                for col in range(0, shape[2], tile_size):
+                    yield band[:, col:col + tile_size]
+
+    channel_names = [os.path.basename(file) for file in channel_files]
+    with tifffile.TiffWriter(output_file, bigtiff=True, ome=True) as writer:
+        writer.write(tiles(), shape=shape, dtype=dtype, tile=(tile_size, tile_size), compression=compression,
+                     metadata={"axes": "CYX", "Channel": {"Name": channel_names}})
+
 # Merge the three channels of the same image into one image.
+# Image sets whose channels and settings didn't change since the last merge (see `build_manifest.py`) are skipped.
 # input: "picture folder path" string
 def image_merger_to_rgb(pic_folder_path): 
     pics_total = 0
-    base_channel = ch_prefix + ch_1_suf
-    for file in tqdm(glob.glob(pic_folder_path+"/*"+base_channel+"*"+input_file_format), desc = "Merging three channels into one rgb8 file"):
-        if os.path.isfile(file.replace(base_channel, "combined")):
-            continue
-        ch1 = cv2.imread(file, -1)
-        ch2 = cv2.imread(file.replace(base_channel, ch_prefix + ch_2_suf), -1)
-        ch3 = cv2.imread(file.replace(base_channel, ch_prefix + ch_3_suf), -1)
-
-        # Combine the channels into one image
-        combined_img = cv2.merge((ch1[:,:,0], ch2[:,:,1], ch3[:,:,2]))
-        file_replaced = file.replace(base_channel, "combined_")
-        cv2.imwrite(file_replaced.replace(input_file_format, output_file_format), combined_img)
-        pics_total += 1
-    print("Created {0} rgb-images".format(pics_total), end = "\r")
+    manifest = build_manifest.BuildManifest(pic_folder_path, "data_preparation")
+    parameters = {"channels": [ch_prefix, ch_1_suf, ch_2_suf, ch_3_suf], "input_file_format": input_file_format, "output_file_format": output_file_format}
+    ome_tiff = output_file_format == ".ome.tiff"
+    if ome_tiff:
+        parameters.update({"channels": [ch_prefix] + ome_channel_suffixes, "planes": ome_channel_planes, "tile_size": ome_tile_size, "compression": ome_compression})
+    channel_suffixes = ome_channel_suffixes if ome_tiff else [ch_1_suf, ch_2_suf, ch_3_suf]
+    try:
+        for channel_set in tqdm(dataset_index.channel_sets(pic_folder_path, ch_prefix, channel_suffixes, input_file_format), desc = "Merging the channels into one file"):
+            channel_files = channel_set["channels"]
+            file = channel_files[0]
+            combined_file = dataset_index.replace_channel_name(file, ch_prefix, channel_suffixes, "combined_")
+            combined_file = combined_file[:-len(input_file_format)] + output_file_format
+            if manifest.is_up_to_date(file, channel_files, parameters, [combined_file]):
+                continue
+            if ome_tiff:
+                merge_to_ome_tiff(channel_files, combined_file, ome_channel_planes)
+                manifest.record(file, channel_files, parameters, [combined_file])
+                pics_total += 1
+                continue
+
+            ch1 = cv2.imread(channel_files[0], -1)
+            ch2 = cv2.imread(channel_files[1], -1)
+            ch3 = cv2.imread(channel_files[2], -1)
+
+            # Combine the channels into one image
+            combined_img = cv2.merge((ch1[:,:,0], ch2[:,:,1], ch3[:,:,2]))
+            cv2.imwrite(combined_file, combined_img)
+            manifest.record(file, channel_files, parameters, [combined_file])
+            pics_total += 1
+    finally:
+        manifest.save()
+    print("Created {0} merged images".format(pics_total), end = "\r")
 
 
 if __name__ == "__main__":
+    if use_image_catalog:
+        catalog = image_catalog.ImageCatalog(wd, ch_prefix, [ch_1_suf, ch_2_suf, ch_3_suf] + ome_channel_suffixes[3:])
+        catalog.refresh()
+        dataset_index.catalog = catalog
     for sub_folder in folders_list:
         pic_folder_path = os.path.join(wd, sub_folder)
         os.chdir(pic_folder_path)
@@ -0,0 +1,159 @@
+"""
+Index of the image sets of a folder.
+The files of a folder are listed once and grouped by their image id (the file name without the channel name),
+instead of globbing for the first channel and guessing the other channels with `str.replace()`.
+Every image set knows its channel files, whether all channels exist, its ROI mask and its previous outputs.
+The channel name is the last occurrence of <channel prefix + channel suffix> in the file name,
+so other parts of the name that look like a channel name are left alone.
+The index gets cached in a `.dataset_index.json` file of the folder and is rebuilt when the folder changes.
+(c) 2024, Maximilian Otto, Berlin.
+"""
+
+import os, re, json, hashlib, threading
+
+index_file_name = ".dataset_index.json"
+
+# Indexes of this process, so the cache file is only read once per folder
+loaded_indexes = {}
+# The images are read in several threads (see `image_io.prefetched()`)
+index_lock = threading.Lock()
+
+# Catalog of `image_catalog.py` to list the folders with, instead of listing them on the (network) drive
+catalog = None
+
+# Names of the files of a folder, from the catalog if it's up to date for the folder
+def list_file_names(folder_path):
+    if not folder_path or not os.path.isdir(folder_path):
+        return []
+    if catalog is not None:
+        file_names = catalog.file_names(folder_path)
+        if file_names is not None:
+            return file_names
+    return [entry.name for entry in os.scandir(folder_path) if entry.is_file()]
+
+def channel_name_pattern(ch_prefix, ch_suffixes):
+    suffixes = "|".join(re.escape(suffix) for suffix in sorted(ch_suffixes, key=len, reverse=True))
+    # the greedy head makes the last occurrence of the channel name count
+    return re.compile(f"^(?P<head>.*){re.escape(ch_prefix)}(?P<suffix>{suffixes})(?P<tail>.*)$")
+
+# Modification times of the folders, the index is outdated as soon as a file gets added, removed or renamed
+def folder_modification_times(folder_paths):
+    return {folder_path: os.stat(folder_path).st_mtime_ns if os.path.isdir(folder_path) else None for folder_path in folder_paths if folder_path}
+
+# List the folder once and group its files into image sets.
+# input: folder path, channel prefix (e.g. "c0"), channel suffixes in the order of the channels (e.g. ["0", "1", "2", "3"]),
+#        file format (e.g. ".tiff"), folder of the ROI masks, suffix of the mask files and the channel the mask names are based on,
+#        {name: folder} of previous outputs with the same file names as the channels (e.g. the thresholded images),
+#        file format of the images the masks were named after, if it isn't `file_format` (e.g. ".tiff" for sparse ".npz" channels)
+# return: {image id: {"image_id", "channels": [file or None per channel], "complete", "missing": [suffixes],
+#          "roi_mask": file or None, "outputs": {name: [file or None per channel]}}}
+def build_index(folder_path, ch_prefix, ch_suffixes, file_format=".tiff", mask_folder_path=None, mask_suffix="_segmentation.tiff", mask_channel=1, output_folder_paths=None, mask_file_format=None):
+    pattern = channel_name_pattern(ch_prefix, ch_suffixes)
+    output_folder_paths = output_folder_paths or {}
+    channel_sets = {}
+    for file_name in list_file_names(folder_path):
+        if not file_name.endswith(file_format):
+            continue
+        match = pattern.match(file_name)
+        if match is None:
+            continue
+        image_id = match["head"] + match["tail"]
+        if image_id not in channel_sets:
+            channel_sets[image_id] = {"image_id": image_id, "channels": [None] * len(ch_suffixes)}
+        channel_sets[image_id]["channels"][ch_suffixes.index(match["suffix"])] = os.path.join(folder_path, file_name)
+
+    mask_names = set(list_file_names(mask_folder_path))
+    output_names = {name: set(list_file_names(path)) for name, path in output_folder_paths.items()}
+    for channel_set in channel_sets.values():
+        channels = channel_set["channels"]
+        channel_set["missing"] = [suffix for suffix, channel in zip(ch_suffixes, channels) if channel is None]
+        channel_set["complete"] = len(channel_set["missing"]) == 0
+        channel_set["roi_mask"] = None
+        if channels[mask_channel] is not None:
+            mask_name = os.path.basename(channels[mask_channel])
+            if mask_file_format is not None:
+                mask_name = mask_name[:len(mask_name) - len(file_format)] + mask_file_format
+            mask_name += mask_suffix
+            if mask_name in mask_names:
+                channel_set["roi_mask"] = os.path.join(mask_folder_path, mask_name)
+        channel_set["outputs"] = {
+            name: [os.path.join(output_folder_paths[name], os.path.basename(channel)) if channel is not None and os.path.basename(channel) in names else None for channel in channels]
+            for name, names in output_names.items()
+        }
+    return channel_sets
+
+# Index of a folder, from memory or the cache file if the folder didn't change, otherwise it's rebuilt and cached
+# (same input and return as `build_index()`)
+def load_index(folder_path, ch_prefix, ch_suffixes, file_format=".tiff", mask_folder_path=None, mask_suffix="_segmentation.tiff", mask_channel=1, output_folder_paths=None, mask_file_format=None):
+    with index_lock:
+        return load_index_unlocked(folder_path, ch_prefix, ch_suffixes, file_format, mask_folder_path, mask_suffix, mask_channel, output_folder_paths, mask_file_format)
+
+def load_index_unlocked(folder_path, ch_prefix, ch_suffixes, file_format=".tiff", mask_folder_path=None, mask_suffix="_segmentation.tiff", mask_channel=1, output_folder_paths=None, mask_file_format=None):
+    folder_path = os.path.abspath(folder_path)
+    mask_folder_path = os.path.abspath(mask_folder_path) if mask_folder_path else None
+    output_folder_paths = {name: os.path.abspath(path) for name, path in (output_folder_paths or {}).items()}
+    parameters = json.dumps([ch_prefix, list(ch_suffixes), file_format, mask_folder_path, mask_suffix, mask_channel, output_folder_paths] + ([mask_file_format] if mask_file_format else []), sort_keys=True)
+    key = hashlib.sha1(parameters.encode()).hexdigest()
+    modification_times = folder_modification_times([folder_path, mask_folder_path] + sorted(output_folder_paths.values()))
+
+    cached = loaded_indexes.get((folder_path, key))
+    if cached is not None and cached["modification_times"] == modification_times:
+        return cached["channel_sets"]
+
+    cache_file_name = os.path.join(folder_path, index_file_name)
+    cache = {}
+    if os.path.isfile(cache_file_name):
+        try:
+            with open(cache_file_name) as f:
+                cache = json.load(f)
+        except ValueError:
+            cache = {}
+    cached = cache.get(key)
+    if cached is None or cached["modification_times"] != modification_times:
+        cached = {"modification_times": modification_times, "channel_sets": build_index(folder_path, ch_prefix, list(ch_suffixes), file_format, mask_folder_path, mask_suffix, mask_channel, output_folder_paths, mask_file_format)}
+        cache[key] = cached
+        try:
+            # Creating the cache file changes the modification time of the folder, rewriting it doesn't.
+            # So the times are taken again after the file exists.
+            for _ in range(2):
+                with open(cache_file_name, "w") as f:
+                    json.dump(cache, f)
+                cached["modification_times"] = folder_modification_times(modification_times)
+        except OSError:
+            # e.g. a read-only folder, the index is only kept in memory
+            pass
+    loaded_indexes[(folder_path, key)] = cached
+    return cached["channel_sets"]
+
+# Image sets of a folder with all channels (and a ROI mask, if `require_roi_mask`), sorted by the file name of the first channel.
+# Incomplete image sets are reported and left out, instead of failing when their images are read.
+# (input as `load_index()`)
+def channel_sets(folder_path, ch_prefix, ch_suffixes, file_format=".tiff", mask_folder_path=None, mask_suffix="_segmentation.tiff", mask_channel=1, output_folder_paths=None, require_roi_mask=False, mask_file_format=None):
+    sets = load_index(folder_path, ch_prefix, ch_suffixes, file_format, mask_folder_path, mask_suffix, mask_channel, output_folder_paths, mask_file_format).values()
+    incomplete = [channel_set for channel_set in sets if not channel_set["complete"]]
+    for channel_set in incomplete:
+        print(f"Skipping {channel_set['image_id']} in {folder_path}: channel(s) {', '.join(ch_prefix + suffix for suffix in channel_set['missing'])} missing")
+    sets = [channel_set for channel_set in sets if channel_set["complete"]]
+    if require_roi_mask:
+        for channel_set in sets:
+            if channel_set["roi_mask"] is None:
+                print(f"Skipping {channel_set['image_id']} in {folder_path}: no ROI mask")
+        sets = [channel_set for channel_set in sets if channel_set["roi_mask"] is not None]
+    return sorted(sets, key=lambda channel_set: channel_set["channels"][0])
+
+# Image set of a file, e.g. to find the other channels of the first channel
+# return: the image set of `load_index()`, or None if the file name doesn't contain a channel name
+def channel_set_of(file_name, ch_prefix, ch_suffixes, file_format=".tiff", mask_folder_path=None, mask_suffix="_segmentation.tiff", mask_channel=1):
+    match = channel_name_pattern(ch_prefix, ch_suffixes).match(os.path.basename(file_name))
+    if match is None:
+        return None
+    index = load_index(os.path.dirname(os.path.abspath(file_name)), ch_prefix, ch_suffixes, file_format, mask_folder_path, mask_suffix, mask_channel)
+    return index.get(match["head"] + match["tail"])
+
+# Replace the channel name of a file name, e.g. with "combined_"
+def replace_channel_name(file_name, ch_prefix, ch_suffixes, replacement):
+    folder_path, name = os.path.split(file_name)
+    match = channel_name_pattern(ch_prefix, ch_suffixes).match(name)
+    if match is None:
+        raise ValueError(f"{file_name} doesn't contain a channel name")
+    return os.path.join(folder_path, match["head"] + replacement + match["tail"])
@@ -0,0 +1,56 @@
+"""
+Distance tolerant colocalization: which part of the signal of a channel lies within d pixels of the signal of another channel?
+Instead of dilating the other channel once per distance (or blurring both channels, which also changes the intensities),
+every channel gets a single Euclidean distance transform (`cv2.distanceTransform`): the distance of every pixel to the
+closest pixel with signal. The distances at the signal pixels of the first channel are counted in a histogram of
+whole pixels, so the coverages of all distances come from one cumulative sum.
+d = 0 is the plain overlap, the same as the coverages of `colocalization_counts()`.
+(c) 2024, Maximilian Otto, Berlin.
+"""
+
+import numpy as np
+import cv2
+
+# Distance of every pixel to the closest pixel with signal (intensity > 0), 0 for the signal itself
+# return: float32 array, or None if the channel has no signal
+def distance_to_signal(channel):
+    if not channel.any():
+        return None
+    return cv2.distanceTransform((channel == 0).view(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+
+# Number of signal pixels of a channel by their distance to the signal of the other channel, rounded up to whole pixels
+# input: channel, distance transform of the other channel, largest distance of interest (larger distances share the last bin)
+# return: counts[d] = number of pixels with d - 1 < distance <= d
+def distance_histogram(channel, distances, max_distance):
+    signal_distances = distances[channel > 0]
+    return np.bincount(np.minimum(np.ceil(signal_distances), max_distance + 1).astype(np.intp), minlength=max_distance + 2)
+
+# Percentage of the signal pixels within each distance (distance <= d)
+def coverage_within(histogram, radii):
+    total = histogram.sum()
+    if total == 0:
+        return [float("nan")] * len(radii)
+    within = np.cumsum(histogram)
+    return [float(within[radius] / total * 100) for radius in radii]
+
+# Column names, e.g. "CHCHD2 within 2 px of TOM-20 (Coverage in %)"
+# input: list of (name of the covered channel, name of the other channel), distances in pixels
+def distance_columns(pair_names, radii):
+    return [f"{name1} within {radius} px of {name2} (Coverage in %)" for name1, name2 in pair_names for radius in radii]
+
+# Coverages of all pairs and distances, every channel gets a single distance transform
+# input: channels, pairs of channel indices (covered channel, other channel), distances in pixels, names of the channels
+# return: {column: coverage in %}
+def distance_row(channels, pairs, radii, channel_names):
+    max_distance = max(radii)
+    distances = {j: distance_to_signal(channels[j]) for j in sorted({j for _, j in pairs})}
+    row = {}
+    for i, j in pairs:
+        columns = distance_columns([(channel_names[i], channel_names[j])], radii)
+        if distances[j] is None:
+            # no signal to be close to
+            coverages = [0.0 if channels[i].any() else float("nan")] * len(radii)
+        else:
+            coverages = coverage_within(distance_histogram(channels[i], distances[j], max_distance), radii)
+        row.update(zip(columns, coverages))
+    return row
@@ -0,0 +1,146 @@
+"""
+SQLite catalog of all images below a working directory, e.g. on a slow network share.
+For every image, the catalog records path, channel, cell line, condition, dimensions, dtype, file size,
+modification time and content hash. Listing a folder then only needs a database query instead of a glob on the share.
+The catalog is refreshed incrementally: only folders whose modification time changed get listed again and
+only new or changed files (size or modification time) get their header read and their content hashed.
+NOTE: changing a file in place doesn't change the modification time of its folder, use `refresh(check_files=True)`
+to stat every file of the catalog.
+The catalog can be used from several threads (e.g. the prefetching threads of `image_io.prefetched()`),
+they share one connection, which is guarded by a lock.
+(c) 2024, Maximilian Otto, Berlin.
+"""
+
+import os, sqlite3, threading, time
+import tifffile
+import build_manifest
+import dataset_index
+
+catalog_file_name = ".image_catalog.sqlite"
+image_file_formats = (".tif", ".tiff", ".bmp", ".png", ".npz")
+
+# Get the cell line from the file name
+# TODO FIXME NOTE:
+# change this for the different file name structures to use the scripts with different data sets
+# return file_name.split("_")[2] #organoids or NPCs new
+def cell_line_from_file_name(file_name):
+    return os.path.basename(file_name).split("_")[0]
+
+# Dimensions and dtype from the header of a TIFF file, without decoding any pixels
+# return: (width, height, samples per pixel, dtype), or Nones for other file formats
+def read_image_header(file_name):
+    if not file_name.lower().endswith((".tif", ".tiff")):
+        return None, None, None, None
+    try:
+        with tifffile.TiffFile(file_name) as tif:
+            page = tif.pages.first
+            return page.imagewidth, page.imagelength, page.samplesperpixel, str(page.dtype)
+    except (tifffile.TiffFileError, ValueError):
+        return None, None, None, None
+
+class ImageCatalog:
+    def __init__(self, root_path, ch_prefix="c0", ch_suffixes=("0", "1", "2", "3"), hash_files=True):
+        self.root_path = os.path.abspath(root_path)
+        self.ch_prefix = ch_prefix
+        self.ch_suffixes = list(ch_suffixes)
+        self.hash_files = hash_files
+        self.connection = sqlite3.connect(os.path.join(self.root_path, catalog_file_name), check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.RLock()
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS folders (
+                path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER)""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY, folder TEXT, name TEXT, image_id TEXT, channel TEXT,
+                cell_line TEXT, condition TEXT, width INTEGER, height INTEGER, samples INTEGER, dtype TEXT,
+                size INTEGER, mtime_ns INTEGER, sha1 TEXT)""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS images_folder ON images (folder)")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    # Condition of a folder: the first folder below the root (e.g. the treatment)
+    def condition_of(self, folder_path):
+        relative_path = os.path.relpath(folder_path, self.root_path)
+        return None if relative_path == "." else relative_path.split(os.sep)[0]
+
+    def image_row(self, folder_path, entry, stat):
+        match = dataset_index.channel_name_pattern(self.ch_prefix, self.ch_suffixes).match(entry.name)
+        width, height, samples, dtype = read_image_header(entry.path)
+        sha1 = build_manifest.file_hash(entry.path, {}) if self.hash_files else None
+        return (entry.path, folder_path, entry.name,
+                match["head"] + match["tail"] if match else None, match["suffix"] if match else None,
+                cell_line_from_file_name(entry.name), self.condition_of(folder_path),
+                width, height, samples, dtype, stat.st_size, stat.st_mtime_ns, sha1)
+
+    # List a single folder again and update its images
+    def refresh_folder(self, folder_path, entries):
+        known = {row["path"]: (row["size"], row["mtime_ns"]) for row in self.connection.execute("SELECT path, size, mtime_ns FROM images WHERE folder = ?", (folder_path,))}
+        present = set()
+        for entry in entries:
+            if not entry.is_file() or not entry.name.lower().endswith(image_file_formats):
+                continue
+            present.add(entry.path)
+            stat = entry.stat()
+            if known.get(entry.path) != (stat.st_size, stat.st_mtime_ns):
+                self.connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.image_row(folder_path, entry, stat))
+        removed = [(path,) for path in known if path not in present]
+        self.connection.executemany("DELETE FROM images WHERE path = ?", removed)
+
+    # Walk the tree, only folders with a new modification time get listed again
+    # check_files: also stat the files of unchanged folders, to notice files that were changed in place
+    # return: number of folders that were listed again
+    def refresh(self, check_files=False):
+        with self.lock:
+            return self.refresh_unlocked(check_files)
+
+    def refresh_unlocked(self, check_files=False):
+        start = time.time()
+        known_folders = {row["path"]: row["mtime_ns"] for row in self.connection.execute("SELECT path, mtime_ns FROM folders")}
+        children = {}
+        for row in self.connection.execute("SELECT path, parent FROM folders"):
+            children.setdefault(row["parent"], []).append(row["path"])
+
+        listed = 0
+        visited = set()
+        with self.connection:
+            folders = [self.root_path]
+            while folders:
+                folder_path = folders.pop()
+                visited.add(folder_path)
+                mtime_ns = os.stat(folder_path).st_mtime_ns
+                if known_folders.get(folder_path) == mtime_ns and not check_files:
+                    folders.extend(children.get(folder_path, []))
+                    continue
+                entries = list(os.scandir(folder_path))
+                self.refresh_folder(folder_path, entries)
+                subfolders = [entry.path for entry in entries if entry.is_dir() and not entry.name.startswith(".")]
+                self.connection.executemany("INSERT OR REPLACE INTO folders VALUES (?, ?, ?)", [(subfolder, folder_path, known_folders.get(subfolder)) for subfolder in subfolders])
+                self.connection.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?)", (folder_path, os.path.dirname(folder_path) if folder_path != self.root_path else None, mtime_ns))
+                folders.extend(subfolders)
+                listed += 1
+            # folders that don't exist anymore
+            removed = [(path,) for path in known_folders if path not in visited]
+            self.connection.executemany("DELETE FROM folders WHERE path = ?", removed)
+            self.connection.executemany("DELETE FROM images WHERE folder = ?", removed)
+        print(f"Image catalog of {self.root_path}: listed {listed} folder(s) again in {time.time() - start:.2f} s")
+        return listed
+
+    # Images of the catalog, filtered by the given columns, e.g. `query(folder=..., channel="0")`
+    # return: list of dicts, sorted by path
+    def query(self, **columns):
+        conditions = " AND ".join(f"{column} = ?" for column in columns) or "1"
+        with self.lock:
+            rows = self.connection.execute(f"SELECT * FROM images WHERE {conditions} ORDER BY path", tuple(columns.values()))
+            return [dict(row) for row in rows]
+
+    # Image file names of a folder (instead of `os.listdir()` or `glob.glob()` on the share)
+    # return: None if the folder isn't part of the catalog or changed since the last refresh
+    def file_names(self, folder_path):
+        folder_path = os.path.abspath(folder_path)
+        with self.lock:
+            row = self.connection.execute("SELECT mtime_ns FROM folders WHERE path = ?", (folder_path,)).fetchone()
+            if row is None or not os.path.isdir(folder_path) or row["mtime_ns"] != os.stat(folder_path).st_mtime_ns:
+                return None
+            return [row["name"] for row in self.connection.execute("SELECT name FROM images WHERE folder = ? ORDER BY name", (folder_path,))]
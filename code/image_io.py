@@ -0,0 +1,160 @@
+"""
+Reading single channels of the images.
+Uncompressed TIFFs are memory-mapped, so a channel is a read-only view of the file and only the pages that are
+actually used get loaded. Compressed TIFFs and other formats are decoded with OpenCV as before, but only the requested
+plane is kept, instead of keeping all planes of the decoded image alive through a slice.
+Thresholded channels can also be written compressed (tiled TIFF) or sparse (`.npz file` with the nonzero pixels only).
+NOTE: the memory-mapped channels are read-only, copy them (`np.array(channel)`) before changing them in place.
+Image sets can be loaded ahead in background threads (`prefetched()`) and written in background threads (`BackgroundWriter`),
+so reading and writing files overlaps with processing the images.
+(c) 2024, Maximilian Otto, Berlin.
+"""
+
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import tifffile
+
+# File format of the sparse channels: positions and values of the nonzero pixels only
+sparse_file_format = ".npz"
+
+# How a TIFF file is stored: "memmap" (uncompressed and contiguous), "tiled" (e.g. the compressed thresholded images),
+# or None for everything that's read with OpenCV
+def tiff_layout(file_name):
+    if not file_name.lower().endswith((".tif", ".tiff")):
+        return None
+    try:
+        with tifffile.TiffFile(file_name) as tif:
+            page = tif.pages.first
+            if page.is_memmappable:
+                return "memmap"
+            if page.is_tiled:
+                return "tiled"
+    except (tifffile.TiffFileError, ValueError):
+        pass
+    return None
+
+# Can the file be memory-mapped (uncompressed and contiguous TIFF)?
+def is_memmappable(file_name):
+    return tiff_layout(file_name) == "memmap"
+
+# Read a single channel of an image
+# plane: index in OpenCV/BGR(A) order, e.g. -1 for `cv2.imread(file, -1)[:,:,-1]`, ignored for greyscale images
+# return: 2D array, a read-only memory map for uncompressed TIFFs; None if the image can't be read (like `cv2.imread()`)
+def read_channel(file_name, plane=-1):
+    if file_name.endswith(sparse_file_format):
+        return read_sparse_channel(file_name)[0]
+    layout = tiff_layout(file_name)
+    if layout is not None:
+        # tiled TIFFs are decoded by tifffile, the tiles in parallel (OpenCV may lack the codec, e.g. zstd)
+        img = tifffile.memmap(file_name, mode="r") if layout == "memmap" else tifffile.imread(file_name)
+        if img.ndim == 2:
+            return img
+        plane = plane % img.shape[-1]
+        # tifffile keeps the RGB(A) order of the file
+        img = img[..., 2 - plane if img.shape[-1] >= 3 and plane < 3 else plane]
+        return img if layout == "memmap" else np.ascontiguousarray(img)
+
+    img = cv2.imread(file_name, -1)
+    if img is None or img.ndim == 2:
+        return img
+    return np.ascontiguousarray(img[..., plane])
+
+# Write a single channel
+#  - `.npz` files: sparse, see `write_sparse_channel()`
+#  - with compression (e.g. "zlib" or "zstd"): tiled TIFF, the tiles are compressed by `n_threads` threads
+#  - otherwise with OpenCV, like `cv2.imwrite()`
+def write_channel(file_name, channel, compression=None, tile_size=256, n_threads=None):
+    if file_name.endswith(sparse_file_format):
+        write_sparse_channel(file_name, channel)
+    elif compression:
+        tifffile.imwrite(file_name, channel, tile=(tile_size, tile_size), compression=compression, maxworkers=n_threads)
+    else:
+        cv2.imwrite(file_name, channel)
+
+# Store only the nonzero pixels of a greyscale channel (e.g. a thresholded one):
+# their flat positions (sorted) and their values, so the size of the file grows with the signal instead of the image
+def write_sparse_channel(file_name, channel):
+    indices = np.flatnonzero(channel)
+    indices = indices.astype(np.uint32 if channel.size <= np.iinfo(np.uint32).max else np.uint64)
+    with open(file_name, "wb") as f:
+        np.savez(f, shape=np.array(channel.shape), indices=indices, values=channel.reshape(-1)[indices])
+
+# Read a sparse channel, only the rows of `row_ranges` get filled in (by default the whole image)
+# input: "file name" string, list of (row_start, row_stop)
+# return: list of arrays with the rows of each range
+def read_sparse_channel(file_name, row_ranges=None):
+    with np.load(file_name) as sparse:
+        height, width = sparse["shape"]
+        indices, values = sparse["indices"], sparse["values"]
+    crops = []
+    for row_start, row_stop in (row_ranges or [(0, height)]):
+        # the positions are sorted, so the pixels of the rows are a slice of them
+        first, last = np.searchsorted(indices, [row_start * width, row_stop * width])
+        crop = np.zeros((row_stop - row_start, width), dtype=values.dtype)
+        crop.reshape(-1)[indices[first:last].astype(np.int64) - row_start * width] = values[first:last]
+        crops.append(crop)
+    return crops
+
+# Load a channel into memory, e.g. in a background thread, instead of reading the memory map page by page later on
+def in_memory(channel):
+    return np.array(channel) if isinstance(channel, np.memmap) else channel
+
+# Load the next items in the background, while the current one is processed.
+# At most `prefetch` items are loaded ahead (so memory stays bounded), the items are yielded in the given order.
+# prefetch = 0 loads every item right before it's yielded, like a plain loop.
+# yield: (item, load(item))
+def prefetched(items, load, prefetch=2, n_threads=2):
+    items = iter(items)
+    if prefetch <= 0:
+        for item in items:
+            yield item, load(item)
+        return
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = deque((item, executor.submit(load, item)) for item in itertools.islice(items, prefetch))
+        while pending:
+            item, future = pending.popleft()
+            for next_item in itertools.islice(items, 1):
+                pending.append((next_item, executor.submit(load, next_item)))
+            yield item, future.result()
+
+# Writes files in background threads, so the next image can be processed in the meantime.
+# `submit()` blocks while `max_pending` writes are still queued, so unwritten images don't pile up in memory.
+# Errors of the writes are raised by `submit()` and when the writer gets closed.
+class BackgroundWriter:
+    def __init__(self, n_threads=2, max_pending=4):
+        self.executor = ThreadPoolExecutor(max_workers=n_threads)
+        self.slots = threading.Semaphore(max_pending)
+        self.futures = []
+
+    def raise_errors(self, wait=False):
+        for future in self.futures:
+            if wait or future.done():
+                future.result()
+        self.futures = [future for future in self.futures if not future.done()]
+
+    # Call `write(*args)` in the background
+    # return: the future of the write
+    def submit(self, write, *args):
+        self.raise_errors()
+        self.slots.acquire()
+        future = self.executor.submit(write, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.raise_errors(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.executor.shutdown(wait=True)
+        # don't hide the error that stopped the loop
+        if exc_type is None:
+            self.raise_errors(wait=True)
@@ -0,0 +1,68 @@
+"""
+Import times of the modules of the pipeline, each one measured in a fresh Python process.
+The processes of the pools (thresholding, plot rendering) and short runs import these modules first,
+so they should stay within their budget and mustn't load the plotting or statistics packages,
+which are only imported when they are used.
+Run it after adding an import: `python import_budget.py` (exit code 1 if a module exceeds its budget).
+(c) 2024, Maximilian Otto, Berlin.
+"""
+# ----------------------------------------------------------------------------------------------- #
+# Budget in seconds per module, including the import of numpy, OpenCV, pandas etc.
+import_budgets = {
+    "build_manifest": 0.1,
+    "dataset_index": 0.1,
+    "image_io": 0.5,
+    "image_catalog": 0.5,
+    "pairwise_statistics": 1.0,
+    "box_plots": 1.0,
+    "colocalization_coefficients": 0.5,
+    "distance_colocalization": 0.5,
+    "thresholding": 1.0,
+    "quantification_5_cell_lines": 1.5,
+}
+
+# Packages that take seconds to import, only needed for the plots and statistics
+lazy_packages = ["matplotlib", "seaborn", "statannot", "scipy"]
+
+# Every module is imported this many times, the fastest import counts (the first one may fill the disk cache)
+repeats = 3
+# ----------------------------------------------------------------------------------------------- #
+
+import os, sys, json, subprocess
+
+code_folder_path = os.path.dirname(os.path.abspath(__file__))
+# the round2 scripts are imported instead of the ones of the first round
+module_paths = [os.path.join(code_folder_path, "round2"), code_folder_path]
+
+measure_import = """
+import sys, time, json
+sys.path[:0] = {paths}
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [package for package in {lazy_packages} if package in sys.modules]}}))
+"""
+
+# Import time of a module in a fresh process
+# return: seconds (fastest of `repeats` imports), lazy packages that got imported along with it
+def measure_import_time(module, repeats=repeats):
+    code = measure_import.format(paths=repr(module_paths), module=module, lazy_packages=repr(lazy_packages))
+    results = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return min(result["seconds"] for result in results), results[0]["loaded"]
+
+# Measure all modules and print them with their budget
+# return: True if all modules are within their budget and no lazy package was imported
+def check_import_budgets(import_budgets=import_budgets):
+    within_budget = True
+    for module, budget in import_budgets.items():
+        seconds, loaded = measure_import_time(module)
+        ok = seconds <= budget and len(loaded) == 0
+        within_budget &= ok
+        print(f"{'ok  ' if ok else 'SLOW'} {module:<30} {seconds:6.3f} s (budget {budget:.1f} s)" + (f", imports {', '.join(loaded)}" if loaded else ""))
+    return within_budget
+
+if __name__ == "__main__":
+    sys.exit(0 if check_import_budgets() else 1)
@@ -0,0 +1,211 @@
+"""
+Pairwise statistics of the quantification tables.
+Every pair of cell lines gets tested for every metric and every condition in one go, instead of testing inside
+the plotting code one plot at a time. The p-values get corrected for multiple testing within every metric and condition
+(the pairs of one plot) and are written as table together with the effect sizes. The plots only read this table.
+The t-tests are calculated for all pairs and metrics at once from the means and variances of the groups.
+scipy is only imported when the tests are run.
+Usage: `python pairwise_statistics.py <quantification table> [-t test] [-c correction]`
+(c) 2024, Maximilian Otto, Berlin.
+"""
+
+import os
+from argparse import ArgumentParser
+from itertools import combinations
+import numpy as np
+import pandas as pd
+
+tests = ("t-test_welch", "t-test_ind", "Mann-Whitney")
+corrections = ("bonferroni", "holm", "fdr_bh", None)
+
+# Same thresholds as the stars of `statannot`
+star_thresholds = ((1e-4, "****"), (1e-3, "***"), (1e-2, "**"), (5e-2, "*"))
+
+# Columns of the statistics table
+statistics_columns = [
+    "Condition", "Metric", "Group 1", "Group 2", "n 1", "n 2", "Mean 1", "Mean 2", "Mean difference",
+    "Effect size", "Effect size type", "Test", "Statistic", "p-value", "Correction", "Adjusted p-value", "Significance",
+]
+
+# Values of every group as one padded array, so all groups and metrics can be processed at once
+# return: array (groups, max. group size, metrics) with NaN for missing values
+def group_values(df, metrics, group_column, groups):
+    values_by_group = [df.loc[df[group_column] == group, metrics].to_numpy(dtype=np.float64) for group in groups]
+    max_size = max([len(values) for values in values_by_group] + [1])
+    padded = np.full((len(groups), max_size, len(metrics)), np.nan)
+    for i, values in enumerate(values_by_group):
+        padded[i, :len(values)] = values
+    return padded
+
+# t-tests of all pairs of groups for all metrics
+# input: group values of `group_values()`, pairs as index arrays
+# return: t, p, Cohen's d (pooled standard deviation); arrays (pairs, metrics)
+def t_tests(values, first, second, equal_var=False):
+    from scipy import stats
+    n = np.sum(~np.isnan(values), axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.nanmean(values, axis=1)
+        var = np.nanvar(values, axis=1, ddof=1)
+    n1, n2, mean1, mean2, var1, var2 = n[first], n[second], mean[first], mean[second], var[first], var[second]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pooled_var = ((n1 - 1) * var1 + (n2 - 1) * var2) / (n1 + n2 - 2)
+        if equal_var:
+            standard_error = np.sqrt(pooled_var * (1 / n1 + 1 / n2))
+            dof = n1 + n2 - 2
+        else:
+            # Welch-Satterthwaite degrees of freedom
+            se1, se2 = var1 / n1, var2 / n2
+            standard_error = np.sqrt(se1 + se2)
+            dof = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+        t = (mean1 - mean2) / standard_error
+        effect_size = (mean1 - mean2) / np.sqrt(pooled_var)
+    p = 2 * stats.t.sf(np.abs(t), dof)
+    invalid = (n1 < 2) | (n2 < 2)
+    return np.where(invalid, np.nan, t), np.where(invalid, np.nan, p), np.where(invalid, np.nan, effect_size)
+
+# Mann-Whitney U tests of all pairs of groups, every pair is tested for all metrics at once
+# return: U, p, rank-biserial correlation; arrays (pairs, metrics)
+def mann_whitney_tests(values, first, second):
+    from scipy import stats
+    n = np.sum(~np.isnan(values), axis=1)
+    u, p = np.full((len(first), values.shape[2]), np.nan), np.full((len(first), values.shape[2]), np.nan)
+    for k, (i, j) in enumerate(zip(first, second)):
+        if n[i].max() == 0 or n[j].max() == 0:
+            continue
+        # the padding of the groups is removed, the remaining NaNs (undefined values) are left out
+        result = stats.mannwhitneyu(values[i, :n[i].max()], values[j, :n[j].max()], alternative="two-sided", axis=0, nan_policy="omit")
+        u[k], p[k] = result.statistic, result.pvalue
+    with np.errstate(divide="ignore", invalid="ignore"):
+        effect_size = 2 * u / (n[first] * n[second]) - 1
+    return u, p, effect_size
+
+# Correct the p-values of every family (row) for multiple testing, NaNs are left out
+# input: array (families, tests), "bonferroni", "holm", "fdr_bh" or None
+def correct_p_values(p_values, method):
+    p_values = np.asarray(p_values, dtype=np.float64)
+    if method is None:
+        return p_values
+    if method not in corrections:
+        raise ValueError(f"Unknown correction: {method}")
+    m = np.sum(~np.isnan(p_values), axis=1, keepdims=True)
+    if method == "bonferroni":
+        return np.minimum(p_values * m, 1)
+
+    # NaNs are sorted to the end of every row
+    order = np.argsort(p_values, axis=1)
+    sorted_p = np.take_along_axis(p_values, order, axis=1)
+    rank = np.arange(1, p_values.shape[1] + 1)
+    if method == "holm":
+        adjusted = np.fmax.accumulate((m - rank + 1) * sorted_p, axis=1)
+    else:
+        adjusted = np.fmin.accumulate((m / rank * sorted_p)[:, ::-1], axis=1)[:, ::-1]
+    adjusted = np.where(np.isnan(sorted_p), np.nan, np.minimum(adjusted, 1))
+    corrected = np.empty_like(adjusted)
+    np.put_along_axis(corrected, order, adjusted, axis=1)
+    return corrected
+
+def significance_stars(p_values):
+    stars = np.full(p_values.shape, "ns", dtype=object)
+    for threshold, star in reversed(star_thresholds):
+        stars[p_values <= threshold] = star
+    stars[np.isnan(p_values)] = ""
+    return stars
+
+# Test every pair of groups (e.g. cell lines) for every metric, separately for every condition
+# input: quantification table, metrics (default: all numeric columns), column of the groups, groups (default: all, sorted),
+#        test ("t-test_welch", "t-test_ind" or "Mann-Whitney"), correction within every metric and condition
+# return: statistics table with one row per condition, metric and pair of groups
+def pairwise_tests(df, metrics=None, group_column="Cell line", groups=None, condition_column="Condition", test="t-test_welch", correction="bonferroni"):
+    if test not in tests:
+        raise ValueError(f"Unknown test: {test}")
+    if metrics is None:
+        metrics = [column for column in df.select_dtypes(include=[float, int]).columns]
+    metrics = list(metrics)
+    conditions = df[condition_column].unique() if condition_column in df else [None]
+
+    tables = []
+    for condition in conditions:
+        condition_df = df if condition is None else df[df[condition_column] == condition]
+        condition_groups = sorted(condition_df[group_column].unique()) if groups is None else [group for group in groups if group in set(condition_df[group_column])]
+        pairs = list(combinations(range(len(condition_groups)), 2))
+        if len(pairs) == 0 or len(metrics) == 0:
+            continue
+        first, second = np.array(pairs).T
+
+        values = group_values(condition_df, metrics, group_column, condition_groups)
+        if test == "Mann-Whitney":
+            statistic, p, effect_size = mann_whitney_tests(values, first, second)
+            effect_size_type = "rank-biserial correlation"
+        else:
+            statistic, p, effect_size = t_tests(values, first, second, equal_var=test == "t-test_ind")
+            effect_size_type = "Cohen's d"
+        # one family per metric: the pairs of a single plot
+        adjusted_p = correct_p_values(p.T, correction).T
+
+        n = np.sum(~np.isnan(values), axis=1)
+        with np.errstate(invalid="ignore"):
+            mean = np.nanmean(values, axis=1)
+        # rows: all pairs of the first metric, then all pairs of the second metric, ...
+        def column(array):
+            return np.asarray(array).T.ravel()
+        metric_names = np.repeat(metrics, len(pairs))
+        tables.append(pd.DataFrame({
+            "Condition": condition,
+            "Metric": metric_names,
+            "Group 1": np.tile(np.array(condition_groups, dtype=object)[first], len(metrics)),
+            "Group 2": np.tile(np.array(condition_groups, dtype=object)[second], len(metrics)),
+            "n 1": column(n[first]),
+            "n 2": column(n[second]),
+            "Mean 1": column(mean[first]),
+            "Mean 2": column(mean[second]),
+            "Mean difference": column(mean[first] - mean[second]),
+            "Effect size": column(effect_size),
+            "Effect size type": effect_size_type,
+            "Test": test,
+            "Statistic": column(statistic),
+            "p-value": column(p),
+            "Correction": correction,
+            "Adjusted p-value": column(adjusted_p),
+            "Significance": significance_stars(column(adjusted_p)),
+        }))
+    if len(tables) == 0:
+        return pd.DataFrame(columns=statistics_columns)
+    return pd.concat(tables, ignore_index=True)[statistics_columns]
+
+# Path of the statistics table next to a quantification table
+def get_statistics_file_name(quantification_file_name):
+    folder_path, name = os.path.split(quantification_file_name)
+    return os.path.join(folder_path, "statistics_" + name)
+
+def save_table(df, file_name):
+    if file_name.endswith(".parquet"):
+        df.to_parquet(file_name, index=False)
+    else:
+        df.to_csv(file_name, index=False)
+
+def load_table(file_name):
+    if file_name.endswith(".parquet"):
+        return pd.read_parquet(file_name)
+    return pd.read_csv(file_name)
+
+# Pairs and adjusted p-values of a single metric (and condition), e.g. for `add_stat_annotation(perform_stat_test=False)`
+# return: list of (group 1, group 2), list of p-values; pairs that couldn't be tested are left out
+def annotation_pairs(statistics_df, metric, condition=None):
+    rows = statistics_df[statistics_df["Metric"] == metric]
+    if condition is not None and "Condition" in rows:
+        rows = rows[rows["Condition"] == condition]
+    rows = rows[rows["Adjusted p-value"].notna()]
+    return list(zip(rows["Group 1"], rows["Group 2"])), list(rows["Adjusted p-value"])
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="pairwise_statistics", description="Test every pair of cell lines for every metric of a quantification table.")
+    parser.add_argument("table", help="Quantification table (`.parquet` or `.csv file`).")
+    parser.add_argument("-t", "--test", default="t-test_welch", choices=tests)
+    parser.add_argument("-c", "--correction", default="bonferroni", choices=[correction for correction in corrections if correction] + ["none"])
+    args = parser.parse_args()
+
+    df = load_table(args.table)
+    statistics_df = pairwise_tests(df, test=args.test, correction=None if args.correction == "none" else args.correction)
+    statistics_file_name = get_statistics_file_name(args.table)
+    save_table(statistics_df, statistics_file_name)
+    print(f"Saved {len(statistics_df)} tests to {statistics_file_name}")
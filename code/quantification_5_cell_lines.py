@@ -68,17 +68,12 @@ import glob
 import os
 import glob
 import cv2
-import seaborn as sns
-import matplotlib.pyplot as plt
 from itertools import combinations
 import gc
 from tqdm import tqdm
-# Easy to use, but deprecated in favor of statannotations package: 
-from statannot import add_stat_annotation 
 
 pic_folder_path = os.path.join(wd, pic_condition_folder_path)
 pic_folder_path = wd
-os.chdir(pic_folder_path)
 
 # Read the *.bmp file
 # NOTE: opencv reads the image in BGR format
@@ -273,6 +268,11 @@ def sort_df_by_cell_line(quantification_df):
 
 # Plot the boxplots of the quantification dataframe with seaborn and save them as `.png files`
 def box_plt_by_cell_line(quantification_df, value_to_plot, pic_folder_path, condition, threshold_mode, show="True"):
+    # the plotting packages take seconds to import, so they are only imported when plotting
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    # Easy to use, but deprecated in favor of statannotations package: 
+    from statannot import add_stat_annotation 
     plt.clf()
     sns.set(style="whitegrid")
     sns.set_context("talk")
@@ -4,6 +4,7 @@ the resulting mask images can be used as a filter to inly analyze the regions of
 """
 
 # std
+import sys
 from os import listdir
 from pathlib import Path
 from argparse import ArgumentParser
@@ -16,6 +17,11 @@ from tqdm import tqdm
 from tifffile import imwrite
 from PIL import Image, ImageDraw
 
+# local
+# `build_manifest.py` is shared with the scripts of the parent folder
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from build_manifest import BuildManifest
+
 
 # Constants
 CLASSES = {"gfppositive"}
@@ -60,6 +66,12 @@ parser.add_argument(
     default=(4096, 3008),
     required=False,
 )
+parser.add_argument(
+    "--no-labels",
+    help="Don't export the label maps (one id per annotation, `*_labels.tiff`) for the object-level quantification.",
+    dest="LABELS",
+    action="store_false",
+)
 args, _ = parser.parse_known_args()  # Ignore unexpected arguments
 
 ANNOTATIONS_PATH = Path(args.ANNOTATIONS_PATH)  # Directory containing QuPath project
@@ -105,16 +117,39 @@ def get_size_of_annotation_file(annotation_file: str) -> Tuple[int, int]:
     return img.size
 
 
-def export_tiff(img: List[any], basename: str, details: str) -> None:
+def get_tiff_path(basename: str, details: str) -> Path:
+    return OUTPUT_PATH / f"{Path(basename).stem}_{details}.tiff"
+
+
+def export_tiff(img: List[any], basename: str, details: str, dtype=np.uint8) -> None:
     imwrite(
-        OUTPUT_PATH / f"{Path(basename).stem}_{details}.tiff",
-        np.array(img, dtype=np.uint8),
+        get_tiff_path(basename, details),
+        np.array(img, dtype=dtype),
     )
 
 
+def get_output_paths(basename: str) -> List[Path]:
+    details = ["segmentation", "labels"] if args.LABELS else ["segmentation"]
+    return [get_tiff_path(basename, detail) for detail in details]
+
+
 annotation_file_names = list(
     filter(lambda f: f.endswith(".geojson"), listdir(ANNOTATIONS_PATH))
 )
+
+# Skip annotation files whose masks were created from the same annotations and size before
+manifest = BuildManifest(OUTPUT_PATH, "convert_label")
+parameters = {"size": list(args.SIZE), "classes": sorted(CLASSES), "labels": args.LABELS}
+annotation_file_names = [
+    f
+    for f in annotation_file_names
+    if not manifest.is_up_to_date(
+        f,
+        [ANNOTATIONS_PATH / f],
+        parameters,
+        get_output_paths(f),
+    )
+]
 annotations = {f: get_annotations(ANNOTATIONS_PATH / f) for f in annotation_file_names}
 
 
@@ -129,6 +164,10 @@ for annotation_file_name in tqdm(annotation_file_names, desc="Creating maps"):
     segmentation_draw = ImageDraw.Draw(segmentation_map)
     segmentation_step_size = 255 // max(sum(map(len, img_annotations.values())), 1)
     segmentation_fill = 255
+    # label map: every annotation gets its own id (1, 2, ...), in the same order as the grey values of the segmentation map
+    label_map = Image.new("I", img_size)
+    label_draw = ImageDraw.Draw(label_map)
+    label = 1
     for class_label, class_annotations in img_annotations.items():
         if class_label.lower() == "unsure":
             continue
@@ -146,7 +185,18 @@ for annotation_file_name in tqdm(annotation_file_names, desc="Creating maps"):
                 list(map(tuple, annotation_coordinates)), fill=segmentation_fill
             )
             segmentation_fill -= segmentation_step_size
+            label_draw.polygon(list(map(tuple, annotation_coordinates)), fill=label)
+            label += 1
 
     export_tiff(segmentation_map, annotation_file_name, "segmentation")
+    if args.LABELS:
+        export_tiff(label_map, annotation_file_name, "labels", np.uint16 if label <= 65536 else np.uint32)
+    manifest.record(
+        annotation_file_name,
+        [ANNOTATIONS_PATH / annotation_file_name],
+        parameters,
+        get_output_paths(annotation_file_name),
+    )
+manifest.save()
 
 print("Done!")
@@ -4,7 +4,7 @@ This script will create a mask for the image, in which both markers (ch2 and ch3
 This will be used as the intersection mask for further analyzations.
 The mean intensity per cell line and channel will be calculated, as well as the percentage of a marker's apperance
 in the intersection mask, an approximated value for the intensities per cell (Sum(Intensities of CHCHD2-Signal) / area of DAPI).
-All those values will be plotted and saved as a `.csv file`.
+All those values will be plotted and saved as a `.parquet file` (and/or `.csv file`).
 
 Change your file path to <where all your image folders to analyze are located>.
 The folder name with the images in it should include <"_thresholded_" + threshold_mode> by now.
@@ -51,6 +51,10 @@ cell_line_list = ["CHCHD2-AAV", "GFP-AAV"]
 # Select the previously executed thrsholding mode, on which the quantification will be performed
 threshold_mode = "otsu_triangle_otsu_triangle_gauss_False"
 
+# File format of the thresholded images: ".tiff" (uncompressed or compressed) or ".npz" for the sparse output of thresholding.py
+#  The ROI masks are still named after the `.tiff files` of QuPath.
+thresholded_file_format = ".tiff"
+
 # Set to True or False, wheter you applied a gaussian filter or not
 gauss_blur_filter = True   
 
@@ -64,25 +68,145 @@ save_mask_as_bmp = True
 #  The masks are based on c01, so the mask file should be named like the image file, but with the suffix "_segmentation.tiff"
 roi_mask = True
 
+# Only process the annotated regions of the ROI mask?
+#  The bounding boxes of the annotations are merged into bands of rows and only these crops are read
+#  (only the TIFF strips within the bands get decoded, if possible) and quantified.
+#  With `save_mask_as_bmp`, the masked DAPI channel is put together from the crops.
+roi_cropping = True
+
+# Run thresholding and quantification in one go?
+#  The raw images (in the `<cell line>` folders of each treatment) get preprocessed, thresholded, masked with the ROI mask
+#  and quantified while they are still in memory, so the thresholded images don't need to be written and read again.
+#  `threshold_mode` is interpreted as "<mode of thresholding.py>_<additional background substraction>".
+#  Set `save_thresholded_images` to True to still write them to the usual `*_thresholded_*` folders, e.g. for QuPath.
+fused_pipeline = False
+save_thresholded_images = False
+# Background substraction method of thresholding.py, only used by the fused pipeline
+background_method = "downsampled_rolling_ball"
+
+# Quantify every single object too (one row per object in `object_quantification.parquet`/`.csv` of the treatment folder)?
+#  - "nuclei": connected components of the thresholded DAPI channel (within the ROI mask, if `roi_mask`)
+#  - "annotations": the single QuPath annotations, from the `*_labels.tiff` files of convert_label.py in the "masks" folder
+#  - None: only per image
+#  Area, amounts, mean intensities and the CHCHD2-TOM20 colocalization of all objects of an image are calculated at once
+#  (one labeled `bincount` per value). Uses the full images instead of the ROI crops, not used by the fused pipeline.
+object_level = None
+# Nuclei with fewer pixels are left out (noise of the thresholding)
+min_object_area = 20
+
+# Intensity based colocalization coefficients of channel pairs (see `colocalization_coefficients.py`)?
+#  Pearson's r, Manders' M1/M2, the overlap coefficient, the Costes thresholds and the thresholded Manders' coefficients
+#  (tM1/tM2) of every pair of `coefficient_channel_pairs`, as additional columns of the quantification table.
+#  Calculated from one joint intensity histogram per pair and image, within the ROI mask (if `roi_mask`).
+quantify_coefficients = False
+# Pairs of channels (0 = DAPI, 1 = CHCHD2, 2 = TOM-20, 3 = EGFP), by default every pair
+coefficient_channel_pairs = [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)]
+
+# Costes randomization test: is the Pearson's r of a channel pair higher than for randomly scrambled blocks of the image?
+#  Adds a p-value, the mean r of the scrambled images and the number of shuffles per pair of `randomization_channel_pairs`
+#  to the quantification table. Only the blocks inside the ROI mask (if `roi_mask`) are scrambled, in a pool of
+#  `randomization_workers` processes, while the next images are quantified (the fused pipeline runs them one after another).
+randomization_test = False
+randomization_channel_pairs = [(1, 2)]
+randomization_shuffles = 200
+# Every test stops after this many seconds (with fewer shuffles), so the run time is bounded:
+#  at most images * pairs * time limit / workers, e.g. 2000 images * 1 pair * 60 s / 8 workers = ~4 h
+randomization_time_limit = 60
+randomization_workers = 4
+# The scrambled blocks are as large as the point spread function (FWHM = 0.51 * wavelength / NA, in pixels)
+# TODO: adjust to the microscope
+emission_wavelength_nm = 570
+numerical_aperture = 1.4
+pixel_size_um = 0.1
+
+# Distance tolerant colocalization (see `distance_colocalization.py`)?
+#  Percentage of the signal pixels of the first channel of every pair of `distance_channel_pairs` within d pixels of the
+#  signal of the second channel, for every d of `colocalization_distances` (d = 0 is the plain overlap).
+#  Tolerates adjacent signals without the gaussian blur of thresholding.py, which also changes the intensities.
+#  Costs one distance transform per channel.
+quantify_distance_colocalization = False
+distance_channel_pairs = [(1, 2), (2, 1)]
+colocalization_distances = [0, 1, 2, 3, 5]
+
+# Statistical test of every pair of cell lines (for every metric) and the correction for multiple testing
+#  The tests are done for all metrics at once by `pairwise_statistics.py` and saved as `statistics_quantification.parquet`
+#  (or `.csv`) next to the quantification table, the plots only show the adjusted p-values of this table.
+# TODO: adjust the statistical test to the correct one.
+#       "Mann-Whitney" is used when the data is not normally distributed
+#       "t-test_welch" is used when the data is normally distributed and the variances are not equal
+#       "t-test_ind" is used when the data is normally distributed and the variances are equal
+statistics_test = "t-test_welch"
+# "bonferroni", "holm", "fdr_bh" or None
+statistics_correction = "bonferroni"
+
+# Number of processes that render the box plots (1 to render them one after another)
+#  Plots whose rows, p-values and style didn't change since the last run are not rendered again.
+plot_workers = 4
+# Only render the plots of the saved quantification tables (e.g. after changing the plots), without quantifying again?
+only_plots = False
+
+# File format of the quantification table: "parquet" or "csv"
+#  Parquet files are written in row groups while the images are processed and need `pyarrow`.
+#  Without `pyarrow`, the table is written as `.csv file`.
+results_format = "parquet"
+# Export the Parquet table as `.csv file` too?
+export_csv = True
+
+# Only quantify new or changed images?
+#  Every row of the table is stored with a key of the content hashes of its channel images (and ROI mask) and the
+#  quantification parameters. Rows with a matching key are taken from the previous table, only the rest is quantified.
+#  The hashes are cached by file size and modification time in `quantification_state.json` of the treatment folder
+#  (same hashes as the build manifests of the other stages, see `build_manifest.py`).
+#  Not used by the fused pipeline, which needs to threshold every raw image anyway.
+incremental = True
+
+# Keep a catalog of all images of `wd` (`.image_catalog.sqlite`, see `image_catalog.py`)?
+#  The folders are then listed from the catalog instead of the (network) drive. It's refreshed at the start of every run,
+#  but only folders that changed since the last run are listed again.
+use_image_catalog = True
+
+# Number of image sets that are read (and hashed) in background threads, while the current one is quantified.
+#  The rows are still added in the order of the files. Set to 0 to read the images one after another.
+prefetch_image_sets = 2
+io_threads = 2
+
 # ----------------------------------------------------------------------------------------------- #
 
 import pandas as pd
+import numpy as np
 import glob
 import os
 import glob
 import cv2
-import seaborn as sns
-import matplotlib.pyplot as plt
+# seaborn, matplotlib and statannot (box_plots.py) and scipy (pairwise_statistics.py) are only imported when they are used,
+# so importing this script (e.g. in the processes of a pool) stays fast, see `import_budget.py`
 from itertools import combinations
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import gc
+import json
+import hashlib
 from tqdm import tqdm
-# Easy to use, but deprecated in favor of statannotations package: 
-from statannot import add_stat_annotation 
+import tifffile
+import thresholding
+# on the path since `import thresholding`
+import build_manifest
+import dataset_index
+import image_catalog
+import image_io
+import pairwise_statistics
+import colocalization_coefficients
+import distance_colocalization
+import box_plots
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 pic_folder_path = os.path.join(wd, pic_condition_folder_path)
 pic_folder_path = wd
-os.chdir(pic_folder_path)
 
 # Read the *.bmp file
 # NOTE: opencv reads the image in BGR format
@@ -91,30 +215,263 @@ def read_bmp(file_name):
     img = cv2.imread(file_name, -1)
     return img
 
+# Bit-packed binary mask, 8 pixels per byte (12 MB -> 1.5 MB for a 4096x3008 image)
+# Every row is packed on its own, so blocks of rows can be unpacked without touching the rest of the mask.
+class PackedMask:
+    def __init__(self, bits, shape):
+        self.bits = bits
+        self.shape = shape
+
+    # Mask of all pixels with a value > 0
+    @classmethod
+    def from_array(cls, array, block_rows=256):
+        bits = np.empty((array.shape[0], (array.shape[1] + 7) // 8), dtype=np.uint8)
+        for row in range(0, array.shape[0], block_rows):
+            bits[row:row + block_rows] = np.packbits(array[row:row + block_rows] > 0, axis=1, bitorder="little")
+        return cls(bits, array.shape)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def __and__(self, other):
+        return PackedMask(self.bits & other.bits, self.shape)
+
+    def __or__(self, other):
+        return PackedMask(self.bits | other.bits, self.shape)
+
+    def __invert__(self):
+        bits = ~self.bits
+        # the bits behind the last pixel of a row must stay unset
+        if self.shape[1] % 8:
+            bits[:, -1] &= (1 << (self.shape[1] % 8)) - 1
+        return PackedMask(bits, self.shape)
+
+    # Number of pixels within the mask
+    def area(self):
+        return int(popcount(self.bits).sum(dtype=np.int64))
+
+    def unpack(self, row=0, block_rows=None):
+        block_rows = self.shape[0] if block_rows is None else block_rows
+        return np.unpackbits(self.bits[row:row + block_rows], axis=1, count=self.shape[1], bitorder="little").view(bool)
+
+    # Sum of the intensities of a channel within the mask
+    def masked_sum(self, channel, block_rows=256):
+        total = 0
+        for row in range(0, self.shape[0], block_rows):
+            total += channel[row:row + block_rows][self.unpack(row, block_rows)].sum(dtype=np.int64 if channel.dtype.kind in "ui" else np.float64)
+        return total
+
+    # Copy of the channel, where every pixel outside of the mask is set to 0
+    def apply(self, channel, block_rows=256):
+        masked = np.zeros_like(channel)
+        for row in range(0, self.shape[0], block_rows):
+            mask_block = self.unpack(row, block_rows)
+            masked[row:row + block_rows][mask_block] = channel[row:row + block_rows][mask_block]
+        return masked
+
+    # 8 bit image of the mask (255 within the mask), e.g. to save it
+    def to_array(self):
+        return self.unpack().view(np.uint8) * np.uint8(255)
+
+# Number of set bits of every byte
+if hasattr(np, "bitwise_count"):
+    popcount = np.bitwise_count
+else:
+    popcount_table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    def popcount(bits):
+        return popcount_table[bits]
+
+# Area of every combination of set and unset masks: areas[code], where bit k of the code is set,
+# if the pixels lay within mask k. Only needs ANDs of the packed masks and a popcount.
+def code_areas(masks):
+    code_masks = [None]
+    for mask in masks:
+        inverted = ~mask
+        # the new bit is the most significant one, so all codes without it come first
+        without_mask = [inverted if code_mask is None else code_mask & inverted for code_mask in code_masks]
+        within_mask = [mask if code_mask is None else code_mask & mask for code_mask in code_masks]
+        code_masks = without_mask + within_mask
+    return np.array([code_mask.area() for code_mask in code_masks], dtype=np.int64)
+
 def keep_only_area_of_mask(channel, mask):
-    return cv2.bitwise_and(channel, mask)
+    return mask.apply(channel)
+
+# Name of the ROI mask of an image set, the masks are based on the c01 `.tiff` image
+# suffix: "_segmentation.tiff" for the ROI mask, "_labels.tiff" for the labeled annotations of convert_label.py
+def get_roi_mask_name(file_name, suffix="_segmentation.tiff"):
+    ch2_file_name = dataset_index.replace_channel_name(file_name, ch_prefix, [ch1_suffix, ch2_suffix, ch3_suffix, ch4_suffix], ch_prefix + ch2_suffix)
+    return Path(file_name).parent.parent / "masks" / (Path(ch2_file_name).with_suffix(".tiff").name + suffix)
+
+# Only keep the pixels of all channels within the ROI mask
+def apply_roi_mask(ch1, ch2, ch3, ch4, file_name, save_mask=False):
+    roi_mask_name = get_roi_mask_name(file_name)
+    # every annotated pixel (> 0) is part of the ROI, the annotations have different grey values
+    mask = PackedMask.from_array(image_io.read_channel(str(roi_mask_name)))
+    ch1 = keep_only_area_of_mask(ch1, mask)
+    ch2 = keep_only_area_of_mask(ch2, mask)
+    ch3 = keep_only_area_of_mask(ch3, mask)
+    ch4 = keep_only_area_of_mask(ch4, mask)
 
-def read_4_color_channels_from_greyscale(file_name, roi_mask=False, save_mask=False):
-    base_channel = ch_prefix + ch1_suffix
-    ch1 = cv2.imread(file_name, -1)
-    ch2 = cv2.imread(file_name.replace(base_channel, ch_prefix + ch2_suffix), -1)
-    ch3 = cv2.imread(file_name.replace(base_channel, ch_prefix + ch3_suffix), -1)
-    ch4 = cv2.imread(file_name.replace(base_channel, ch_prefix + ch4_suffix), -1)
+    if save_mask:
+        save_masked_channel(file_name, ch1)
+    return ch1, ch2, ch3, ch4
 
-    if roi_mask:
-        roi_mask_name = Path(file_name).parent.parent / "masks" / (str(Path(file_name.replace(base_channel, ch_prefix + ch2_suffix)).name) + "_segmentation.tiff")
-        mask = cv2.imread(str(roi_mask_name), -1)
-        ch1 = keep_only_area_of_mask(ch1, mask)
-        ch2 = keep_only_area_of_mask(ch2, mask)
-        ch3 = keep_only_area_of_mask(ch3, mask)
-        ch4 = keep_only_area_of_mask(ch4, mask)
+# Save a channel within the ROI mask next to the mask, e.g. to check the mask
+def save_masked_channel(file_name, channel):
+    sanity_mask_name = str(get_roi_mask_name(file_name)).replace("_segmentation", "_coloc")
+    cv2.imwrite(sanity_mask_name, channel)
+
+# Pixels of the ROI mask of an image set (boolean), e.g. for the colocalization coefficients
+def read_roi(file_name):
+    return image_io.read_channel(str(get_roi_mask_name(file_name))) > 0
+
+# Channel files of every complete image set of a folder by the first channel (see `dataset_index.py`)
+# roi_mask: only image sets with a ROI mask in the "masks" folder next to the folder
+def get_image_sets(folder_path, roi_mask=False):
+    mask_folder_path = os.path.join(os.path.dirname(os.path.abspath(folder_path)), "masks") if roi_mask else None
+    channel_sets = dataset_index.channel_sets(folder_path, ch_prefix, [ch1_suffix, ch2_suffix, ch3_suffix, ch4_suffix], thresholded_file_format, mask_folder_path=mask_folder_path, require_roi_mask=roi_mask, mask_file_format=".tiff")
+    return {channel_set["channels"][0]: channel_set["channels"] for channel_set in channel_sets}
+
+# First channel of every complete image set of a folder
+def get_image_set_files(folder_path, roi_mask=False):
+    return list(get_image_sets(folder_path, roi_mask))
+
+# File names of the 4 corresponding greyscale images
+def get_channel_file_names(file_name):
+    channel_set = dataset_index.channel_set_of(file_name, ch_prefix, [ch1_suffix, ch2_suffix, ch3_suffix, ch4_suffix], thresholded_file_format)
+    if channel_set is None or not channel_set["complete"]:
+        raise ValueError(f"Not all channels of {file_name} exist")
+    return channel_set["channels"]
+
+# in_memory: read memory-mapped channels completely, e.g. when they are prefetched
+# channel_files: result of `get_channel_file_names()`, if the channels were looked up already
+def read_4_color_channels_from_greyscale(file_name, roi_mask=False, save_mask=False, in_memory=False, channel_files=None):
+    # memory-mapped (read-only) for uncompressed TIFFs
+    ch1, ch2, ch3, ch4 = [image_io.read_channel(channel_file) for channel_file in channel_files or get_channel_file_names(file_name)]
+    if in_memory:
+        ch1, ch2, ch3, ch4 = [image_io.in_memory(channel) for channel in (ch1, ch2, ch3, ch4)]
 
-    if save_mask:
-        sanity_mask_name = str(roi_mask_name).replace("_segmentation", "_coloc")
-        cv2.imwrite(sanity_mask_name, ch1)
+    if roi_mask:
+        ch1, ch2, ch3, ch4 = apply_roi_mask(ch1, ch2, ch3, ch4, file_name, save_mask=save_mask)
 
     return ch1, ch2, ch3, ch4
 
+# Bands of rows around the annotated regions of a ROI mask.
+# The bounding boxes of the regions get merged wherever their rows overlap, so the bands don't overlap
+# and every annotated pixel lies in exactly one band.
+# return: list of (row_start, row_stop, col_start, col_stop)
+def roi_bands(mask):
+    _, _, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8), connectivity=8)
+    # label 0 is the background
+    boxes = sorted((y, y + h, x, x + w) for x, y, w, h, _ in stats[1:])
+    bands = []
+    for row_start, row_stop, col_start, col_stop in boxes:
+        if bands and row_start < bands[-1][1]:
+            band = bands[-1]
+            bands[-1] = (band[0], max(band[1], row_stop), min(band[2], col_start), max(band[3], col_stop))
+        else:
+            bands.append((row_start, row_stop, col_start, col_stop))
+    return bands
+
+# Read only the given row ranges of a greyscale TIFF image (or sparse `.npz` image).
+# Only the strips that contain these rows get decoded. Tiled or multi-channel TIFFs (or missing codecs)
+# fall back to decoding the whole image.
+# input: "file name" string, list of (row_start, row_stop)
+# return: list of arrays with the rows of each range
+def read_tiff_rows(file_name, row_ranges):
+    if file_name.endswith(image_io.sparse_file_format):
+        return image_io.read_sparse_channel(file_name, row_ranges)
+    try:
+        with tifffile.TiffFile(file_name) as tif:
+            page = tif.pages.first
+            if page.is_tiled or page.samplesperpixel != 1:
+                raise ValueError("Only strips of single channel TIFFs can be decoded on their own")
+            height = page.imagelength
+            rows_per_strip = min(page.rowsperstrip, height)
+            strips = {}
+            def read_strip(index):
+                if index not in strips:
+                    tif.filehandle.seek(page.dataoffsets[index])
+                    data = tif.filehandle.read(page.databytecounts[index])
+                    segment, _, _ = page.decode(data, index, jpegtables=page.jpegtables)
+                    # the last strip may be shorter
+                    strips[index] = segment[0, :min(rows_per_strip, height - index * rows_per_strip), :, 0]
+                return strips[index]
+
+            crops = []
+            for row_start, row_stop in row_ranges:
+                first_strip, last_strip = row_start // rows_per_strip, (row_stop - 1) // rows_per_strip
+                rows = np.concatenate([read_strip(index) for index in range(first_strip, last_strip + 1)])
+                offset = first_strip * rows_per_strip
+                crops.append(rows[row_start - offset:row_stop - offset])
+            return crops
+    except (ValueError, tifffile.TiffFileError):
+        img = image_io.read_channel(file_name)
+        return [img[row_start:row_stop] for row_start, row_stop in row_ranges]
+
+# Read the ROI mask of an image set and the bands of rows of its channels that contain annotated regions
+# channel_files: result of `get_channel_file_names()`, if the channels were looked up already
+# return: (mask, bands, [crops per band] per channel)
+def read_roi_crops(file_name, channel_files=None):
+    mask = image_io.in_memory(image_io.read_channel(str(get_roi_mask_name(file_name))))
+    bands = roi_bands(mask)
+    row_ranges = [(row_start, row_stop) for row_start, row_stop, _, _ in bands]
+    channel_crops = [read_tiff_rows(channel_file, row_ranges) for channel_file in channel_files or get_channel_file_names(file_name)]
+    return mask, bands, channel_crops
+
+# Bounding box of the bands of `roi_bands()`
+# return: (row slice, column slice)
+def roi_bands_bounding_box(bands):
+    return slice(bands[0][0], bands[-1][1]), slice(min(band[2] for band in bands), max(band[3] for band in bands))
+
+# The ROI of the crops of `read_roi_crops()` as images of its bounding box (masked like the full images)
+# return: the four channels in the order of `swap_egfp_and_chchd2()`
+def roi_crop_images(mask, bands, channel_crops):
+    rows, cols = roi_bands_bounding_box(bands)
+    row_start, row_stop, col_start, col_stop = rows.start, rows.stop, cols.start, cols.stop
+    images = [np.zeros((row_stop - row_start, col_stop - col_start), dtype=crops[0].dtype) for crops in channel_crops]
+    for i, (band_row_start, band_row_stop, band_col_start, band_col_stop) in enumerate(bands):
+        roi = mask[band_row_start:band_row_stop, band_col_start:band_col_stop] > 0
+        for image, crops in zip(images, channel_crops):
+            image[band_row_start - row_start:band_row_stop - row_start, band_col_start - col_start:band_col_stop - col_start] = np.where(roi, crops[i][:, band_col_start:band_col_stop], 0)
+    return swap_egfp_and_chchd2(*images)
+
+# Quantify only the annotated regions of an image set.
+# The counts and sums of all bands are added up, so the result is the same as for the masked full images.
+# crops: result of `read_roi_crops()`, if the crops were read already
+# save_mask: save the masked DAPI channel like `apply_roi_mask()`, put together from the crops
+# return: dict with one entry per column of the quantification table, or None if there's no DAPI signal in the ROI
+def quantify_roi_crops(file_name, gaussian_filter=False, threshold_mode="", crops=None, save_mask=False):
+    mask, bands, channel_crops = crops if crops is not None else read_roi_crops(file_name)
+    masked_channel = np.zeros(mask.shape, dtype=channel_crops[0][0].dtype if bands else np.uint8) if save_mask else None
+
+    counts = np.zeros(16, dtype=np.int64)
+    sums = np.zeros((4, 16), dtype=np.float64)
+    # the joint histograms and sums of the bands add up to the ones of the whole ROI
+    pair_statistics = {}
+    for i, (row_start, row_stop, col_start, col_stop) in enumerate(bands):
+        roi = PackedMask.from_array(mask[row_start:row_stop, col_start:col_stop])
+        ch1, ch2, ch3, ch4 = [roi.apply(crops[i][:, col_start:col_stop]) for crops in channel_crops]
+        ch1, ch2, ch3, ch4 = swap_egfp_and_chchd2(ch1, ch2, ch3, ch4)
+        if save_mask:
+            masked_channel[row_start:row_stop, col_start:col_stop] = ch1
+        band_counts, band_sums = colocalization_counts([ch1, ch2, ch3, ch4])
+        counts += band_counts
+        sums += band_sums
+        if quantify_coefficients:
+            for pair, (histogram, exact_sums) in coefficient_statistics([ch1, ch2, ch3, ch4], mask[row_start:row_stop, col_start:col_stop] > 0).items():
+                pair_statistics[pair] = (pair_statistics[pair][0] + histogram, pair_statistics[pair][1] + exact_sums) if pair in pair_statistics else (histogram, exact_sums)
+    if save_mask:
+        save_masked_channel(file_name, masked_channel)
+    row = quantification_row(counts, sums, file_name, gaussian_filter, threshold_mode)
+    if row is not None and quantify_coefficients:
+        row.update(colocalization_coefficients.coefficient_row(pair_statistics, channel_names, channel_crops[0][0].dtype if bands else np.uint8))
+    if row is not None and quantify_distance_colocalization:
+        # the distances reach across the bands, so they are measured in the bounding box of the whole ROI
+        row.update(distance_colocalization.distance_row(roi_crop_images(mask, bands, channel_crops), distance_channel_pairs, colocalization_distances, channel_names))
+    return row
+
 
 
 def create_mask(ch2, ch3, file, save_mask=False):
@@ -124,198 +481,669 @@ def create_mask(ch2, ch3, file, save_mask=False):
     #  - We do not care about the ch1/blue channel (it contains the DAPI/Hoechst intensities)
     #  - Keep all the pixels, where both channels are not zero
     #  - This will give us the spots where both markers are present, i.e. the colocalization mask
-    mask_chchd2_and_tom20 = cv2.bitwise_and(ch2, ch3)
+    mask_chchd2_and_tom20 = PackedMask.from_array(ch2) & PackedMask.from_array(ch3)
 
     # Save the mask as a `.bmp file`
     # TODO: change
     if save_mask & (not os.path.isfile(file.replace("thresholded", "mask"))):
-        cv2.imwrite(str(Path(file).parent.parent / "masks" / str(Path(file).name).replace("_segmentation", "_colocCHCHD2TOM20")), mask_chchd2_and_tom20)
+        cv2.imwrite(str(Path(file).parent.parent / "masks" / str(Path(file).name).replace("_segmentation", "_colocCHCHD2TOM20")), mask_chchd2_and_tom20.to_array())
 
-    # Transform mask_chchd2_and_tom20_df to a binary mask
-    mask_chchd2_and_tom20 = mask_chchd2_and_tom20 > 0
+    # bit-packed binary mask
     return mask_chchd2_and_tom20
 
 
-def calculate_mean_intensity_of_2_markers(pic_folder_path, treatment_var="normal", threshold_mode="triangle_on_dapi_intensity_greater_1_on_rest", gaussian_filter=False, save_mask=False, roi_mask=False):
-    # Lists, in which all values of interest will be stored:
-    file_names = []
-
-    ch1_counts_total = []
-    ch2_counts_total = []
-    ch3_counts_total = []
-    ch4_counts_total = []
-    ch2_counts_total_normalized = []
-    ch3_counts_total_normalized = []
-    ch4_counts_total_normalized = []
+# Count and sum up the pixels of every combination of channels with signal (intensity > 0) in a single pass.
+# Every pixel gets a code with one bit per channel (bit k is set, if channel k > 0), so all combinations
+# (single channels, pairs, triples, all four) can be obtained from the counts and sums per code.
+# The counts are popcounts of the bit-packed signal masks, the sums come from one weighted `bincount` of the codes.
+# The image is processed in blocks of rows to keep the temporary arrays small.
+# return: counts[code] (number of pixels per code) and sums[channel, code] (sum of the intensities of a channel per code)
+def colocalization_counts(channels, block_rows=256):
+    n_codes = 1 << len(channels)
+    counts = np.zeros(n_codes, dtype=np.int64)
+    sums = np.zeros((len(channels), n_codes), dtype=np.float64)
+    for row in range(0, channels[0].shape[0], block_rows):
+        blocks = [channel[row:row + block_rows] for channel in channels]
+        code = np.zeros(blocks[0].shape, dtype=np.uint8)
+        masks = []
+        for bit, block in enumerate(blocks):
+            signal = block > 0
+            code |= signal.view(np.uint8) << bit
+            masks.append(PackedMask(np.packbits(signal, axis=1, bitorder="little"), signal.shape))
+        code = code.ravel()
+        counts += code_areas(masks)
+        for k, block in enumerate(blocks):
+            sums[k] += np.bincount(code, weights=block.ravel(), minlength=n_codes)
+    return counts, sums
+
+# Number of pixels, where all of the given channels have signal (other channels may or may not have signal)
+# input: counts of `colocalization_counts()`, indices of the channels
+def combination_count(counts, combination):
+    bits = sum(1 << k for k in combination)
+    codes = np.arange(counts.size)
+    return int(counts[(codes & bits) == bits].sum())
+
+# Sum of the intensities of a channel, where all of the given channels have signal
+def combination_sum(sums, channel, combination):
+    bits = sum(1 << k for k in combination)
+    codes = np.arange(sums.shape[1])
+    return sums[channel][(codes & bits) == bits].sum()
+
+def safe_divide(numerator, denominator):
+    return numerator / denominator if denominator != 0 else float("nan")
+
+# Counts, intensity sums and mean intensities of every channel within every combination of channels
+# return: dict {combination: {"count": ..., "sums": [...], "means": [...]}}, the combinations are tuples of channel indices
+def colocalization_statistics(counts, sums):
+    n_channels = sums.shape[0]
+    statistics = {}
+    for size in range(1, n_channels + 1):
+        for combination in combinations(range(n_channels), size):
+            count = combination_count(counts, combination)
+            channel_sums = [combination_sum(sums, channel, combination) for channel in range(n_channels)]
+            statistics[combination] = {
+                "count": count,
+                "sums": channel_sums,
+                "means": [safe_divide(channel_sum, count) for channel_sum in channel_sums],
+            }
+    return statistics
+
+# Columns of the quantification table (without "Condition" and "Cell line")
+quantification_columns = [
+    "File name",
+    "DAPI amount", "CHCHD2 amount", "TOM-20 amount", "EGFP amount",
+    "CHCHD2 amount normalized by DAPI", "TOM-20 amount normalized by DAPI", "EGFP amount normalized by DAPI",
+    "DAPI intensity (mean)", "CHCHD2 intensity (mean)", "TOM-20 intensity (mean)", "EGFP intensity (mean)",
+    "CHCHD2 mean intensity (colocalized with DAPI)", "CHCHD2 mean intensity (colocalized with TOM-20)", "TOM-20 mean intensity (colocalized with CHCHD2)",
+    "DAPI colocalized with CHCHD2 (Coverage in %)", "CHCHD2 colocalized with DAPI (Coverage in %)",
+    "CHCHD2 colocalized with TOM-20 (Coverage in %)", "TOM-20 colocalized with CHCHD2 (Coverage in %)",
+    "CHCHD2 amount per cell (colocalized with TOM-20)", "CHCHD2 amount per mito (colocalized with TOM-20)",
+    "CHCHD2 intensity per cell (colocalized with TOM-20)", "CHCHD2 intensity per mito (colocalized with TOM-20)",
+    "Gaussian filter", "Threshold type",
+]
+
+# NOTE: swap ch2 and ch4 , because original ch2 is EGFP and ch4 is CHCHD2 in this case. 
+# so let's swap and just add egfp as ch4 to the analysis 
+def swap_egfp_and_chchd2(ch1, ch2, ch3, ch4):
+    return ch1, ch4, ch3, ch2
+
+# Names of the channels in the order of `swap_egfp_and_chchd2()`
+channel_names = ["DAPI", "CHCHD2", "TOM-20", "EGFP"]
+
+# Columns of the colocalization coefficients, see `quantify_coefficients`
+coefficient_columns = colocalization_coefficients.coefficient_columns([(channel_names[i], channel_names[j]) for i, j in coefficient_channel_pairs]) if quantify_coefficients else []
+# Columns of the randomization test, see `randomization_test`
+randomization_columns = colocalization_coefficients.randomization_columns([(channel_names[i], channel_names[j]) for i, j in randomization_channel_pairs]) if randomization_test else []
+# Columns of the distance tolerant colocalization, see `distance_colocalization`
+distance_columns = distance_colocalization.distance_columns([(channel_names[i], channel_names[j]) for i, j in distance_channel_pairs], colocalization_distances) if quantify_distance_colocalization else []
+quantification_columns = quantification_columns[:-2] + coefficient_columns + randomization_columns + distance_columns + quantification_columns[-2:]
+
+# Joint intensity histograms and exact intensity sums of the channel pairs of `coefficient_channel_pairs`
+# input: channels in the order of `swap_egfp_and_chchd2()`, boolean mask of the pixels to use (e.g. the ROI) or None for all pixels
+# return: {(i, j): (joint histogram, sums)}, see `colocalization_coefficients.joint_statistics()`
+def coefficient_statistics(channels, roi=None):
+    return {(i, j): colocalization_coefficients.joint_statistics(channels[i], channels[j], roi) for i, j in coefficient_channel_pairs}
+
+# Side length of the scrambled blocks of the randomization test
+randomization_block_size = colocalization_coefficients.psf_block_size(emission_wavelength_nm, numerical_aperture, pixel_size_um)
+
+# Bounding box of the pixels of a ROI mask (None: the whole image)
+# return: (row slice, column slice)
+def roi_bounding_box(roi=None):
+    if roi is None:
+        return slice(None), slice(None)
+    rows, cols = np.flatnonzero(roi.any(axis=1)), np.flatnonzero(roi.any(axis=0))
+    if len(rows) == 0:
+        return slice(0, 0), slice(0, 0)
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+# Columns and arguments of `colocalization_coefficients.randomization_test()` for every pair of `randomization_channel_pairs`
+# input: channels in the order of `swap_egfp_and_chchd2()` (e.g. cropped to the ROI), file name for the seed of the shuffles,
+#        boolean ROI mask of the same shape as the channels (only the blocks inside of it are scrambled) or None
+# return: list of (columns, arguments)
+def randomization_jobs(channels, file, roi=None):
+    # the same image always gets the same shuffles
+    seed = int(hashlib.sha1(os.path.basename(file).encode()).hexdigest()[:8], 16)
+    return [
+        (colocalization_coefficients.randomization_columns([(channel_names[i], channel_names[j])]), (channels[i], channels[j], randomization_block_size, randomization_shuffles, randomization_time_limit, seed + k, roi))
+        for k, (i, j) in enumerate(randomization_channel_pairs)
+    ]
+
+# Calculate all values of interest of a single image set
+# input: the four channels in the order of the file names (c00, c01, c02, c03),
+#        boolean ROI mask for the colocalization coefficients (None: all pixels)
+# return: dict with one entry per column of the quantification table, or None if there's no DAPI signal in the image
+def quantify_channels(ch1, ch2, ch3, ch4, file, gaussian_filter=False, threshold_mode="", roi=None):
+    ch1, ch2, ch3, ch4 = swap_egfp_and_chchd2(ch1, ch2, ch3, ch4)
+
+    # Counts and intensity sums of all channel combinations in one pass over the image
+    # Channel indices: 0 = DAPI, 1 = CHCHD2, 2 = TOM-20, 3 = EGFP
+    counts, sums = colocalization_counts([ch1, ch2, ch3, ch4])
+    row = quantification_row(counts, sums, file, gaussian_filter, threshold_mode)
+    if row is not None and quantify_coefficients:
+        row.update(colocalization_coefficients.coefficient_row(coefficient_statistics([ch1, ch2, ch3, ch4], roi), channel_names, ch1.dtype))
+    if row is not None and quantify_distance_colocalization:
+        row.update(distance_colocalization.distance_row([ch1, ch2, ch3, ch4], distance_channel_pairs, colocalization_distances, channel_names))
+    return row
+
+# Derive the columns of the quantification table from the counts and sums of `colocalization_counts()`
+def quantification_row(counts, sums, file, gaussian_filter=False, threshold_mode=""):
+    statistics = colocalization_statistics(counts, sums)
+
+    # How many pixles of a color channel have intensity > 0?
+    # NOTE: This required the image to be thresholded and checked before
+    ch1_count_total = statistics[(0,)]["count"]
+    ch2_count_total = statistics[(1,)]["count"]
+    ch3_count_total = statistics[(2,)]["count"]
+    ch4_count_total = statistics[(3,)]["count"]
+
+    # if image is empty / no Signal on ch1 (DAPI), skip the image
+    if ch1_count_total == 0:
+        return None
+
+    # Normalize the amounts of each marker by the total amount of DAPI-pixels
+    # aka normalizing by nuclei area
+    ch2_count_total_normalized = ch2_count_total / ch1_count_total
+    ch3_count_total_normalized = ch3_count_total / ch1_count_total
+    ch4_count_total_normalized = ch4_count_total / ch1_count_total
+
+    # Get mean intensities of each channel
+    ch1_mean_greater_than_zero = statistics[(0,)]["means"][0]
+    ch2_mean_greater_than_zero = statistics[(1,)]["means"][1]
+    ch3_mean_greater_than_zero = statistics[(2,)]["means"][2]
+    ch4_mean_greater_than_zero = statistics[(3,)]["means"][3]
+
+    # Get amount of all values > 0 that are colocalized
+    # The CHCHD2-TOM20 colocalization mask contains all pixels, where both channels are not zero
+    ch2_count_in_mask = statistics[(1, 2)]["count"]
+    ch3_count_in_mask = ch2_count_in_mask
+    ch1_count_at_chchd2 = statistics[(0, 1)]["count"]
+    ch2_count_at_dapi = ch1_count_at_chchd2
+
+    # Calculate the percentage of ch1, ch2, and ch3 that are in chchd2_and_tom20
+    percentage_of_ch1_in_chchd2 = ch1_count_at_chchd2 / ch1_count_total * 100
+    percentage_of_ch2_in_dapi = safe_divide(ch2_count_at_dapi, ch2_count_total) * 100
+    percentage_of_ch2_in_chchd2_and_tom20 = safe_divide(ch2_count_in_mask, ch2_count_total) * 100
+    percentage_of_ch3_in_chchd2_and_tom20 = safe_divide(ch3_count_in_mask, ch3_count_total) * 100
+
+    # Mean-intensity of the pixel values of a channel, that are not black and lay within in the mask
+    # NOTE: "CHCHD2 mean intensity (colocalized with DAPI)" has always been the DAPI intensity within the CHCHD2-TOM20 mask
+    ch1_crossover_mean = statistics[(0, 1, 2)]["means"][0]
+    ch2_crossover_mean = statistics[(1, 2)]["means"][1]
+    ch3_crossover_mean = statistics[(1, 2)]["means"][2]
+
+    # Per cell and per mitochondria approximation (ch3 should be TOM20)
+    # Area-wise approximation:
+    amount_per_cell_approximation_ch2_in_mask = ch2_count_in_mask / ch1_count_total
+    amount_per_mito_approximation_ch2_in_mask = safe_divide(ch2_count_in_mask, ch3_count_total)
+    # Total intensity divided by cell-area approximation:
+    intensity_per_cell_approximation_ch2_in_mask = statistics[(1, 2)]["sums"][1] / ch1_count_total
+    intensity_per_mito_approximation_ch2_in_mask = safe_divide(intensity_per_cell_approximation_ch2_in_mask * ch1_count_total, ch3_count_total)
+
+    return {
+        "File name": os.path.basename(file),
+        # raw amounts:
+        "DAPI amount": ch1_count_total,
+        "CHCHD2 amount": ch2_count_total,
+        "TOM-20 amount": ch3_count_total,
+        "EGFP amount": ch4_count_total,
+        # amounts normalized by DAPI amount per image:
+        "CHCHD2 amount normalized by DAPI": ch2_count_total_normalized,
+        "TOM-20 amount normalized by DAPI": ch3_count_total_normalized,
+        "EGFP amount normalized by DAPI": ch4_count_total_normalized,
+        # mean intensities of channels:
+        "DAPI intensity (mean)": ch1_mean_greater_than_zero,
+        "CHCHD2 intensity (mean)": ch2_mean_greater_than_zero,
+        "TOM-20 intensity (mean)": ch3_mean_greater_than_zero,
+        "EGFP intensity (mean)": ch4_mean_greater_than_zero,
+        # mean intensities of channels in the CHCHD2-TOM20 colocalization mask:
+        "CHCHD2 mean intensity (colocalized with DAPI)": ch1_crossover_mean,
+        "CHCHD2 mean intensity (colocalized with TOM-20)": ch2_crossover_mean,
+        "TOM-20 mean intensity (colocalized with CHCHD2)": ch3_crossover_mean,
+        # Colocalization percentages:
+        "DAPI colocalized with CHCHD2 (Coverage in %)": percentage_of_ch1_in_chchd2,
+        "CHCHD2 colocalized with DAPI (Coverage in %)": percentage_of_ch2_in_dapi,
+        "CHCHD2 colocalized with TOM-20 (Coverage in %)": percentage_of_ch2_in_chchd2_and_tom20,
+        "TOM-20 colocalized with CHCHD2 (Coverage in %)": percentage_of_ch3_in_chchd2_and_tom20,
+        # amounts normalized by mito amount per cell, that are colocalized with TOM-20:
+        "CHCHD2 amount per cell (colocalized with TOM-20)": amount_per_cell_approximation_ch2_in_mask,
+        "CHCHD2 amount per mito (colocalized with TOM-20)": amount_per_mito_approximation_ch2_in_mask,
+        "CHCHD2 intensity per cell (colocalized with TOM-20)": intensity_per_cell_approximation_ch2_in_mask,
+        "CHCHD2 intensity per mito (colocalized with TOM-20)": intensity_per_mito_approximation_ch2_in_mask,
+        # Additional information:
+        "Gaussian filter": gaussian_filter,
+        "Threshold type": threshold_mode,
+    }
+
+# Columns of the object quantification table (without "Condition", "Cell line" and "Image key")
+object_columns = [
+    "File name", "Object", "Object type", "Area", "Centroid x", "Centroid y",
+    "DAPI amount", "CHCHD2 amount", "TOM-20 amount", "EGFP amount",
+    "DAPI intensity (mean)", "CHCHD2 intensity (mean)", "TOM-20 intensity (mean)", "EGFP intensity (mean)",
+    "CHCHD2 amount (colocalized with TOM-20)", "CHCHD2 mean intensity (colocalized with TOM-20)",
+    "CHCHD2 colocalized with TOM-20 (Coverage in %)", "TOM-20 colocalized with CHCHD2 (Coverage in %)",
+    "Gaussian filter", "Threshold type",
+]
+
+# Label the nuclei: connected components of the DAPI signal, components smaller than `min_area` are removed
+# return: label image (0 = background, 1..n = nuclei)
+def label_nuclei(dapi, min_area=min_object_area):
+    _, labels, stats, _ = cv2.connectedComponentsWithStats((dapi > 0).view(np.uint8), connectivity=8, ltype=cv2.CV_32S)
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+    keep[0] = False
+    # consecutive labels for the remaining nuclei
+    new_labels = np.cumsum(keep, dtype=np.int32) * keep
+    return new_labels[labels]
+
+# Measurements of every object of a label image, each one a single labeled reduction over the pixels of all objects
+# input: the four channels in the order of the file names (c00, c01, c02, c03), label image (0 = background)
+# return: columns of the object quantification table (arrays with one value per object), objects without pixels are left out
+def quantify_objects(ch1, ch2, ch3, ch4, labels, file, object_type, gaussian_filter=False, threshold_mode=""):
+    channels = swap_egfp_and_chchd2(ch1, ch2, ch3, ch4)
+    # only the pixels of the objects are used
+    pixels = np.flatnonzero(labels)
+    object_labels = labels.reshape(-1)[pixels].astype(np.intp)
+    n_labels = int(object_labels.max()) + 1 if object_labels.size else 1
+    def labeled_sum(weights=None):
+        return np.bincount(object_labels, weights=weights, minlength=n_labels)
+
+    area = labeled_sum()
+    rows, cols = np.divmod(pixels, labels.shape[1])
+    centroid_x = labeled_sum(cols) / np.maximum(area, 1)
+    centroid_y = labeled_sum(rows) / np.maximum(area, 1)
+
+    values = [channel.reshape(-1)[pixels] for channel in channels]
+    signals = [value > 0 for value in values]
+    amounts = [labeled_sum(signal) for signal in signals]
+    # the channels are thresholded, so the sum over all pixels is the sum over the pixels with signal
+    means = [labeled_sum(value.astype(np.float64)) / np.where(amount > 0, amount, np.nan) for value, amount in zip(values, amounts)]
+    # Channel indices: 0 = DAPI, 1 = CHCHD2, 2 = TOM-20, 3 = EGFP
+    colocalized = signals[1] & signals[2]
+    colocalized_amount = labeled_sum(colocalized)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        colocalized_mean = labeled_sum(np.where(colocalized, values[1], 0).astype(np.float64)) / colocalized_amount
+        chchd2_coverage = colocalized_amount / amounts[1] * 100
+        tom20_coverage = colocalized_amount / amounts[2] * 100
+
+    objects = np.flatnonzero(area)
+    objects = objects[objects > 0]
+    return {
+        "File name": os.path.basename(file),
+        "Object": objects,
+        "Object type": object_type,
+        "Area": area[objects],
+        "Centroid x": centroid_x[objects],
+        "Centroid y": centroid_y[objects],
+        "DAPI amount": amounts[0][objects], "CHCHD2 amount": amounts[1][objects], "TOM-20 amount": amounts[2][objects], "EGFP amount": amounts[3][objects],
+        "DAPI intensity (mean)": means[0][objects], "CHCHD2 intensity (mean)": means[1][objects], "TOM-20 intensity (mean)": means[2][objects], "EGFP intensity (mean)": means[3][objects],
+        "CHCHD2 amount (colocalized with TOM-20)": colocalized_amount[objects],
+        "CHCHD2 mean intensity (colocalized with TOM-20)": colocalized_mean[objects],
+        "CHCHD2 colocalized with TOM-20 (Coverage in %)": chchd2_coverage[objects],
+        "TOM-20 colocalized with CHCHD2 (Coverage in %)": tom20_coverage[objects],
+        "Gaussian filter": gaussian_filter,
+        "Threshold type": threshold_mode,
+    }
+
+# Data types of the columns of the quantification table
+# The raw amounts are pixel counts, the remaining measurements are floats (NaN if undefined)
+quantification_column_dtypes = {column: np.float64 for column in quantification_columns}
+quantification_column_dtypes.update({
+    "File name": object,
+    "DAPI amount": np.int64, "CHCHD2 amount": np.int64, "TOM-20 amount": np.int64, "EGFP amount": np.int64,
+    "Gaussian filter": np.bool_,
+    "Threshold type": object,
+    "Condition": object,
+    "Cell line": object,
+    "Image key": object,
+})
+quantification_column_dtypes.update({column: np.int64 for column in randomization_columns if column.startswith("Costes randomizations")})
+object_column_dtypes = {column: np.float64 for column in object_columns}
+object_column_dtypes.update({
+    "File name": object, "Object": np.int64, "Object type": object, "Area": np.int64,
+    "DAPI amount": np.int64, "CHCHD2 amount": np.int64, "TOM-20 amount": np.int64, "EGFP amount": np.int64,
+    "CHCHD2 amount (colocalized with TOM-20)": np.int64,
+    "Gaussian filter": np.bool_,
+    "Threshold type": object,
+    "Condition": object,
+    "Cell line": object,
+    "Image key": object,
+})
+
+# Path of the quantification table of a treatment folder
+# table: "quantification" or "object_quantification"
+def get_quantification_file_name(pic_folder_path, results_format=results_format, table="quantification"):
+    if results_format == "parquet" and pq is None:
+        results_format = "csv"
+    return os.path.join(pic_folder_path, table + "." + results_format)
+
+# Read a quantification table, e.g. to plot it
+def load_quantification_df(file_name):
+    if file_name.endswith(".parquet"):
+        return pd.read_parquet(file_name)
+    # the exact values, so the rows reused from the table match recomputed ones
+    return pd.read_csv(file_name, float_precision="round_trip")
+
+# Collects the rows of the quantification table in preallocated, typed column arrays and writes them
+# chunk by chunk to the table file, instead of keeping every value in Python lists until the end.
+# Parquet: every chunk becomes a row group. CSV: every chunk gets appended to the file.
+# The file is written next to the final one and only replaces it in `close()`.
+# append: keep the rows of an already existing table and add the new ones
+# columns, column_dtypes: of another table, e.g. `object_columns` and `object_column_dtypes`
+class QuantificationTable:
+    def __init__(self, file_name, treatment_var, chunk_rows=1024, append=False, export_csv=False, columns=quantification_columns, column_dtypes=quantification_column_dtypes):
+        self.file_name = file_name
+        self.treatment_var = treatment_var
+        self.chunk_rows = chunk_rows
+        self.export_csv = export_csv
+        self.columns = columns + ["Condition", "Cell line", "Image key"]
+        self.column_dtypes = column_dtypes
+        self.is_parquet = file_name.endswith(".parquet")
+        self.temporary_file_name = file_name + ".tmp"
+        self.writer = None
+        self.rows_written = 0
+        self.chunk = {column: np.empty(chunk_rows, dtype=self.column_dtypes[column]) for column in self.columns}
+        self.chunk_length = 0
+        if append and os.path.isfile(file_name):
+            previous_df = load_quantification_df(file_name)
+            if "Image key" not in previous_df:
+                previous_df["Image key"] = ""
+            self.write_chunk(previous_df[self.columns])
+
+    def __len__(self):
+        return self.rows_written + self.chunk_length
+
+    # Add one row of `quantification_row()`
+    def append(self, row):
+        row = dict(row, **{"Condition": self.treatment_var, "Cell line": image_catalog.cell_line_from_file_name(row["File name"])})
+        row.setdefault("Image key", "")
+        for column in self.columns:
+            self.chunk[column][self.chunk_length] = row[column]
+        self.chunk_length += 1
+        if self.chunk_length == self.chunk_rows:
+            self.flush()
+
+    # Add several rows at once, e.g. the columns of `quantify_objects()` or the rows of a previous table
+    # input: {column: array or single value for all rows}, number of rows
+    def extend(self, columns, n_rows):
+        file_names = columns["File name"]
+        columns = dict(columns, **{
+            "Condition": self.treatment_var,
+            "Cell line": image_catalog.cell_line_from_file_name(file_names) if isinstance(file_names, str) else np.array([image_catalog.cell_line_from_file_name(file_name) for file_name in file_names], dtype=object),
+        })
+        columns.setdefault("Image key", "")
+        start = 0
+        while start < n_rows:
+            length = min(n_rows - start, self.chunk_rows - self.chunk_length)
+            for column in self.columns:
+                value = columns[column]
+                self.chunk[column][self.chunk_length:self.chunk_length + length] = value if np.isscalar(value) else value[start:start + length]
+            self.chunk_length += length
+            start += length
+            if self.chunk_length == self.chunk_rows:
+                self.flush()
+
+    def chunk_df(self):
+        return pd.DataFrame({column: self.chunk[column][:self.chunk_length] for column in self.columns})
+
+    def write_chunk(self, df):
+        if self.is_parquet:
+            table = pa.Table.from_pandas(df, schema=self.schema(), preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.temporary_file_name, table.schema)
+            self.writer.write_table(table)
+        else:
+            df.to_csv(self.temporary_file_name, mode="a" if self.rows_written else "w", header=not self.rows_written, index=False)
+        self.rows_written += len(df)
+
+    def flush(self):
+        if self.chunk_length:
+            self.write_chunk(self.chunk_df())
+            self.chunk_length = 0
+
+    def schema(self):
+        types = {np.int64: pa.int64(), np.float64: pa.float64(), np.bool_: pa.bool_(), object: pa.string()}
+        return pa.schema([(column, types[self.column_dtypes[column]]) for column in self.columns])
+
+    # Write the remaining rows and replace the table file
+    # return: the table as dataframe, read from the written file
+    def close(self):
+        self.flush()
+        if self.rows_written == 0:
+            # write the header / schema of an empty table
+            self.write_chunk(self.chunk_df())
+        if self.writer is not None:
+            self.writer.close()
+        os.replace(self.temporary_file_name, self.file_name)
+        quantification_df = load_quantification_df(self.file_name)
+        if self.export_csv and self.is_parquet:
+            quantification_df.to_csv(self.file_name.replace(".parquet", ".csv"), index=False)
+        return quantification_df
+
+# State of the incremental quantification of a treatment folder:
+#  "hashes": {file: [size, modification time, sha1]}, "empty": keys of images without DAPI signal
+def get_quantification_state_file_name(pic_folder_path):
+    return os.path.join(pic_folder_path, "quantification_state.json")
+
+def load_quantification_state(pic_folder_path):
+    state_file_name = get_quantification_state_file_name(pic_folder_path)
+    if os.path.isfile(state_file_name):
+        with open(state_file_name) as f:
+            return json.load(f)
+    return {"hashes": {}, "empty": []}
+
+def save_quantification_state(pic_folder_path, state):
+    state_file_name = get_quantification_state_file_name(pic_folder_path)
+    with open(state_file_name + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_file_name + ".tmp", state_file_name)
+
+# Key of a row of the quantification table: content of the input files and all parameters that change the row
+# channel_files: result of `get_channel_file_names()`, if the channels were looked up already
+def image_key(file_name, parameters, hashes, roi_mask=False, object_level=None, channel_files=None):
+    input_files = list(channel_files or get_channel_file_names(file_name))
+    if roi_mask:
+        input_files.append(str(get_roi_mask_name(file_name)))
+    if object_level == "annotations":
+        input_files.append(str(get_roi_mask_name(file_name, "_labels.tiff")))
+    key = hashlib.sha1(json.dumps(parameters, sort_keys=True).encode())
+    for input_file in input_files:
+        key.update(os.path.basename(input_file).encode())
+        key.update(build_manifest.file_hash(input_file, hashes).encode())
+    return key.hexdigest()
+
+# Rows of the previous quantification table by their "Image key"
+def previous_quantification_rows(file_name):
+    if not os.path.isfile(file_name):
+        return {}
+    previous_df = load_quantification_df(file_name)
+    if "Image key" not in previous_df:
+        return {}
+    return {row["Image key"]: row for row in previous_df.to_dict("records") if row["Image key"]}
+
+# Rows of the previous object quantification table by their "Image key"
+# return: {key: {column: array}}
+def previous_object_rows(file_name):
+    if not os.path.isfile(file_name):
+        return {}
+    previous_df = load_quantification_df(file_name)
+    if "Image key" not in previous_df:
+        return {}
+    return {key: {column: rows[column].to_numpy() for column in rows} for key, rows in previous_df.groupby("Image key", sort=False) if key}
+
+# Label image of the objects of an image set, see `object_level`
+def read_object_labels(file_name, ch1, object_level):
+    if object_level == "nuclei":
+        return label_nuclei(ch1, min_object_area)
+    if object_level == "annotations":
+        return image_io.read_channel(str(get_roi_mask_name(file_name, "_labels.tiff")))
+    raise ValueError(f"Unknown object level: {object_level}")
+
+# object_level: also quantify every object, see `object_level` above
+def calculate_mean_intensity_of_2_markers(pic_folder_path, treatment_var="normal", threshold_mode="triangle_on_dapi_intensity_greater_1_on_rest", gaussian_filter=False, save_mask=False, roi_mask=False, roi_cropping=False, results_format=results_format, incremental=False, object_level=None):
+    quantification_file_name = get_quantification_file_name(pic_folder_path, results_format)
+    object_file_name = get_quantification_file_name(pic_folder_path, results_format, "object_quantification")
+    if incremental:
+        previous_rows = previous_quantification_rows(quantification_file_name)
+        previous_objects = previous_object_rows(object_file_name) if object_level else {}
+        state = load_quantification_state(pic_folder_path)
+        empty_image_keys = set(state["empty"])
+        parameters = {
+            "threshold_mode": threshold_mode, "gaussian_filter": gaussian_filter, "roi_mask": roi_mask,
+            "channels": [ch_prefix, ch1_suffix, ch2_suffix, ch3_suffix, ch4_suffix],
+        }
+        # the objects get quantified again when the object level changes
+        if object_level:
+            parameters.update({"object_level": object_level, "min_object_area": min_object_area if object_level == "nuclei" else None})
+        if quantify_coefficients:
+            parameters["coefficient_channel_pairs"] = coefficient_channel_pairs
+        if randomization_test:
+            parameters.update({"randomization_channel_pairs": randomization_channel_pairs, "randomization_shuffles": randomization_shuffles, "randomization_block_size": randomization_block_size})
+        if quantify_distance_colocalization:
+            parameters.update({"distance_channel_pairs": distance_channel_pairs, "colocalization_distances": colocalization_distances})
+        reused_rows = 0
+
+    # All values of interest, one row per image:
+    table = QuantificationTable(quantification_file_name, treatment_var, export_csv=export_csv)
+    # and one row per object:
+    if object_level:
+        object_table = QuantificationTable(object_file_name, treatment_var, export_csv=export_csv, columns=object_columns, column_dtypes=object_column_dtypes)
+
+    crop_rois = roi_mask and roi_cropping and not object_level
+    # Runs in the prefetching threads: hash the files and read the images, unless the row can be reused.
+    # The channel files were looked up in the main thread, so the threads never (re)build the index of a folder.
+    # input: (first channel, channel files) of `get_image_sets()`
+    # return: (key of the row, channels or crops of the image set; None if the image set gets skipped)
+    def load_image_set(image_set_files):
+        file, channel_files = image_set_files
+        key = image_key(file, parameters, state["hashes"], roi_mask, object_level, channel_files) if incremental else None
+        if incremental and (key in previous_rows or key in empty_image_keys):
+            return key, None
+        if crop_rois:
+            return key, read_roi_crops(file, channel_files)
+        channels = read_4_color_channels_from_greyscale(file, save_mask=save_mask, roi_mask=roi_mask, in_memory=True, channel_files=channel_files)
+        labels = read_object_labels(file, channels[0], object_level) if object_level else None
+        roi = read_roi(file) if roi_mask and (quantify_coefficients or randomization_test) else None
+        return key, (channels, labels, roi)
+
+    # The randomization tests run in a pool of processes, their rows wait in `pending` (in the order of the images)
+    # until their tests are done. At most a few images per process wait, so the images don't pile up in memory.
+    executor = ProcessPoolExecutor(max_workers=randomization_workers) if randomization_test else None
+    pending = deque()
+    def append_finished_rows(max_pending=0):
+        while pending and (len(pending) > max_pending or all(future.done() for _, future in pending[0][1])):
+            row, futures = pending.popleft()
+            for columns, future in futures:
+                row.update(zip(columns, future.result()))
+            table.append(row)
+
+    try:
+        for cell_line_folder in cell_line_list:
+            cell_line_folder_path = os.path.join(pic_folder_path, cell_line_folder)
+            image_sets = get_image_sets(cell_line_folder_path + "_thresholded_" + threshold_mode, roi_mask)
+            for (file, _), (key, image_set) in tqdm(image_io.prefetched(image_sets.items(), load_image_set, prefetch_image_sets, io_threads), total=len(image_sets), desc="Counting pixels for " + cell_line_folder):
+                # img = read_bmp(file)
+
+                if incremental:
+                    if key in previous_rows:
+                        pending.append((previous_rows[key], []))
+                        if key in previous_objects:
+                            object_table.extend(previous_objects[key], len(previous_objects[key]["Object"]))
+                        reused_rows += 1
+                        continue
+                    if key in empty_image_keys:
+                        continue
+
+                if crop_rois:
+                    row = quantify_roi_crops(file, gaussian_filter, threshold_mode, crops=image_set, save_mask=save_mask)
+                    if row is not None and randomization_test:
+                        randomization_channels = roi_crop_images(*image_set)
+                        rows, cols = roi_bands_bounding_box(image_set[1])
+                        randomization_roi = image_set[0][rows, cols] > 0
+                else:
+                    (ch1, ch2, ch3, ch4), labels, roi = image_set
+                    row = quantify_channels(ch1, ch2, ch3, ch4, file, gaussian_filter, threshold_mode, roi)
+                    if row is not None and randomization_test:
+                        rows, cols = roi_bounding_box(roi)
+                        randomization_channels = [channel[rows, cols] for channel in swap_egfp_and_chchd2(ch1, ch2, ch3, ch4)]
+                        randomization_roi = None if roi is None else roi[rows, cols]
+                    if object_level and row is not None:
+                        objects = quantify_objects(ch1, ch2, ch3, ch4, labels, file, object_level, gaussian_filter, threshold_mode)
+                        objects["Image key"] = key or ""
+                        object_table.extend(objects, len(objects["Object"]))
+                if incremental:
+                    if row is None:
+                        empty_image_keys.add(key)
+                    else:
+                        row["Image key"] = key
+                # if image is empty / no Signal on ch1 (DAPI), skip the image
+                if row is not None:
+                    futures = []
+                    if randomization_test:
+                        futures = [(columns, executor.submit(colocalization_coefficients.randomization_test, *arguments)) for columns, arguments in randomization_jobs(randomization_channels, file, randomization_roi)]
+                    pending.append((row, futures))
+                append_finished_rows(2 * randomization_workers)
+
+        append_finished_rows()
+    finally:
+        # also if a quantification fails, the pending tests are cancelled
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    # Save the table
+    quantification_df = table.close()
+    if object_level:
+        object_df = object_table.close()
+        print(f"Quantified {len(object_df)} objects ({object_level}) in {len(quantification_df)} images")
+    if incremental:
+        state["empty"] = sorted(empty_image_keys)
+        save_quantification_state(pic_folder_path, state)
+        print(f"Reused {reused_rows} of {len(quantification_df)} rows of the previous quantification")
+    return quantification_df
 
-    mean_intensities_ch1 = []
-    mean_intensities_ch2 = []
-    mean_intensities_ch3 = []
-    mean_intensities_ch4 = []
+# Threshold and quantify the raw images of all cell lines of a treatment without reading the thresholded images back from disk
+# threshold_mode: "<mode of thresholding.py>_<additional background substraction>", e.g. "otsu_triangle_otsu_triangle_gauss_False"
+# save_thresholded_images: also write the thresholded images, like `thresholding.thresholding()` does
+def fused_quantification(pic_folder_path, treatment_var="normal", threshold_mode="otsu_triangle_otsu_triangle_gauss_False", gaussian_filter=False, save_mask=False, roi_mask=False, save_thresholded_images=False, background_method="rolling_ball", results_format=results_format):
+    mode, additional_background_substraction = threshold_mode.rsplit("_", 1)
+    additional_background_substraction = additional_background_substraction == "True"
+    thresholds = None
+    if mode in thresholding.global_threshold_methods:
+        thresholds = thresholding.global_thresholds(pic_folder_path, cell_line_list, mode, gaussian_filter, additional_background_substraction, background_method=background_method)
+    # "background_filtered_combo" always substracts the background
+    background_substraction = additional_background_substraction or mode == "background_filtered_combo"
+
+    table = QuantificationTable(get_quantification_file_name(pic_folder_path, results_format), treatment_var, export_csv=export_csv)
+    for cell_line_folder in cell_line_list:
+        cell_line_folder_path = os.path.join(pic_folder_path, cell_line_folder)
+        thresholded_folder_path = cell_line_folder_path + "_thresholded_" + threshold_mode
+        if save_thresholded_images:
+            os.makedirs(thresholded_folder_path, exist_ok=True)
 
-    mean_intensities_ch2_at_dapi = []
-    mean_intensities_ch2_in_mask = []
-    mean_intensities_ch3_in_mask = []
-    mean_intensities_ch4_in_mask = []
+        for raw_file in tqdm(thresholding.get_image_set_files(cell_line_folder_path), desc="Thresholding and counting pixels for " + cell_line_folder):
+            # the thresholded file name is used to find the ROI mask and in the table, like in the two-step pipeline
+            file = os.path.join(thresholded_folder_path, thresholding.get_thresholded_file_name(raw_file, mode, background_substraction))
 
-    percentages_ch1_in_chchd2 = []
-    percentages_ch2_in_dapi = []
-    percentages_ch2_in_chchd2_and_tom20 = []
-    percentages_ch3_in_chchd2_and_tom20 = []
+            ch1, ch2, ch3, ch4 = thresholding.read_4_color_channels_from_rgb(raw_file)
+            ch1, ch2, ch3, ch4 = thresholding.preprocess_channels(ch1, ch2, ch3, ch4, gaussian_filter, background_substraction, background_method=background_method)
+            ch1, ch2, ch3, ch4 = thresholding.apply_threshold_mode(ch1, ch2, ch3, ch4, mode, thresholds)
 
-    amounts_per_cell_approximation_ch2_in_mask = []
-    amounts_per_mito_approximation_ch2_in_mask = []
-    intensities_per_cell_approximation_ch2_in_mask = []
-    intensities_per_mito_approximation_ch2_in_mask = []
+            if save_thresholded_images:
+                thresholding.write_thresholded_images(thresholding.get_thresholded_file_names(raw_file, thresholded_folder_path, mode, background_substraction), (ch1, ch2, ch3, ch4))
 
-    gaussian_filters = []
-    threshold_types = []
+            roi = None
+            if roi_mask:
+                # the masks are named after the thresholded images, like in the two-step pipeline
+                ch1, ch2, ch3, ch4 = apply_roi_mask(ch1, ch2, ch3, ch4, file, save_mask=save_mask)
+                roi = read_roi(file) if quantify_coefficients or randomization_test else None
 
-    # change the working directory to the folder, where the thresholded images are stored:
+            row = quantify_channels(ch1, ch2, ch3, ch4, file, gaussian_filter, threshold_mode, roi)
+            if row is not None and randomization_test:
+                rows, cols = roi_bounding_box(roi)
+                for columns, arguments in randomization_jobs([channel[rows, cols] for channel in swap_egfp_and_chchd2(ch1, ch2, ch3, ch4)], file, None if roi is None else roi[rows, cols]):
+                    row.update(zip(columns, colocalization_coefficients.randomization_test(*arguments)))
+            if row is not None:
+                table.append(row)
 
-    for cell_line_folder in cell_line_list:
-        os.chdir(pic_folder_path + "/" + cell_line_folder + "_thresholded_" + threshold_mode)
-        cell_line_folder_path = os.path.join(pic_folder_path, cell_line_folder)
-        for file in tqdm(glob.glob(cell_line_folder_path + "_thresholded_" + threshold_mode + "/*" + ch_prefix + ch1_suffix + "*.tiff"), desc="Counting pixels for " + cell_line_folder):
-            # img = read_bmp(file)
-
-            ch1, ch2, ch3, ch4 = read_4_color_channels_from_greyscale(file, save_mask=save_mask, roi_mask=roi_mask)
-
-            # NOTE: swap ch2 and ch4 , because original ch2 is EGFP and ch4 is CHCHD2 in this case. 
-            # so let's swap and just add egfp as ch4 to the analysis 
-            ch2, ch4 = ch4, ch2
-
-            # Split the image into its three channels and create the colocalization mask:
-            mask_chchd2_and_tom20_bin = create_mask(ch2, ch3, file, save_mask=False)
-            # Create a mask, where Dapi and CHCHD2 are colocalized
-            dapi_chchd2_mask = cv2.bitwise_and(ch1, ch2)
-            dapi_chchd2_mask = dapi_chchd2_mask > 0
-
-            # How many pixles of a color channel have intensity > 0?
-            # NOTE: This required the image to be thresholded and checked before
-            ch1_count_total = ch1[ch1 > 0].size 
-            ch2_count_total = ch2[ch2 > 0].size
-            ch3_count_total = ch3[ch3 > 0].size
-            ch4_count_total = ch4[ch4 > 0].size
-
-            # if image is empty / no Signal on ch1 (DAPI), skip the image
-            if ch1_count_total == 0:
-                continue
-
-            # Normalize the amounts of each marker by the total amount of DAPI-pixels
-            # aka normalizing by nuclei area
-            ch2_count_total_normalized = ch2_count_total / ch1_count_total
-            ch3_count_total_normalized = ch3_count_total / ch1_count_total
-            ch4_count_total_normalized = ch4_count_total / ch1_count_total
-
-            # Get mean intensities of each channel
-            ch1_mean_greater_than_zero = ch1[ch1 > 0].mean()
-            ch2_mean_greater_than_zero = ch2[ch2 > 0].mean()
-            ch3_mean_greater_than_zero = ch3[ch3 > 0].mean()
-            ch4_mean_greater_than_zero = ch4[ch4 > 0].mean()
-
-            # Get amount of all values > 0 that are colocalized
-            ch2_count_in_mask = ch2[mask_chchd2_and_tom20_bin].size
-            ch3_count_in_mask = ch3[mask_chchd2_and_tom20_bin].size
-            ch1_count_at_chchd2 = ch1[dapi_chchd2_mask].size # same would be: ch1[(ch2 > 0) & (ch1 > 0)].size                                          
-            ch2_count_at_dapi = ch2[dapi_chchd2_mask].size
-
-            # Calculate the percentage of ch1, ch2, and ch3 that are in chchd2_and_tom20
-            percentage_of_ch1_in_chchd2 = ch1_count_at_chchd2 / ch1_count_total * 100
-            percentage_of_ch2_in_dapi = ch2_count_at_dapi / ch2_count_total * 100
-            percentage_of_ch2_in_chchd2_and_tom20 = ch2_count_in_mask / ch2_count_total * 100
-            percentage_of_ch3_in_chchd2_and_tom20 = ch3_count_in_mask / ch3_count_total * 100
-
-            # Mean-intensity of the pixel values of a channel, that are not black and lay within in the mask
-            ch1_crossover_mean = ch1[mask_chchd2_and_tom20_bin & (ch1 > 0)].mean()
-            ch2_at_dapi_mean = ch2[dapi_chchd2_mask].mean()
-            ch2_crossover_mean = ch2[mask_chchd2_and_tom20_bin].mean()
-            ch3_crossover_mean = ch3[mask_chchd2_and_tom20_bin].mean()
-
-            # Per cell and per mitochondria approximation (ch3 should be TOM20)
-            # Area-wise approximation:
-            amount_per_cell_approximation_ch2_in_mask = ch2_count_in_mask / ch1_count_total
-            amount_per_mito_approximation_ch2_in_mask = ch2_count_in_mask / ch3_count_total
-            # Total intensity divided by cell-area approximation:
-            intensity_per_cell_approximation_ch2_in_mask = ch2[mask_chchd2_and_tom20_bin].sum() / ch1_count_total
-            intensity_per_mito_approximation_ch2_in_mask = intensity_per_cell_approximation_ch2_in_mask * ch1_count_total / ch3_count_total
-
-            # Append the values to the lists:
-            file_names.append(os.path.basename(file))
-
-            ch1_counts_total.append(ch1_count_total)
-            ch2_counts_total.append(ch2_count_total)
-            ch3_counts_total.append(ch3_count_total) 
-            ch4_counts_total.append(ch4_count_total)
-            ch2_counts_total_normalized.append(ch2_count_total_normalized)
-            ch3_counts_total_normalized.append(ch3_count_total_normalized)
-            ch4_counts_total_normalized.append(ch4_count_total_normalized)
-
-            mean_intensities_ch1.append(ch1_mean_greater_than_zero)
-            mean_intensities_ch2.append(ch2_mean_greater_than_zero)
-            mean_intensities_ch3.append(ch3_mean_greater_than_zero)
-            mean_intensities_ch4.append(ch4_mean_greater_than_zero)
-            mean_intensities_ch2_at_dapi.append(ch1_crossover_mean)
-            mean_intensities_ch2_in_mask.append(ch2_crossover_mean)
-            mean_intensities_ch3_in_mask.append(ch3_crossover_mean)
-            percentages_ch1_in_chchd2.append(percentage_of_ch1_in_chchd2)
-            percentages_ch2_in_dapi.append(percentage_of_ch2_in_dapi)
-            percentages_ch2_in_chchd2_and_tom20.append(percentage_of_ch2_in_chchd2_and_tom20)
-            percentages_ch3_in_chchd2_and_tom20.append(percentage_of_ch3_in_chchd2_and_tom20)
-            amounts_per_cell_approximation_ch2_in_mask.append(amount_per_cell_approximation_ch2_in_mask)
-            amounts_per_mito_approximation_ch2_in_mask.append(amount_per_mito_approximation_ch2_in_mask)
-            intensities_per_cell_approximation_ch2_in_mask.append(intensity_per_cell_approximation_ch2_in_mask)
-            intensities_per_mito_approximation_ch2_in_mask.append(intensity_per_mito_approximation_ch2_in_mask)
-            gaussian_filters.append(gaussian_filter)
-            threshold_types.append(threshold_mode)
-
-    # Create a dataframe with all obtained values to save it as a `csv file` and plot it with seaborn:
-    quantification_df = pd.DataFrame({
-                        "File name": file_names,
-                        # raw amounts:
-                        "DAPI amount": ch1_counts_total,
-                        "CHCHD2 amount": ch2_counts_total,
-                        "TOM-20 amount": ch3_counts_total,
-                        "EGFP amount": ch4_counts_total,
-                        # amounts normalized by DAPI amount per image:
-                        "CHCHD2 amount normalized by DAPI": ch2_counts_total_normalized,
-                        "TOM-20 amount normalized by DAPI": ch3_counts_total_normalized,
-                        "EGFP amount normalized by DAPI": ch4_counts_total_normalized,
-                        # mean intensities of channels:
-                        "DAPI intensity (mean)": mean_intensities_ch1,
-                        "CHCHD2 intensity (mean)": mean_intensities_ch2,
-                        "TOM-20 intensity (mean)": mean_intensities_ch3,
-                        "EGFP intensity (mean)": mean_intensities_ch4,
-                        # mean intensities of channels in the CHCHD2-TOM20 colocalization mask:
-                        "CHCHD2 mean intensity (colocalized with DAPI)": mean_intensities_ch2_at_dapi,
-                        "CHCHD2 mean intensity (colocalized with TOM-20)": mean_intensities_ch2_in_mask,
-                        "TOM-20 mean intensity (colocalized with CHCHD2)": mean_intensities_ch3_in_mask,
-                        # Colocalization percentages:
-                        "DAPI colocalized with CHCHD2 (Coverage in %)": percentages_ch1_in_chchd2,
-                        "CHCHD2 colocalized with DAPI (Coverage in %)": percentages_ch2_in_dapi,
-                        "CHCHD2 colocalized with TOM-20 (Coverage in %)": percentages_ch2_in_chchd2_and_tom20,
-                        "TOM-20 colocalized with CHCHD2 (Coverage in %)": percentages_ch3_in_chchd2_and_tom20,
-                        # amounts normalized by mito amount per cell, that are colocalized with TOM-20:
-                        "CHCHD2 amount per cell (colocalized with TOM-20)": amounts_per_cell_approximation_ch2_in_mask,
-                        "CHCHD2 amount per mito (colocalized with TOM-20)": amounts_per_mito_approximation_ch2_in_mask,
-                        "CHCHD2 intensity per cell (colocalized with TOM-20)": intensities_per_cell_approximation_ch2_in_mask,
-                        "CHCHD2 intensity per mito (colocalized with TOM-20)": intensities_per_mito_approximation_ch2_in_mask,
-                        # Additional information:
-                        "Gaussian filter": gaussian_filters,
-                        "Threshold type": threshold_types,
-                        "Condition": treatment_var
-                        })
-
-    # Additional information: 
-    # Get the cell line from the file name
-    # TODO FIXME NOTE:
-    # change this for the different file name structures to use this script with different data sets
-    # quantification_df["Cell line"] = quantification_df["File name"].str.split("_", expand=True)[2] #organoids or NPCs new
-    quantification_df["Cell line"] = quantification_df["File name"].str.split("_", expand=True)[0]
-
-    # Save the dataframe to a csv file
-    quantification_df.to_csv(pic_folder_path + "/quantification.csv", index=False)
-    return quantification_df
+    return table.close()
 
 # Run the quantification function
 #quantification_df = calculate_mean_intensity_of_2_markers(pic_folder_path, treatment_var="normal", gaussian_filter=gauss_blur_filter, threshold_mode=threshold_mode, save_mask=save_mask_as_bmp)
@@ -326,66 +1154,83 @@ def sort_df_by_cell_line(quantification_df):
     return quantification_df.sort_values(by=["cell_line"], inplace=True)
 #quantification_df_sorted = sort_df_by_cell_line(quantification_df)
 
+# Keyword arguments of `box_plots.render_box_plot()` for the boxplot of a single value of the quantification dataframe
+# statistics_df: table of `pairwise_statistics.pairwise_tests()`, its adjusted p-values are shown for all pairs of cell lines
+def box_plot_job(quantification_df, value_to_plot, pic_folder_path, condition, statistics_df=None):
+    box_pairs, p_values = pairwise_statistics.annotation_pairs(statistics_df, value_to_plot, condition) if statistics_df is not None else ([], [])
+    return {
+        "data": quantification_df[["Cell line", value_to_plot]],
+        "x": "Cell line",
+        "y": value_to_plot,
+        "file_name": pic_folder_path + "/ttestwelchplot_" + value_to_plot + "_" + condition + ".png",
+        "order": [cell_line for cell_line in cell_line_list if cell_line in set(quantification_df["Cell line"])],
+        # the p-values are already corrected for multiple testing
+        "box_pairs": box_pairs,
+        "p_values": p_values,
+        "test_short_name": statistics_test,
+    }
+
 # Plot the boxplots of the quantification dataframe with seaborn and save them as `.png files`
-def box_plt_by_cell_line(quantification_df, value_to_plot, pic_folder_path, condition, threshold_mode, show="True"):
-    plt.clf()
-    sns.set_theme(context="paper", style="whitegrid")
-
-    sns.catplot(x="Cell line",
-                y=value_to_plot,
-                kind="box",
-                legend=False,
-                height=7,
-                aspect=0.8,
-                data=quantification_df,
-                fliersize=0)
-
-    ax = sns.stripplot(x="Cell line",
-                        y=value_to_plot,
-                        data=quantification_df,
-                        jitter=True,
-                        dodge=True,
-                        marker='o',
-                        alpha=0.5,
-                        linewidth=0.5)
-
-    # TODO: Change the names of the cell lines to the correct ones
-    all_box_pairs = list(combinations(cell_line_list, 2))
-    # TODO: adjust the statistical test to the correct one. 
-    #       Mann-Whitney is used when the data is not normally distributed
-    #       t-welch-test is used when the data is normally distributed and the variances are not equal
-    #       t-test is used when the data is normally distributed and the variances are equal
-    add_stat_annotation(ax, data=quantification_df, x="Cell line", y=value_to_plot,
-                        box_pairs=all_box_pairs,
-                        test="t-test_welch", comparisons_correction="bonferroni", text_format="star", loc="outside", verbose=2)
-
-    plt.savefig(pic_folder_path + "/ttestwelchplot_" + value_to_plot + "_" + condition + ".png", bbox_inches='tight')
-    if show:
-        plt.show()
+def box_plt_by_cell_line(quantification_df, value_to_plot, pic_folder_path, condition, threshold_mode, show="True", statistics_df=None):
+    box_plots.render_box_plot(**box_plot_job(quantification_df, value_to_plot, pic_folder_path, condition, statistics_df))
     return
 
+# Render the boxplots of all values in a pool of processes, unchanged plots are skipped
+def plot_quantification(quantification_df, statistics_df, pic_folder_path, condition, metrics, n_workers=plot_workers):
+    jobs = [box_plot_job(quantification_df, metric, pic_folder_path, condition, statistics_df) for metric in metrics]
+    rendered = box_plots.render_box_plots(jobs, n_workers)
+    print(f"Rendered {rendered} of {len(jobs)} plots of \"{condition}\"")
+
+# Render the plots of every treatment from the saved quantification tables (and statistics tables)
+def plot_saved_quantification(treatment_list, n_workers=plot_workers):
+    for treatment in treatment_list:
+        pic_folder_path = os.path.join(wd, treatment)
+        quantification_file_name = get_quantification_file_name(pic_folder_path)
+        quantification_df = load_quantification_df(quantification_file_name)
+        metrics = list(quantification_df.select_dtypes(include=[float, int]).columns)
+        statistics_file_name = pairwise_statistics.get_statistics_file_name(quantification_file_name)
+        if os.path.isfile(statistics_file_name):
+            statistics_df = pairwise_statistics.load_table(statistics_file_name)
+        else:
+            statistics_df = pairwise_statistics.pairwise_tests(quantification_df, metrics, groups=cell_line_list, test=statistics_test, correction=statistics_correction)
+        plot_quantification(quantification_df, statistics_df, pic_folder_path, treatment, metrics, n_workers)
+
 # Run the calculation for every treatment of the list of treatments and append the results to the dataframe
 # Create plots for each treatment within its seperated folder
-def quantification(treatment_list, threshold_mode="triangle_on_dapi_intensity_greater_1_on_rest", gaussian_filter=False, save_mask=False, pic_folder_path=pic_folder_path, roi_mask=False):
+def quantification(treatment_list, threshold_mode="triangle_on_dapi_intensity_greater_1_on_rest", gaussian_filter=False, save_mask=False, pic_folder_path=pic_folder_path, roi_mask=False, fused_pipeline=False, roi_cropping=False, incremental=False, object_level=None):
+    if use_image_catalog:
+        # the folders are listed from the catalog from now on (see `dataset_index.py`)
+        catalog = image_catalog.ImageCatalog(wd, ch_prefix, [ch1_suffix, ch2_suffix, ch3_suffix, ch4_suffix])
+        catalog.refresh()
+        dataset_index.catalog = catalog
+
     # Loop through the treatments to quantify each treatment seperately
     complete_df = pd.DataFrame()
     for treatment in treatment_list:
         # Get the path of the folder containing the images
         pic_sub_folder_path = treatment
         pic_folder_path = os.path.join(wd, pic_sub_folder_path)
-        os.chdir(pic_folder_path)
         print(f"Calculating condition \"" + treatment + "\"")
 
-        current_quant_df = calculate_mean_intensity_of_2_markers(pic_folder_path, treatment_var=treatment, gaussian_filter=gaussian_filter, threshold_mode=threshold_mode, save_mask=save_mask, roi_mask=roi_mask)
+        if fused_pipeline:
+            current_quant_df = fused_quantification(pic_folder_path, treatment_var=treatment, gaussian_filter=gaussian_filter, threshold_mode=threshold_mode, save_mask=save_mask, roi_mask=roi_mask, save_thresholded_images=save_thresholded_images, background_method=background_method)
+        else:
+            current_quant_df = calculate_mean_intensity_of_2_markers(pic_folder_path, treatment_var=treatment, gaussian_filter=gaussian_filter, threshold_mode=threshold_mode, save_mask=save_mask, roi_mask=roi_mask, roi_cropping=roi_cropping, incremental=incremental, object_level=object_level)
         # add quant data to the complete dataframe
         complete_df = pd.concat([complete_df, current_quant_df], ignore_index=True)
 
-        for column in complete_df.select_dtypes(include=[float, int]):
-            box_plt_by_cell_line(current_quant_df, column, pic_folder_path, treatment, threshold_mode, show="False")
+        # Test every pair of cell lines for every metric at once, the plots only read the results
+        metrics = list(complete_df.select_dtypes(include=[float, int]).columns)
+        statistics_df = pairwise_statistics.pairwise_tests(current_quant_df, metrics, groups=cell_line_list, test=statistics_test, correction=statistics_correction)
+        pairwise_statistics.save_table(statistics_df, pairwise_statistics.get_statistics_file_name(get_quantification_file_name(pic_folder_path)))
+
+        plot_quantification(current_quant_df, statistics_df, pic_folder_path, treatment, metrics)
 
         print("########################################################################\n\n\n")
     return complete_df
 
 # Run the quantification function
-if __name__ == "__main__":
-    complete_df = quantification(treatment_list, threshold_mode, gaussian_filter=gauss_blur_filter, save_mask=save_mask_as_bmp, roi_mask=roi_mask)
+if __name__ == "__main__" and only_plots:
+    plot_saved_quantification(treatment_list)
+elif __name__ == "__main__":
+    complete_df = quantification(treatment_list, threshold_mode, gaussian_filter=gauss_blur_filter, save_mask=save_mask_as_bmp, roi_mask=roi_mask, fused_pipeline=fused_pipeline, roi_cropping=roi_cropping, incremental=incremental, object_level=object_level)
@@ -34,25 +34,99 @@ threshold_mode = "otsu_triangle_otsu_triangle_gauss"
 #  - "low_intensities_filtered"
 #  - "adaptive"
 #  - "background_filtered_combo"
+# Dataset-wide thresholds (same threshold for all images of folders_list, see below):
+#  - "global_otsu_triangle_otsu_triangle_gauss"
+#  - "global_otsu_otsu_otsu_otsu_gauss"
+#  - "global_otsu"
+#  - "global_triangle"
+
+# Global threshold modes and the method used for each channel (ch1, ch2, ch3, ch4).
+# The histograms of every channel are accumulated over all images of all folders in `folders_list` first,
+# then the thresholds are calculated from these merged histograms and applied to every image.
+# The histograms get saved in `wd`, so switching to another global mode doesn't need to read the images again.
+global_threshold_methods = {
+    "global_otsu_triangle_otsu_triangle_gauss": ("otsu", "triangle", "otsu", "triangle"),
+    "global_otsu_otsu_otsu_otsu_gauss": ("otsu", "otsu", "otsu", "otsu"),
+    "global_otsu": ("otsu", "otsu", "otsu", "otsu"),
+    "global_triangle": ("triangle", "triangle", "triangle", "triangle"),
+}
 
 # Set an additional Background Substraction with Rolling ball method 
 # for all methods that don't have it already
 # set to True to activate, or False to disable
-# Round2 images were too big to apply this method
+# Round2 images were too big to apply the exact method, use one of the fast ones below instead
 additional_background_substraction = False
 
+# Background substraction method:
+#  - "rolling_ball": exact rolling ball (skimage), very slow for 4096x3008 images
+#  - "downsampled_rolling_ball": rolling ball on a block-minimum downsampled image, then upsampled again
+#     (>100x faster with a shrink factor of 4, deviates only a few intensity levels from the exact method)
+#  - "tophat": morphological opening with an elliptical kernel of the same radius (OpenCV), flat instead of a ball
+background_method = "downsampled_rolling_ball"
+background_shrink_factor = 4
+
+# Print the deviation and speedup of the fast background method compared to the exact rolling ball?
+#  Measured once per run on a crop of the first image, the exact rolling ball takes about half a minute.
+report_background_deviation = False
+
 # Want to apply a gaussian blur filter too?
 # this affects the thresholding results and increases the overlap fluorecence signal
 gauss_blur_filter = True
+
+# Number of image sets that get thresholded at the same time (one process each).
+# Set to 1 to process the images one after another.
+# The CPU cores are split evenly between the workers, so the rolling ball and OpenCV threads
+# of all workers together don't use more threads than the machine has.
+n_workers = 1
+
+# With a single worker, the next image sets are read in background threads while the current one is thresholded,
+# and the thresholded images are written in background threads too.
+# Number of image sets that are read ahead (0 to read them one after another, like before):
+prefetch_image_sets = 2
+# Number of thresholded images that can wait for being written, before the thresholding waits for the writer:
+max_pending_writes = 8
+io_threads = 2
+
+# File format of the thresholded images (most of their pixels are 0 after the thresholding):
+#  - "tiff": uncompressed TIFF, as before
+#  - "compressed_tiff": tiled TIFF, compressed with `thresholded_compression`, the tiles are compressed in parallel
+#     "zlib" (deflate) can be opened by QuPath/ImageJ, "zstd" is smaller and faster but not supported everywhere
+#  - "sparse": `.npz file` with the positions and values of the nonzero pixels only, for the quantification
+#     (set `thresholded_file_format = ".npz"` in quantification_5_cell_lines.py), but not for QuPath
+thresholded_output_format = "tiff"
+thresholded_compression = "zlib"
+thresholded_tile_size = 256
+
+# Compare several threshold modes in one go instead of running the script once per mode.
+# Each mode gets its own `*_thresholded_{mode}_{bool}` folder as usual, but the blurred and background
+# substracted channels are only computed once per image set and kept in a memory-mapped cache on disk.
+# Leave the list empty to only run `threshold_mode`.
+threshold_mode_sweep = []
+# threshold_mode_sweep = ["otsu", "triangle", "otsu_triangle_otsu_triangle_gauss", "otsu_otsu_otsu_otsu_gauss", "global_otsu"]
+
+# Max. size of the preprocessing cache in bytes, the least recently used image sets get removed first
+preprocessing_cache_budget = 20 * 1024**3
+
+# Keep a catalog of all images of `wd` (`.image_catalog.sqlite`, see `image_catalog.py`)?
+# The folders are then listed from the catalog instead of the (network) drive, only changed folders get listed again.
+use_image_catalog = True
 # ----------------------------------------------------------------------------------------------- #
 
-import os, glob
+import os, sys, glob, time, json, hashlib
+from collections import OrderedDict
+import numpy as np
 import cv2
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import skimage.restoration as restoration
+# `build_manifest.py` is shared with the scripts of the parent folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import build_manifest
+import dataset_index
+import image_catalog
+import image_io
 
 pic_folder_path = os.path.join(wd, folders_list[0])
-os.chdir(pic_folder_path)
 
 # Read the `*.bmp file`
 # input: "file name" string
@@ -62,143 +136,547 @@ def read_image(file):
     img = cv2.imread(file, -1)
     return img
 
+# First channel of every complete image set of a folder (see `dataset_index.py`)
+def get_image_set_files(pic_folder_path):
+    return [channel_set["channels"][0] for channel_set in dataset_index.channel_sets(pic_folder_path, ch_prefix, [ch1_suffix, ch2_suffix, ch3_suffix, ch4_suffix], ".tiff")]
+
+# File names of the 4 corresponding greyscale images
+def get_channel_file_names(file_name):
+    channel_set = dataset_index.channel_set_of(file_name, ch_prefix, [ch1_suffix, ch2_suffix, ch3_suffix, ch4_suffix], ".tiff")
+    if channel_set is None or not channel_set["complete"]:
+        raise ValueError(f"Not all channels of {file_name} exist")
+    return channel_set["channels"]
+
 ## Read 4 corresponding greyscale images
 def read_4_color_channels_from_rgb(file_name):
-    base_channel = ch_prefix + ch1_suffix
-    ch1 = cv2.imread(file_name, -1)[:,:,-1]
-    ch2 = cv2.imread(file_name.replace(base_channel, ch_prefix + ch2_suffix), -1)[:,:,-1]
-    ch3 = cv2.imread(file_name.replace(base_channel, ch_prefix + ch3_suffix), -1)[:,:,-1]
-    ch4 = cv2.imread(file_name.replace(base_channel, ch_prefix + ch4_suffix), -1)[:,:,-1]
+    # memory-mapped for uncompressed TIFFs, only the used plane is kept otherwise
+    ch1, ch2, ch3, ch4 = [image_io.read_channel(channel_file, -1) for channel_file in get_channel_file_names(file_name)]
     return ch1, ch2, ch3, ch4
 
 
-def substract_background(img, background_substraction, radius=100):
+# Estimate the background of an image with the chosen method
+def estimate_background(img, radius=100, num_threads=16, method="rolling_ball", shrink_factor=background_shrink_factor):
+    if method == "rolling_ball":
+        return restoration.rolling_ball(img, radius=radius, num_threads=num_threads)
+
+    if method == "downsampled_rolling_ball":
+        # Downsample with the minimum of each block, so the ball still rolls below every pixel
+        height, width = img.shape
+        padded = np.pad(img, ((0, -height % shrink_factor), (0, -width % shrink_factor)), mode="edge")
+        small = padded.reshape(padded.shape[0] // shrink_factor, shrink_factor, padded.shape[1] // shrink_factor, shrink_factor).min(axis=(1, 3))
+        # The ball shrinks in x and y, but keeps its height in the intensity dimension
+        small_radius = max(1, round(radius / shrink_factor))
+        kernel = restoration.ellipsoid_kernel((2 * small_radius + 1, 2 * small_radius + 1), radius)
+        background = restoration.rolling_ball(small, kernel=kernel, num_threads=num_threads)
+        background = cv2.resize(background, (padded.shape[1], padded.shape[0]), interpolation=cv2.INTER_LINEAR)[:height, :width]
+        # The interpolated background must never be brighter than the image
+        return np.minimum(background, img)
+
+    if method == "tophat":
+        # Opening = background of a white top-hat transformation
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+        return cv2.morphologyEx(img, cv2.MORPH_OPEN, kernel)
+
+    raise ValueError(f"Unknown background substraction method: {method}")
+
+def substract_background(img, background_substraction, radius=100, num_threads=16, method="rolling_ball"):
     # Apply a bacground substraction method to the image
-    # Rolling Ball method from skimage.restoration
+    # Rolling Ball method from skimage.restoration, or one of its fast approximations
     if background_substraction:
-        img -= restoration.rolling_ball(img, radius=radius, num_threads=16)
+        # not in place, the channels may be read-only memory maps
+        img = img - estimate_background(img, radius=radius, num_threads=num_threads, method=method).astype(img.dtype)
     return img
 
+# Compare a fast background method with the exact rolling ball on a crop of an image
+# The exact method takes minutes on a full round2 image, so only the center crop is compared
+# return: dict with the runtimes, the speedup and the deviation of the backgrounds in intensity levels
+def compare_background_methods(img, method="downsampled_rolling_ball", radius=100, num_threads=16, crop_size=512):
+    height, width = img.shape
+    top, left = max(0, (height - crop_size) // 2), max(0, (width - crop_size) // 2)
+    img = img[top:top + crop_size, left:left + crop_size]
+
+    start = time.perf_counter()
+    exact_background = estimate_background(img, radius=radius, num_threads=num_threads, method="rolling_ball")
+    exact_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    fast_background = estimate_background(img, radius=radius, num_threads=num_threads, method=method)
+    fast_seconds = time.perf_counter() - start
+
+    deviation = np.abs(fast_background.astype(np.float64) - exact_background.astype(np.float64))
+    return {
+        "method": method,
+        "exact seconds": exact_seconds,
+        "fast seconds": fast_seconds,
+        "speedup": exact_seconds / max(fast_seconds, 1e-9),
+        "max deviation": deviation.max(),
+        "mean deviation": deviation.mean(),
+        "pixels deviating > 1": (deviation > 1).mean() * 100,
+    }
+
+# Background methods reported in this run, see `report_background_deviation`
+reported_background_methods = set()
+
+# Print the comparison of the fast and the exact background substraction for one image
+def report_background_method(file, method="downsampled_rolling_ball", radius=100):
+    reported_background_methods.add(method)
+    ch1 = image_io.read_channel(file, -1)
+    comparison = compare_background_methods(ch1, method=method, radius=radius)
+    print(f"Background substraction \"{method}\" on {os.path.basename(file)}: "
+          f"{comparison['speedup']:.1f}x faster than the exact rolling ball, "
+          f"max. deviation {comparison['max deviation']:.0f}, mean deviation {comparison['mean deviation']:.3f} intensity levels, "
+          f"{comparison['pixels deviating > 1']:.2f}% of the pixels deviate by more than 1")
+    return comparison
+
+# Name of the thresholded DAPI image of an image set
+# input: "file name" string of the DAPI image, threshold mode, background substraction flag
+def get_thresholded_file_name(file, mode, additional_background_substraction):
+    thresholded_file_name = file.replace("combined", f"_{mode}_thresholded_{additional_background_substraction}")
+    if thresholded_output_format == "sparse":
+        thresholded_file_name = os.path.splitext(thresholded_file_name)[0] + image_io.sparse_file_format
+    return os.path.basename(thresholded_file_name)
+
+# Paths of the 4 thresholded channels of an image set
+def get_thresholded_file_names(file, output_folder_path, mode, additional_background_substraction):
+    return [os.path.join(output_folder_path, get_thresholded_file_name(channel_file, mode, additional_background_substraction)) for channel_file in get_channel_file_names(file)]
+
+# Everything that changes the thresholded images, recorded in the build manifest of the output folder
+def threshold_parameters(mode, gaussian_blur, additional_background_substraction, background_method, thresholds=None):
+    return {
+        "mode": mode,
+        "gaussian_blur": gaussian_blur,
+        "additional_background_substraction": additional_background_substraction,
+        "background_method": background_method if additional_background_substraction else None,
+        "background_shrink_factor": background_shrink_factor if additional_background_substraction and background_method != "rolling_ball" else None,
+        "thresholds": None if thresholds is None else [int(threshold) for threshold in thresholds],
+        "channels": [ch_prefix, ch1_suffix, ch2_suffix, ch3_suffix, ch4_suffix],
+        "output_format": thresholded_output_format,
+        "compression": thresholded_compression if thresholded_output_format == "compressed_tiff" else None,
+    }
+
+# Blur and remove the background of all channels of an image set
+def preprocess_channels(ch1, ch2, ch3, ch4, gaussian_blur=True, additional_background_substraction=False, num_threads=16, background_method="rolling_ball"):
+    if gaussian_blur:
+        # Apply a Gaussian blur filter to the image
+        # sigma 0.5 leads to a kernal size of (3x3) = ((6*sigma+1) x (6*sigma+1)) 
+        ch1 = cv2.GaussianBlur(ch1, (0, 0), 0.5)
+        ch2 = cv2.GaussianBlur(ch2, (0, 0), 0.5)
+        ch3 = cv2.GaussianBlur(ch3, (0, 0), 0.5)
+        ch4 = cv2.GaussianBlur(ch4, (0, 0), 0.5)
+
+    ch1 = substract_background(ch1, additional_background_substraction, num_threads=num_threads, method=background_method)
+    ch2 = substract_background(ch2, additional_background_substraction, num_threads=num_threads, method=background_method)
+    ch3 = substract_background(ch3, additional_background_substraction, num_threads=num_threads, method=background_method)
+    ch4 = substract_background(ch4, additional_background_substraction, num_threads=num_threads, method=background_method)
+    return ch1, ch2, ch3, ch4
+
+# Otsu's threshold of a histogram, same result as `cv2.threshold(..., cv2.THRESH_OTSU)` on the image
+def otsu_threshold_from_histogram(hist):
+    hist = np.asarray(hist, dtype=np.float64)
+    probabilities = hist / hist.sum()
+    levels = np.arange(hist.size)
+    q1 = np.cumsum(probabilities)
+    q2 = 1 - q1
+    partial_mean = np.cumsum(levels * probabilities)
+    mean = partial_mean[-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mu1 = partial_mean / q1
+        mu2 = (mean - partial_mean) / q2
+        between_class_variance = q1 * q2 * (mu1 - mu2) ** 2
+    # OpenCV ignores classes that are (almost) empty
+    eps = np.finfo(np.float32).eps
+    valid = (np.minimum(q1, q2) >= eps) & (np.maximum(q1, q2) <= 1 - eps)
+    between_class_variance = np.where(valid, between_class_variance, 0)
+    if between_class_variance.max() <= 0:
+        return 0
+    return int(np.argmax(between_class_variance))
+
+# Triangle threshold of a histogram, same result as `cv2.threshold(..., cv2.THRESH_TRIANGLE)` on the image
+def triangle_threshold_from_histogram(hist):
+    hist = np.asarray(hist, dtype=np.int64)
+    n_bins = hist.size
+    nonzero_bins = np.flatnonzero(hist)
+    if nonzero_bins.size == 0:
+        return 0
+    left_bound, right_bound = nonzero_bins[0], nonzero_bins[-1]
+    if left_bound > 0:
+        left_bound -= 1
+    if right_bound < n_bins - 1:
+        right_bound += 1
+    max_ind = int(np.argmax(hist))
+
+    # The line is always drawn from the peak to the longer tail of the histogram
+    is_flipped = False
+    if max_ind - left_bound < right_bound - max_ind:
+        is_flipped = True
+        hist = hist[::-1]
+        left_bound = n_bins - 1 - right_bound
+        max_ind = n_bins - 1 - max_ind
+
+    # Bin with the largest distance to the line between the peak and the tail
+    threshold = left_bound
+    bins = np.arange(left_bound + 1, max_ind + 1)
+    if bins.size > 0:
+        distances = hist[max_ind] * bins + (left_bound - max_ind) * hist[bins]
+        if distances.max() > 0:
+            threshold = int(bins[np.argmax(distances)])
+    threshold -= 1
+
+    if is_flipped:
+        threshold = n_bins - 1 - threshold
+    return threshold
+
+def threshold_from_histogram(hist, method):
+    if method == "otsu":
+        return otsu_threshold_from_histogram(hist)
+    if method == "triangle":
+        return triangle_threshold_from_histogram(hist)
+    raise ValueError(f"Unknown global threshold method: {method}")
+
+# Histograms of the preprocessed channels of a single image set
+# 256 bins for 8 bit images, 65536 bins for 16 bit images
+# return: array with one row per channel
+def channel_histograms(file, gaussian_blur=True, additional_background_substraction=False, num_threads=16, background_method="rolling_ball"):
+    channels = read_4_color_channels_from_rgb(file)
+    channels = preprocess_channels(*channels, gaussian_blur, additional_background_substraction, num_threads=num_threads, background_method=background_method)
+    n_bins = 256 if channels[0].dtype == np.uint8 else 65536
+    return np.stack([cv2.calcHist([channel], [0], None, [n_bins], [0, n_bins]).ravel().astype(np.int64) for channel in channels])
+
+# First pass of the global thresholding: stream every image set of all folders once and
+# add up the histograms of each channel. Only the histograms are kept in memory.
+# The merged histograms are saved, so they only get calculated once per set of images and preprocessing parameters.
+# return: array with one merged histogram per channel
+def accumulate_histograms(wd, folders_list, gaussian_blur=True, additional_background_substraction=False, n_workers=1, background_method="rolling_ball"):
+    files = sorted(file for folder in folders_list for file in get_image_set_files(os.path.join(wd, folder)))
+    parameters = {"gaussian_blur": gaussian_blur, "additional_background_substraction": additional_background_substraction, "background_method": background_method if additional_background_substraction else None}
+    histogram_file = os.path.join(wd, f"histograms_gauss_{gaussian_blur}_bg_{additional_background_substraction}.npz")
+
+    if os.path.isfile(histogram_file):
+        saved = np.load(histogram_file)
+        if json.loads(str(saved["parameters"])) == parameters and list(saved["files"]) == files:
+            print(f"Using the saved histograms of {len(files)} image sets: {histogram_file}")
+            return saved["histograms"]
+
+    histograms = None
+    if n_workers <= 1:
+        for file in tqdm(files, desc="Accumulating histograms"):
+            hist = channel_histograms(file, gaussian_blur, additional_background_substraction, background_method=background_method)
+            histograms = hist if histograms is None else histograms + hist
+    else:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(threads_per_worker,)) as executor:
+            futures = [executor.submit(channel_histograms, file, gaussian_blur, additional_background_substraction, threads_per_worker, background_method) for file in files]
+            for future in tqdm(as_completed(futures), total=len(futures), desc=f"Accumulating histograms ({n_workers} workers)"):
+                hist = future.result()
+                histograms = hist if histograms is None else histograms + hist
+
+    if histograms is None:
+        raise FileNotFoundError(f"No images found in {wd} for the folders {folders_list}")
+    np.savez(histogram_file, histograms=histograms, files=np.array(files), parameters=json.dumps(parameters))
+    return histograms
+
+# Thresholds for every channel of a global threshold mode, calculated from the merged histograms
+def global_thresholds(wd, folders_list, mode, gaussian_blur=True, additional_background_substraction=False, n_workers=1, background_method="rolling_ball"):
+    histograms = accumulate_histograms(wd, folders_list, gaussian_blur, additional_background_substraction, n_workers, background_method)
+    thresholds = tuple(threshold_from_histogram(hist, method) for hist, method in zip(histograms, global_threshold_methods[mode]))
+    print(f"Global thresholds for {mode}: {thresholds}")
+    return thresholds
+
+# Apply the thresholding method of the chosen mode to every color channel of an image set
+# thresholds: one threshold per channel, only used by the global threshold modes
+def apply_threshold_mode(ch1, ch2, ch3, ch4, mode, thresholds=None):
+    # some modes change the channels in place, the memory-mapped channels are read-only
+    ch1, ch2, ch3, ch4 = [channel if channel.flags.writeable else np.array(channel) for channel in (ch1, ch2, ch3, ch4)]
+    if mode in global_threshold_methods:
+        # Every value above the dataset-wide threshold remains the same, everything else is set to 0
+        _, ch1 = cv2.threshold(ch1, thresholds[0], 255, cv2.THRESH_TOZERO)
+        _, ch2 = cv2.threshold(ch2, thresholds[1], 255, cv2.THRESH_TOZERO)
+        _, ch3 = cv2.threshold(ch3, thresholds[2], 255, cv2.THRESH_TOZERO)
+        _, ch4 = cv2.threshold(ch4, thresholds[3], 255, cv2.THRESH_TOZERO)
+
+    if mode == "triangle":
+        # Apply triangle thresholding to every channel
+        _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
+        _, ch2 = cv2.threshold(ch2, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
+        _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
+        _, ch4 = cv2.threshold(ch4, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
+
+    if mode == "adaptive":
+        # Apply cv adaptive thresholding to every channel
+        ch1 = cv2.adaptiveThreshold(ch1, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 0)
+        ch2 = cv2.adaptiveThreshold(ch2, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 0)
+        ch3 = cv2.adaptiveThreshold(ch3, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 0)
+        ch4 = cv2.adaptiveThreshold(ch4, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 0)
+
+    if mode == "otsu":
+        # Apply Otsu's thresholding to every channel
+        _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+        _, ch2 = cv2.threshold(ch2, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+        _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+        _, ch4 = cv2.threshold(ch4, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+
+    if mode == "otsu_on_dapi_only":
+        # Apply Otsu's thresholding to only the DAPI channel
+        _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+
+    if mode == "otsu_on_dapi_intensity_greater_7_on_rest":
+        # Apply Otsu's thresholding to only the DAPI channel
+        _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+        # Every value >1 remains the same, every value <=1 is set to 0
+        ch2[ch2 < 8] = 0
+        ch3[ch3 < 8] = 0
+        ch4[ch4 < 8] = 0
+
+    if mode == "triangle_on_dapi_intensity_greater_1_on_rest":
+        # Apply Otsu's thresholding to only the DAPI channel
+        _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
+        # Every value >1 remains the same, every value <=1 is set to 0
+        ch2[ch2 < 2] = 0
+        ch3[ch3 < 2] = 0
+        ch4[ch4 < 2] = 0
+
+    if mode == "super_low_intensities_5_filtered":
+        # Every value >5 remains the same, every value <=5 is set to 0
+        ch1[ch1 < 6] = 0
+        ch2[ch2 < 6] = 0
+        ch3[ch3 < 6] = 0
+        ch4[ch4 < 6] = 0
+
+    if mode == "low_intensities_filtered":
+        ch1[ch1 < 11] = 0
+        ch2[ch2 < 11] = 0
+        ch3[ch3 < 11] = 0
+        ch4[ch4 < 11] = 0
+
+    if mode == "blue_otsu_red_triangle_green_5":
+        _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+        ch2[ch2 < 5] = 0
+        _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
+
+    # For cortical organoids I used: 
+    if mode == "background_filtered_combo":
+        _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+        _, ch2 = cv2.threshold(ch2, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
+        _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
+
+    # For NPCs we can use the following:
+    if mode == "otsu_triangle_otsu_triangle_gauss":
+        _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+        _, ch2 = cv2.threshold(ch2, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
+        _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+        _, ch4 = cv2.threshold(ch4, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
+
+    if mode == "otsu_otsu_otsu_otsu_gauss":
+        _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+        _, ch2 = cv2.threshold(ch2, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+        _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+        _, ch4 = cv2.threshold(ch4, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
+    return ch1, ch2, ch3, ch4
+
+# Threshold a single image set and save the four thresholded channels
+# input: "file name" string of the DAPI image, folder to save the thresholded images in
+def threshold_image_set(file, output_folder_path, mode, gaussian_blur=True, additional_background_substraction=False, num_threads=16, background_method="rolling_ball", thresholds=None):
+    channels = read_4_color_channels_from_rgb(file)
+    channels = threshold_channels(channels, mode, gaussian_blur, additional_background_substraction, num_threads, background_method, thresholds)
+    write_thresholded_images(get_thresholded_file_names(file, output_folder_path, mode, additional_background_substraction), channels)
+    return
+
+# Preprocess and threshold the 4 channels of an image set
+def threshold_channels(channels, mode, gaussian_blur=True, additional_background_substraction=False, num_threads=16, background_method="rolling_ball", thresholds=None):
+    ch1, ch2, ch3, ch4 = preprocess_channels(*channels, gaussian_blur, additional_background_substraction, num_threads=num_threads, background_method=background_method)
+    return apply_threshold_mode(ch1, ch2, ch3, ch4, mode, thresholds)
+
+# Write the thresholded channels in the format of `thresholded_output_format`
+def write_thresholded_images(thresholded_file_names, channels):
+    compression = thresholded_compression if thresholded_output_format == "compressed_tiff" else None
+    for thresholded_file_name, channel in zip(thresholded_file_names, channels):
+        image_io.write_channel(thresholded_file_name, channel, compression, thresholded_tile_size)
+
+# Read the 4 channels of an image set completely, so the file is read in the prefetching thread
+def load_image_set(file):
+    return [image_io.in_memory(channel) for channel in read_4_color_channels_from_rgb(file)]
+
+# Every process of the pool only gets its share of the CPU cores
+def init_worker(num_threads):
+    cv2.setNumThreads(num_threads)
+
+# Memory-mapped cache of the preprocessed (blurred and background substracted) channels of image sets.
+# Every image set is stored as one `.npy` file with the shape (channels, height, width).
+# When the cache gets larger than `byte_budget`, the least recently used image sets are removed.
+class PreprocessingCache:
+    def __init__(self, cache_folder_path, byte_budget=preprocessing_cache_budget):
+        self.cache_folder_path = cache_folder_path
+        self.byte_budget = byte_budget
+        os.makedirs(cache_folder_path, exist_ok=True)
+        # Resume with the files of previous runs, oldest first
+        self.entries = OrderedDict()
+        for path in sorted(glob.glob(os.path.join(cache_folder_path, "*.npy")), key=os.path.getmtime):
+            self.entries[os.path.basename(path)[:-4]] = os.path.getsize(path)
+
+    # The key changes whenever one of the channel files of the image set or the preprocessing parameters change
+    @staticmethod
+    def key(file, gaussian_blur, additional_background_substraction, background_method):
+        channel_stats = [(os.path.abspath(channel_file), os.stat(channel_file)) for channel_file in get_channel_file_names(file)]
+        identity = "|".join(f"{channel_file}|{file_stat.st_size}|{file_stat.st_mtime_ns}" for channel_file, file_stat in channel_stats)
+        identity += f"|{gaussian_blur}|{additional_background_substraction}|{background_method if additional_background_substraction else None}"
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_folder_path, key + ".npy")
+
+    def nbytes(self):
+        return sum(self.entries.values())
+
+    # return: read-only memory map of the cached channels, or None if the image set is not cached
+    def get(self, key):
+        if key not in self.entries or not os.path.isfile(self.path(key)):
+            self.entries.pop(key, None)
+            return None
+        self.entries.move_to_end(key)
+        os.utime(self.path(key))
+        return np.load(self.path(key), mmap_mode="r")
+
+    def put(self, key, channels):
+        temporary_path = self.path(key) + ".tmp"
+        cached = np.lib.format.open_memmap(temporary_path, mode="w+", dtype=channels[0].dtype, shape=(len(channels),) + channels[0].shape)
+        for i, channel in enumerate(channels):
+            cached[i] = channel
+        cached.flush()
+        del cached
+        os.replace(temporary_path, self.path(key))
+        self.entries[key] = os.path.getsize(self.path(key))
+        self.entries.move_to_end(key)
+        self.evict(keep=key)
+        return np.load(self.path(key), mmap_mode="r")
+
+    # Remove the least recently used image sets until the cache fits into the budget again
+    def evict(self, keep=None):
+        while self.nbytes() > self.byte_budget and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            if key == keep:
+                break
+            self.entries.pop(key)
+            if os.path.isfile(self.path(key)):
+                os.remove(self.path(key))
+
+# Preprocessed channels of an image set, from the cache if possible
+def cached_preprocessed_channels(file, cache, gaussian_blur=True, additional_background_substraction=False, background_method="rolling_ball"):
+    key = cache.key(file, gaussian_blur, additional_background_substraction, background_method)
+    channels = cache.get(key)
+    if channels is None:
+        channels = read_4_color_channels_from_rgb(file)
+        channels = preprocess_channels(*channels, gaussian_blur, additional_background_substraction, background_method=background_method)
+        channels = cache.put(key, channels)
+    return channels
+
+# Apply several threshold modes to all image sets of a folder.
+# Each image set gets read and preprocessed only once (or taken from the cache of a previous sweep),
+# all modes are evaluated on copies of the cached channels.
+# The output folders and file names are the same as the ones of `thresholding()`.
+# thresholds_by_mode: thresholds of the global threshold modes, see `global_thresholds()`
+def threshold_mode_sweep_folder(pic_folder_path, pic_sub_folder_name, modes, cache, gaussian_blur=True, additional_background_substraction=False, background_method="rolling_ball", thresholds_by_mode=None):
+    thresholds_by_mode = thresholds_by_mode or {}
+    output_folder_paths = {}
+    manifests = {}
+    for mode in modes:
+        output_folder_paths[mode] = os.path.abspath(pic_folder_path + f"/../{pic_sub_folder_name}_thresholded_{mode}_{additional_background_substraction}")
+        os.makedirs(output_folder_paths[mode], exist_ok=True)
+        manifests[mode] = build_manifest.BuildManifest(output_folder_paths[mode], "thresholding")
+    # "background_filtered_combo" always substracts the background
+    background_substraction_by_mode = {mode: additional_background_substraction or mode == "background_filtered_combo" for mode in modes}
+    parameters_by_mode = {mode: threshold_parameters(mode, gaussian_blur, background_substraction_by_mode[mode], background_method, thresholds_by_mode.get(mode)) for mode in modes}
+
+    try:
+        for file in tqdm(get_image_set_files(pic_folder_path), desc=f"Applying {len(modes)} threshold modes"):
+            for background_substraction in sorted(set(background_substraction_by_mode.values())):
+                # Skip modes that have been applied to this image set with the same inputs and parameters before
+                missing_modes = [mode for mode in modes if background_substraction_by_mode[mode] == background_substraction
+                                 and not manifests[mode].is_up_to_date(file, get_channel_file_names(file), parameters_by_mode[mode], get_thresholded_file_names(file, output_folder_paths[mode], mode, background_substraction))]
+                if len(missing_modes) == 0:
+                    continue
+
+                channels = cached_preprocessed_channels(file, cache, gaussian_blur, background_substraction, background_method)
+                for mode in missing_modes:
+                    # the modes change the channels in place, so every mode gets its own copy
+                    ch1, ch2, ch3, ch4 = apply_threshold_mode(*[np.array(channel) for channel in channels], mode, thresholds_by_mode.get(mode))
+                    thresholded_file_names = get_thresholded_file_names(file, output_folder_paths[mode], mode, background_substraction)
+                    write_thresholded_images(thresholded_file_names, (ch1, ch2, ch3, ch4))
+                    manifests[mode].record(file, get_channel_file_names(file), parameters_by_mode[mode], thresholded_file_names)
+                del channels
+    finally:
+        for manifest in manifests.values():
+            manifest.save()
+    return
+
 # Apply thresholding to every color channel of the image.
 # input: "folder name" string
-def thresholding(pic_folder_path, pic_sub_folder_name, mode = "low_intensities_filtered", gaussian_blur = True, additional_background_substraction = True):
-    if not os.path.isdir(pic_folder_path + f"/../{pic_sub_folder_name}_thresholded_{mode}_{additional_background_substraction}"):
-        os.makedirs(pic_folder_path + f"/../{pic_sub_folder_name}_thresholded_{mode}_{additional_background_substraction}")
-    # We're gonna save the images here:
-    os.chdir(pic_folder_path + f"/../{pic_sub_folder_name}_thresholded_{mode}_{additional_background_substraction}")
+def thresholding(pic_folder_path, pic_sub_folder_name, mode = "low_intensities_filtered", gaussian_blur = True, additional_background_substraction = True, n_workers = 1, background_method = "rolling_ball", thresholds = None):
+    output_folder_path = os.path.abspath(pic_folder_path + f"/../{pic_sub_folder_name}_thresholded_{mode}_{additional_background_substraction}")
+    if not os.path.isdir(output_folder_path):
+        os.makedirs(output_folder_path)
 
     if mode == "background_filtered_combo":
         additional_background_substraction = True
-
-    for file in tqdm(glob.glob(pic_folder_path+"/*"+ch_prefix+ch1_suffix+"*"), desc=f"Applying {mode} thresholding"):
-        thresholded_file_name = file.replace("combined", f"_{mode}_thresholded_{additional_background_substraction}")
-        thresholded_file_name = os.path.basename(thresholded_file_name)
-        if os.path.isfile(thresholded_file_name):
-            continue
-
-        ch1, ch2, ch3, ch4 = read_4_color_channels_from_rgb(file)
-
-        if gaussian_blur:
-            # Apply a Gaussian blur filter to the image
-            # sigma 0.5 leads to a kernal size of (3x3) = ((6*sigma+1) x (6*sigma+1)) 
-            ch1 = cv2.GaussianBlur(ch1, (0, 0), 0.5)
-            ch2 = cv2.GaussianBlur(ch2, (0, 0), 0.5)
-            ch3 = cv2.GaussianBlur(ch3, (0, 0), 0.5)
-            ch4 = cv2.GaussianBlur(ch4, (0, 0), 0.5)
-
-        ch1 = substract_background(ch1, additional_background_substraction)
-        ch2 = substract_background(ch2, additional_background_substraction)
-        ch3 = substract_background(ch3, additional_background_substraction)
-        ch4 = substract_background(ch4, additional_background_substraction)
-
-
-        if mode == "triangle":
-            # Apply triangle thresholding to every channel
-            _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
-            _, ch2 = cv2.threshold(ch2, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
-            _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
-            _, ch4 = cv2.threshold(ch4, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
-
-        if mode == "adaptive":
-            # Apply cv adaptive thresholding to every channel
-            ch1 = cv2.adaptiveThreshold(ch1, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 0)
-            ch2 = cv2.adaptiveThreshold(ch2, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 0)
-            ch3 = cv2.adaptiveThreshold(ch3, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 0)
-            ch4 = cv2.adaptiveThreshold(ch4, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 21, 0)
-
-        if mode == "otsu":
-            # Apply Otsu's thresholding to every channel
-            _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-            _, ch2 = cv2.threshold(ch2, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-            _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-            _, ch4 = cv2.threshold(ch4, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-
-        if mode == "otsu_on_dapi_only":
-            # Apply Otsu's thresholding to only the DAPI channel
-            _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-
-        if mode == "otsu_on_dapi_intensity_greater_7_on_rest":
-            # Apply Otsu's thresholding to only the DAPI channel
-            _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-            # Every value >1 remains the same, every value <=1 is set to 0
-            ch2[ch2 < 8] = 0
-            ch3[ch3 < 8] = 0
-            ch4[ch4 < 8] = 0
-
-        if mode == "triangle_on_dapi_intensity_greater_1_on_rest":
-            # Apply Otsu's thresholding to only the DAPI channel
-            _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
-            # Every value >1 remains the same, every value <=1 is set to 0
-            ch2[ch2 < 2] = 0
-            ch3[ch3 < 2] = 0
-            ch4[ch4 < 2] = 0
-
-        if mode == "super_low_intensities_5_filtered":
-            # Every value >5 remains the same, every value <=5 is set to 0
-            ch1[ch1 < 6] = 0
-            ch2[ch2 < 6] = 0
-            ch3[ch3 < 6] = 0
-            ch4[ch4 < 6] = 0
-
-        if mode == "low_intensities_filtered":
-            ch1[ch1 < 11] = 0
-            ch2[ch2 < 11] = 0
-            ch3[ch3 < 11] = 0
-            ch4[ch4 < 11] = 0
-
-        if mode == "blue_otsu_red_triangle_green_5":
-            _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-            ch2[ch2 < 5] = 0
-            _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
-
-        # For cortical organoids I used: 
-        if mode == "background_filtered_combo":
-            _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-            _, ch2 = cv2.threshold(ch2, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
-            _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
-
-        # For NPCs we can use the following:
-        if mode == "otsu_triangle_otsu_triangle_gauss":
-            _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-            _, ch2 = cv2.threshold(ch2, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
-            _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-            _, ch4 = cv2.threshold(ch4, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_TRIANGLE)
-
-        if mode == "otsu_otsu_otsu_otsu_gauss":
-            _, ch1 = cv2.threshold(ch1, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-            _, ch2 = cv2.threshold(ch2, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-            _, ch3 = cv2.threshold(ch3, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-            _, ch4 = cv2.threshold(ch4, 0, 255, cv2.THRESH_TOZERO + cv2.THRESH_OTSU)
-
-
-        cv2.imwrite(os.getcwd()+"/"+thresholded_file_name, ch1)
-        cv2.imwrite(os.getcwd()+"/"+thresholded_file_name.replace(ch_prefix+ch1_suffix, ch_prefix+ch2_suffix), ch2)
-        cv2.imwrite(os.getcwd()+"/"+thresholded_file_name.replace(ch_prefix+ch1_suffix, ch_prefix+ch3_suffix), ch3)
-        cv2.imwrite(os.getcwd()+"/"+thresholded_file_name.replace(ch_prefix+ch1_suffix, ch_prefix+ch4_suffix), ch4)
+    if mode in global_threshold_methods and thresholds is None:
+        raise ValueError(f"The global threshold mode {mode} needs the thresholds of global_thresholds()")
+
+    # Skip image sets that have been thresholded with the same inputs and parameters before
+    manifest = build_manifest.BuildManifest(output_folder_path, "thresholding")
+    parameters = threshold_parameters(mode, gaussian_blur, additional_background_substraction, background_method, thresholds)
+    def is_up_to_date(file):
+        return manifest.is_up_to_date(file, get_channel_file_names(file), parameters, get_thresholded_file_names(file, output_folder_path, mode, additional_background_substraction))
+    def record(file):
+        manifest.record(file, get_channel_file_names(file), parameters, get_thresholded_file_names(file, output_folder_path, mode, additional_background_substraction))
+    files = [file for file in get_image_set_files(pic_folder_path) if not is_up_to_date(file)]
+
+    if additional_background_substraction and background_method != "rolling_ball" and report_background_deviation and background_method not in reported_background_methods and len(files) > 0:
+        report_background_method(files[0], method=background_method)
+
+    # The manifest is saved even if the run gets interrupted, so finished image sets don't get thresholded again
+    try:
+        if n_workers <= 1:
+            # Read ahead and write in the background, the image sets are still thresholded in order.
+            # An image set is only recorded once its images are written.
+            written = []
+            try:
+                with image_io.BackgroundWriter(io_threads, max_pending_writes) as writer:
+                    for file, channels in tqdm(image_io.prefetched(files, load_image_set, prefetch_image_sets, io_threads), total=len(files), desc=f"Applying {mode} thresholding"):
+                        channels = threshold_channels(channels, mode, gaussian_blur, additional_background_substraction, background_method=background_method, thresholds=thresholds)
+                        written.append((file, writer.submit(write_thresholded_images, get_thresholded_file_names(file, output_folder_path, mode, additional_background_substraction), channels)))
+            finally:
+                for file, future in written:
+                    if future.done() and not future.cancelled() and future.exception() is None:
+                        record(file)
+            return
+
+        # Fan the image sets out to a pool of processes
+        threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(threads_per_worker,)) as executor:
+            futures = {executor.submit(threshold_image_set, file, output_folder_path, mode, gaussian_blur, additional_background_substraction, threads_per_worker, background_method, thresholds): file for file in files}
+            for future in tqdm(as_completed(futures), total=len(futures), desc=f"Applying {mode} thresholding ({n_workers} workers)"):
+                # re-raise errors of the workers
+                future.result()
+                record(futures[future])
+    finally:
+        manifest.save()
     return
 
 if __name__ == "__main__":
+    wd = os.path.abspath(wd)
+    if use_image_catalog:
+        catalog = image_catalog.ImageCatalog(wd, ch_prefix, [ch1_suffix, ch2_suffix, ch3_suffix, ch4_suffix])
+        catalog.refresh()
+        dataset_index.catalog = catalog
+    # First pass of the global threshold modes: thresholds from the histograms of all images
+    thresholds_by_mode = {}
+    for mode in (threshold_mode_sweep or [threshold_mode]):
+        if mode in global_threshold_methods:
+            thresholds_by_mode[mode] = global_thresholds(wd, folders_list, mode, gauss_blur_filter, additional_background_substraction, n_workers, background_method)
+
+    if threshold_mode_sweep:
+        cache = PreprocessingCache(os.path.join(wd, ".preprocessing_cache"), preprocessing_cache_budget)
     for sub_folder_name in folders_list:
         pic_folder_path = os.path.join(wd, sub_folder_name)
-        os.chdir(pic_folder_path)
-        thresholding(pic_folder_path, sub_folder_name, mode = threshold_mode, gaussian_blur = gauss_blur_filter, additional_background_substraction = additional_background_substraction)
+        if threshold_mode_sweep:
+            threshold_mode_sweep_folder(pic_folder_path, sub_folder_name, threshold_mode_sweep, cache, gauss_blur_filter, additional_background_substraction, background_method, thresholds_by_mode)
+        else:
+            thresholding(pic_folder_path, sub_folder_name, mode = threshold_mode, gaussian_blur = gauss_blur_filter, additional_background_substraction = additional_background_substraction, n_workers = n_workers, background_method = background_method, thresholds = thresholds_by_mode.get(threshold_mode))
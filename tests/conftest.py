@@ -0,0 +1,33 @@
+"""
+Shared fixtures of the tests: the scripts of `code/` and `code/round2/` are imported as modules,
+the images are small synthetic image sets written to a temporary folder.
+(c) 2024, Maximilian Otto, Berlin.
+"""
+
+import os, sys
+import numpy as np
+import tifffile
+import pytest
+
+code_folder_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code")
+# the round2 scripts come first, `code/` has older scripts with the same names
+sys.path.insert(0, code_folder_path)
+sys.path.insert(0, os.path.join(code_folder_path, "round2"))
+
+# Write `n_sets` image sets (4 greyscale channels stored as uncompressed RGB TIFFs, so they get memory-mapped) of a cell line
+# return: folder of the images
+# tag: part of the file names, e.g. "combined" like the exported images
+def write_image_sets(folder_path, cell_line="CHCHD2-AAV", n_sets=2, shape=(120, 160), seed=0, tag=""):
+    rng = np.random.default_rng(seed)
+    cell_line_folder_path = os.path.join(folder_path, cell_line)
+    os.makedirs(cell_line_folder_path, exist_ok=True)
+    for i in range(n_sets):
+        for c in range(4):
+            img = (rng.random(shape) ** 3 * 255).astype(np.uint8)
+            tifffile.imwrite(os.path.join(cell_line_folder_path, f"{cell_line}_img{i}{tag}_c0{c}.tiff"), np.stack([img, img, img], axis=-1), photometric="rgb")
+    return cell_line_folder_path
+
+@pytest.fixture
+def image_sets(tmp_path):
+    write_image_sets(str(tmp_path))
+    return str(tmp_path)
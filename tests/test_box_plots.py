@@ -0,0 +1,23 @@
+import os, subprocess, sys
+
+# The plots are rendered in a separate process, the backend of the tests stays as it is
+render_script = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import pandas as pd
+import box_plots
+data = pd.DataFrame({"Cell line": ["A"] * 5 + ["B"] * 5, "Value": range(10)})
+box_plots.render_box_plots([{"data": data, "x": "Cell line", "y": "Value", "file_name": sys.argv[2], "order": ["A", "B"]}], n_workers=1)
+import matplotlib
+print(matplotlib.get_backend())
+"""
+
+def test_serial_rendering_uses_the_agg_backend(tmp_path):
+    code_folder_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code")
+    # another backend than Agg, like an interactive one of the user's matplotlibrc
+    environment = dict(os.environ, MPLBACKEND="svg")
+    file_name = str(tmp_path / "plot.png")
+    result = subprocess.run([sys.executable, "-c", render_script, code_folder_path, file_name], env=environment, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().lower() == "agg"
+    assert os.path.isfile(file_name)
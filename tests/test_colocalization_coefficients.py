@@ -0,0 +1,45 @@
+import numpy as np
+import colocalization_coefficients
+
+# Thresholded 16 bit channels: mostly zeros, some of the signal is darker than the lowest bin of the histogram
+def thresholded_16_bit_channels(shape=(200, 300), seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.gamma(2, 2000, shape)
+    ch1 = np.clip(base + rng.normal(0, 1500, shape), 0, 65535).astype(np.uint16)
+    ch2 = np.clip(0.7 * base + rng.normal(0, 2500, shape), 0, 65535).astype(np.uint16)
+    ch1[ch1 < 4000] = 0
+    ch2[ch2 < 3000] = 0
+    ch1[rng.random(shape) < 0.01] = 40
+    ch2[rng.random(shape) < 0.01] = 20
+    return ch1, ch2
+
+def test_coefficients_of_16_bit_channels_are_exact():
+    ch1, ch2 = thresholded_16_bit_channels()
+    mask = np.random.default_rng(1).random(ch1.shape) > 0.3
+    hist, sums = colocalization_coefficients.joint_statistics(ch1, ch2, mask)
+    coefficients = dict(zip(colocalization_coefficients.coefficient_names, colocalization_coefficients.coefficients(hist, sums, ch1.dtype)))
+    a, b = ch1[mask].astype(np.float64), ch2[mask].astype(np.float64)
+    assert np.isclose(coefficients["Pearson's r"], np.corrcoef(a, b)[0, 1], rtol=1e-12)
+    assert np.isclose(coefficients["Manders' M1"], a[b > 0].sum() / a.sum(), rtol=1e-12)
+    assert np.isclose(coefficients["Manders' M2"], b[a > 0].sum() / b.sum(), rtol=1e-12)
+    assert np.isclose(coefficients["Overlap coefficient"], (a * b).sum() / np.sqrt((a * a).sum() * (b * b).sum()), rtol=1e-12)
+    assert 0 < coefficients["Costes tM1"] <= 1 and 0 < coefficients["Costes tM2"] <= 1
+
+def test_statistics_of_crops_add_up():
+    ch1, ch2 = thresholded_16_bit_channels()
+    hist, sums = colocalization_coefficients.joint_statistics(ch1, ch2)
+    top = colocalization_coefficients.joint_statistics(ch1[:77], ch2[:77])
+    bottom = colocalization_coefficients.joint_statistics(ch1[77:], ch2[77:])
+    assert np.array_equal(top[0] + bottom[0], hist)
+    assert np.array_equal(top[1] + bottom[1], sums)
+
+def test_randomization_test_finds_colocalized_blocks():
+    rng = np.random.default_rng(2)
+    ch1 = np.where(rng.random((90, 120)) < 0.1, rng.integers(1, 256, (90, 120)), 0).astype(np.uint8)
+    ch2 = np.where(ch1 > 0, 255 - ch1 // 2, 0).astype(np.uint8)
+    result = colocalization_coefficients.randomization_test(ch1, ch2, 3, n_shuffles=50, seed=3, batch_bytes=1 << 16)
+    assert result == colocalization_coefficients.randomization_test(ch1, ch2, 3, n_shuffles=50, seed=3, batch_bytes=1 << 16)
+    p_value, mean_r, n_shuffles = result
+    assert n_shuffles == 50
+    assert p_value == 1 / 51
+    assert abs(mean_r) < 0.1
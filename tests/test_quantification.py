@@ -0,0 +1,161 @@
+import os, threading
+import numpy as np
+import pandas as pd
+import tifffile
+import pytest
+from conftest import write_image_sets
+import thresholding
+import dataset_index
+import image_catalog
+import quantification_5_cell_lines as quantification
+
+threshold_mode = "otsu_triangle_otsu_triangle_gauss_False"
+
+@pytest.fixture
+def settings(monkeypatch):
+    monkeypatch.setattr(quantification, "cell_line_list", ["CHCHD2-AAV"])
+    monkeypatch.setattr(quantification, "export_csv", False)
+
+# ROI masks of all image sets, named after the thresholded c01 images (like the exports of QuPath)
+def write_roi_masks(pic_folder_path, shape=(120, 160)):
+    os.makedirs(os.path.join(pic_folder_path, "masks"), exist_ok=True)
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[10:60, 20:90] = 255
+    mask[80:110, 100:150] = 200
+    for raw_file in thresholding.get_image_set_files(os.path.join(pic_folder_path, "CHCHD2-AAV")):
+        for channel_file in thresholding.get_channel_file_names(raw_file)[1:2]:
+            name = thresholding.get_thresholded_file_name(channel_file, "otsu_triangle_otsu_triangle_gauss", False)
+            tifffile.imwrite(os.path.join(pic_folder_path, "masks", name + "_segmentation.tiff"), mask)
+
+def sorted_table(df):
+    return df.drop(columns="Image key").sort_values("File name").reset_index(drop=True)
+
+def test_fused_and_two_step_quantification_use_the_same_roi_masks(tmp_path, settings):
+    pic_folder_path = str(tmp_path)
+    # "combined" is replaced in the thresholded file names
+    write_image_sets(pic_folder_path, tag="_combined")
+    write_roi_masks(pic_folder_path)
+    fused = quantification.fused_quantification(pic_folder_path, "t", threshold_mode, gaussian_filter=False, roi_mask=True, save_thresholded_images=True, results_format="csv")
+    two_step = quantification.calculate_mean_intensity_of_2_markers(pic_folder_path, "t", threshold_mode, gaussian_filter=False, roi_mask=True, results_format="csv")
+    assert len(fused) == 2
+    pd.testing.assert_frame_equal(sorted_table(fused), sorted_table(two_step))
+
+def test_prefetched_quantification_lists_the_folders_from_the_image_catalog(tmp_path, settings, monkeypatch):
+    pic_folder_path = str(tmp_path)
+    write_image_sets(pic_folder_path, tag="_combined")
+    write_roi_masks(pic_folder_path)
+    expected = quantification.fused_quantification(pic_folder_path, "t", threshold_mode, gaussian_filter=False, roi_mask=True, save_thresholded_images=True, results_format="csv")
+    catalog = image_catalog.ImageCatalog(pic_folder_path)
+    catalog.refresh()
+    monkeypatch.setattr(dataset_index, "catalog", catalog)
+    monkeypatch.setattr(quantification, "prefetch_image_sets", 2)
+    try:
+        df = quantification.calculate_mean_intensity_of_2_markers(pic_folder_path, "t", threshold_mode, gaussian_filter=False, roi_mask=True, results_format="csv")
+    finally:
+        catalog.close()
+    pd.testing.assert_frame_equal(sorted_table(expected), sorted_table(df))
+
+def test_prefetching_threads_get_the_channel_files_from_the_main_thread(tmp_path, settings, monkeypatch):
+    pic_folder_path = str(tmp_path)
+    write_image_sets(pic_folder_path, tag="_combined")
+    write_roi_masks(pic_folder_path)
+    quantification.fused_quantification(pic_folder_path, "t", threshold_mode, gaussian_filter=False, roi_mask=True, save_thresholded_images=True, results_format="csv")
+    load_index = dataset_index.load_index
+    def main_thread_load_index(*args, **kwargs):
+        assert threading.current_thread() is threading.main_thread()
+        return load_index(*args, **kwargs)
+    monkeypatch.setattr(dataset_index, "load_index", main_thread_load_index)
+    monkeypatch.setattr(quantification, "prefetch_image_sets", 2)
+    for roi_cropping in (False, True):
+        df = quantification.calculate_mean_intensity_of_2_markers(pic_folder_path, "t", threshold_mode, gaussian_filter=False, roi_mask=True, roi_cropping=roi_cropping, incremental=True, results_format="csv")
+        assert len(df) == 2
+
+def test_no_distance_columns_without_distance_colocalization(tmp_path, settings):
+    assert not quantification.quantify_distance_colocalization
+    pic_folder_path = str(tmp_path)
+    write_image_sets(pic_folder_path, tag="_combined")
+    write_roi_masks(pic_folder_path)
+    df = quantification.fused_quantification(pic_folder_path, "t", threshold_mode, gaussian_filter=False, roi_mask=True, save_thresholded_images=True, results_format="csv")
+    file = quantification.get_image_set_files(os.path.join(pic_folder_path, "CHCHD2-AAV_thresholded_" + threshold_mode))[0]
+    rows = [quantification.quantify_roi_crops(file), quantification.quantify_channels(*quantification.read_4_color_channels_from_greyscale(file), file)]
+    for columns in [df.columns] + [row.keys() for row in rows]:
+        assert not [column for column in columns if " px of " in column]
+
+@pytest.mark.parametrize("results_format", ["csv", "parquet"])
+def test_appended_quantification_table_keeps_the_previous_rows(tmp_path, settings, results_format):
+    pic_folder_path = str(tmp_path)
+    write_image_sets(pic_folder_path, tag="_combined")
+    write_roi_masks(pic_folder_path)
+    previous = quantification.fused_quantification(pic_folder_path, "t", threshold_mode, gaussian_filter=False, roi_mask=True, results_format=results_format)
+    table = quantification.QuantificationTable(quantification.get_quantification_file_name(pic_folder_path, results_format), "t", append=True)
+    row = previous.iloc[0].to_dict()
+    table.append(dict(row, **{"File name": "CHCHD2-AAV_img2_combined_c00.tiff"}))
+    df = table.close()
+    assert len(df) == len(previous) + 1
+    pd.testing.assert_frame_equal(df.iloc[:len(previous)], previous)
+    assert df.iloc[-1]["File name"] == "CHCHD2-AAV_img2_combined_c00.tiff"
+
+def test_csv_table_reads_the_same_values_as_parquet_table(tmp_path, settings):
+    pic_folder_path = str(tmp_path)
+    write_image_sets(pic_folder_path, n_sets=4, tag="_combined")
+    write_roi_masks(pic_folder_path)
+    csv_df = quantification.fused_quantification(pic_folder_path, "t", threshold_mode, gaussian_filter=False, roi_mask=True, save_thresholded_images=True, results_format="csv")
+    parquet_df = quantification.fused_quantification(pic_folder_path, "t", threshold_mode, gaussian_filter=False, roi_mask=True, results_format="parquet")
+    # the rows reused from a CSV table have to match recomputed ones exactly
+    pd.testing.assert_frame_equal(sorted_table(csv_df), sorted_table(parquet_df), check_exact=True)
+
+def test_packed_mask_operations_match_boolean_arrays():
+    rng = np.random.default_rng(0)
+    # the width isn't a multiple of 8, so the last byte of every row is only partly used
+    a, b = rng.random((2, 37, 13)) > 0.5
+    channel = rng.integers(0, 1 << 16, size=a.shape, dtype=np.uint16)
+    mask_a, mask_b = quantification.PackedMask.from_array(a), quantification.PackedMask.from_array(b)
+    for mask, expected in [(mask_a & mask_b, a & b), (mask_a | mask_b, a | b), (~mask_a, ~a)]:
+        np.testing.assert_array_equal(mask.unpack(), expected)
+        assert mask.area() == expected.sum()
+        assert mask.masked_sum(channel, block_rows=8) == channel[expected].sum(dtype=np.int64)
+    mask = quantification.create_mask(a.view(np.uint8), b.view(np.uint8), "CHCHD2-AAV_img0_c01.tiff")
+    np.testing.assert_array_equal(mask.unpack(), a & b)
+
+def test_roi_cropping_saves_the_same_masks_as_the_full_images(tmp_path, settings, monkeypatch):
+    pic_folder_path = str(tmp_path)
+    write_image_sets(pic_folder_path, tag="_combined")
+    write_roi_masks(pic_folder_path)
+    quantification.fused_quantification(pic_folder_path, "t", threshold_mode, gaussian_filter=False, roi_mask=True, save_thresholded_images=True, results_format="csv")
+    mask_folder_path = tmp_path / "masks"
+    full = quantification.calculate_mean_intensity_of_2_markers(pic_folder_path, "t", threshold_mode, gaussian_filter=False, save_mask=True, roi_mask=True, results_format="csv")
+    full_masks = {path.name: tifffile.imread(path) for path in mask_folder_path.glob("*_coloc*")}
+    for path in mask_folder_path.glob("*_coloc*"):
+        path.unlink()
+    read_roi_crops = quantification.read_roi_crops
+    cropped_files = []
+    def counting_read_roi_crops(file_name, channel_files=None):
+        cropped_files.append(file_name)
+        return read_roi_crops(file_name, channel_files)
+    monkeypatch.setattr(quantification, "read_roi_crops", counting_read_roi_crops)
+    cropped = quantification.calculate_mean_intensity_of_2_markers(pic_folder_path, "t", threshold_mode, gaussian_filter=False, save_mask=True, roi_mask=True, roi_cropping=True, results_format="csv")
+    assert len(cropped_files) == 2
+    pd.testing.assert_frame_equal(sorted_table(full), sorted_table(cropped))
+    assert len(full_masks) == 2
+    for name, full_mask in full_masks.items():
+        np.testing.assert_array_equal(tifffile.imread(mask_folder_path / name), full_mask)
+
+def test_randomization_test_of_independent_noise_within_the_roi_is_not_significant():
+    rng = np.random.default_rng(0)
+    mask = np.zeros((120, 160), dtype=np.uint8)
+    mask[10:60, 20:90] = 255
+    mask[80:110, 100:150] = 200
+    roi = mask > 0
+    # independent noise inside the ROI, the zeros outside of it are the same in all channels
+    channels = [np.where(roi, rng.integers(1, 256, size=roi.shape), 0).astype(np.uint8) for _ in range(4)]
+
+    rows, cols = quantification.roi_bounding_box(roi)
+    jobs = quantification.randomization_jobs([channel[rows, cols] for channel in quantification.swap_egfp_and_chchd2(*channels)], "noise.tiff", roi[rows, cols])
+    bands = quantification.roi_bands(mask)
+    crops = [[channel[row_start:row_stop] for row_start, row_stop, _, _ in bands] for channel in channels]
+    rows, cols = quantification.roi_bands_bounding_box(bands)
+    crop_jobs = quantification.randomization_jobs(quantification.roi_crop_images(mask, bands, crops), "noise.tiff", mask[rows, cols] > 0)
+    for columns, arguments in jobs + crop_jobs:
+        p_value, _, n_shuffles = quantification.colocalization_coefficients.randomization_test(*arguments)
+        assert n_shuffles > 0
+        assert p_value > 0.05
@@ -0,0 +1,42 @@
+import os
+import numpy as np
+import tifffile
+import thresholding
+
+def test_parallel_histograms_match_serial_histograms(image_sets, tmp_path):
+    serial = thresholding.accumulate_histograms(image_sets, ["CHCHD2-AAV"], gaussian_blur=False, n_workers=1)
+    # the histograms are saved, the parallel pass must not reuse them
+    for histogram_file in tmp_path.glob("histograms_*.npz"):
+        histogram_file.unlink()
+    parallel = thresholding.accumulate_histograms(image_sets, ["CHCHD2-AAV"], gaussian_blur=False, n_workers=2)
+    assert np.array_equal(serial, parallel)
+    assert serial.shape == (4, 256)
+
+def test_background_substraction_without_blur_on_memory_mapped_channels(image_sets):
+    file = thresholding.get_image_set_files(image_sets + "/CHCHD2-AAV")[0]
+    channels = thresholding.read_4_color_channels_from_rgb(file)
+    assert not channels[0].flags.writeable
+    original = np.array(channels[0])
+    preprocessed = thresholding.preprocess_channels(*channels, gaussian_blur=False, additional_background_substraction=True, num_threads=1, background_method="tophat")
+    assert preprocessed[0].dtype == original.dtype
+    # the files are left alone
+    assert np.array_equal(thresholding.read_4_color_channels_from_rgb(file)[0], original)
+    assert np.all(preprocessed[0] <= original)
+    histograms = thresholding.channel_histograms(file, gaussian_blur=False, additional_background_substraction=True, num_threads=1, background_method="tophat")
+    assert histograms.sum() == 4 * original.size
+    # configuration "background_filtered_combo_False": no blur, the mode always substracts the background
+    thresholded = thresholding.threshold_channels(thresholding.read_4_color_channels_from_rgb(file), "background_filtered_combo", False, True, 1, "tophat")
+    assert all(channel.shape == original.shape for channel in thresholded)
+
+def test_preprocessing_cache_notices_changed_channels(image_sets, tmp_path):
+    file = thresholding.get_image_set_files(image_sets + "/CHCHD2-AAV")[0]
+    cache = thresholding.PreprocessingCache(str(tmp_path / "cache"))
+    before = np.array(thresholding.cached_preprocessed_channels(file, cache, gaussian_blur=False))
+    # replace the TOM-20 channel (c02) with a different image
+    channel_file = thresholding.get_channel_file_names(file)[2]
+    img = 255 - tifffile.imread(channel_file)
+    tifffile.imwrite(channel_file, img, photometric="rgb")
+    os.utime(channel_file, ns=(os.stat(channel_file).st_atime_ns, os.stat(channel_file).st_mtime_ns + 10 ** 9))
+    after = np.array(thresholding.cached_preprocessed_channels(file, cache, gaussian_blur=False))
+    assert np.array_equal(after[:2], before[:2])
+    assert not np.array_equal(after[2], before[2])